@@ -10,9 +10,35 @@ import zipfile
 import shutil
 import re
 import mimetypes
-from flask import Flask, Response, request, render_template_string, redirect, url_for, send_file, jsonify
-from urllib.parse import unquote, urlparse
+import hashlib
+import uuid
+import mmap
+import io
+import struct
+import bisect
+import gzip
+import sqlite3
+import math
+import asyncio
+import itertools
+import signal
+import contextlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, request, render_template, redirect, url_for, send_file, jsonify, g
+from urllib.parse import unquote, unquote_to_bytes, urlparse
+from datetime import datetime, timezone
+from werkzeug.http import http_date, quote_etag
 from waitress import serve
+from jinja2 import DictLoader
+try:
+    import brotli  # Optional: adds br variants of the static assets
+except ImportError:
+    brotli = None
+try:
+    from inotify_simple import INotify, flags as inotify_flags  # Optional: instant library updates on Linux
+except ImportError:
+    INotify = None
 
 # --- LOGGING ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
@@ -22,54 +48,13 @@ logging.getLogger('waitress').setLevel(logging.ERROR)
 logging.getLogger('urllib3').setLevel(logging.ERROR)
 
 app = Flask(__name__)
-current_file_path = None
-active_processes = {}
-process_lock = threading.Lock()
 DOWNLOAD_DIR = "downloads"
+CACHE_DIR = "cache"
+SERVER_PORT = int(os.environ.get('PORT', '5500'))
+VIDEO_EXTS = ('.mp4', '.mkv', '.avi', '.mov', '.webm')
+SUBTITLE_EXTS = ('.srt', '.vtt', '.ass', '.ssa', '.sub')
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
-
-# --- GLOBAL PROGRESS STATE ---
-# We use this to track download status across threads
-download_state = {
-    'progress': 0,
-    'status': 'Idle',
-    'msg': 'Waiting...',
-    'filename': ''
-}
-
-# --- HARDWARE ACCELERATION STATE ---
-AVAILABLE_HW_MODES = {'cpu': 'CPU (Software)'} 
-CURRENT_HW_MODE = 'cpu'
-
-def detect_hardware_encoders():
-    """Scans FFmpeg for available GPU encoders."""
-    global AVAILABLE_HW_MODES, CURRENT_HW_MODE
-    logger.info("Scanning for Hardware Acceleration...")
-    try:
-        startupinfo = None
-        if os.name == 'nt':
-            startupinfo = subprocess.STARTUPINFO()
-            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-        output = subprocess.check_output(['ffmpeg', '-v', 'error', '-encoders'], startupinfo=startupinfo).decode('utf-8')
-        
-        if 'h264_nvenc' in output:
-            AVAILABLE_HW_MODES['nvenc'] = 'NVIDIA (NVENC)'
-            CURRENT_HW_MODE = 'nvenc' 
-        if 'h264_qsv' in output:
-            AVAILABLE_HW_MODES['qsv'] = 'Intel (QuickSync)'
-            if CURRENT_HW_MODE == 'cpu': CURRENT_HW_MODE = 'qsv'
-        if 'h264_videotoolbox' in output:
-            AVAILABLE_HW_MODES['videotoolbox'] = 'Mac (VideoToolbox)'
-            if CURRENT_HW_MODE == 'cpu': CURRENT_HW_MODE = 'videotoolbox'
-        if 'h264_amf' in output:
-            AVAILABLE_HW_MODES['amf'] = 'AMD (AMF)'
-            if CURRENT_HW_MODE == 'cpu': CURRENT_HW_MODE = 'amf'
-    except Exception as e:
-        logger.warning(f"Could not detect encoders: {e}")
-    CURRENT_HW_MODE = 'cpu'
-    logger.info(f"Defaulting to: {CURRENT_HW_MODE}")
-
-detect_hardware_encoders()
+os.makedirs(CACHE_DIR, exist_ok=True)
 
 # ==========================================
 # TEMPLATES
@@ -81,20 +66,7 @@ LANDING_TEMPLATE = """
 <html>
 <head>
     <title>Stream Videos - Loader</title>
-    <style>
-        body { background: #000; color: #fff; font-family: 'Segoe UI', sans-serif; display: flex; justify-content: center; align-items: center; height: 100vh; margin: 0; }
-        .container { background: #1f1f1f; padding: 40px; border-radius: 8px; border: 1px solid #333; width: 500px; text-align: center; }
-        h1 { color: #00E676; margin-bottom: 20px; }
-        input { width: 90%; padding: 12px; margin-bottom: 20px; background: #333; border: 1px solid #555; color: white; border-radius: 4px; font-size: 1rem; }
-        button { background: #00E676; color: #000; border: none; padding: 12px 30px; font-weight: bold; cursor: pointer; border-radius: 4px; font-size: 1rem; width: 100%; transition: 0.2s; }
-        button:hover { opacity: 0.9; }
-        
-        /* Progress UI */
-        #progressArea { display: none; margin-top: 25px; }
-        .progress-track { background: #333; height: 10px; border-radius: 5px; overflow: hidden; margin-bottom: 10px; }
-        .progress-fill { background: #00E676; height: 100%; width: 0%; transition: width 0.3s ease; }
-        .status-text { color: #aaa; font-size: 0.9rem; margin-bottom: 5px; display: flex; justify-content: space-between; }
-    </style>
+    <link href="{{ asset_url('landing.css') }}" rel="stylesheet">
 </head>
 <body>
     <div class="container">
@@ -114,60 +86,89 @@ LANDING_TEMPLATE = """
             <div class="progress-track">
                 <div class="progress-fill" id="pBar"></div>
             </div>
+            <a id="playNow" href="#" style="display: none; color: #00E676; font-weight: bold; text-decoration: none;">▶ Play now while downloading</a>
         </div>
     </div>
 
-    <script>
-        document.getElementById('dlForm').addEventListener('submit', function(e) {
-            e.preventDefault();
-            const url = document.getElementById('urlInput').value;
-            const btn = document.getElementById('dlBtn');
-            const progressArea = document.getElementById('progressArea');
-            
-            // UI Updates
-            btn.style.display = 'none';
-            progressArea.style.display = 'block';
-
-            // Start Download AJAX
-            const formData = new FormData();
-            formData.append('url', url);
-
-            fetch('/process_url', { method: 'POST', body: formData })
-                .then(response => response.json())
-                .then(data => {
-                    if(data.status === 'ok') {
-                        window.location.href = '/list_files';
-                    } else {
-                        alert("Error: " + data.message);
-                        location.reload();
-                    }
-                })
-                .catch(err => {
-                    alert("Network Error: " + err);
-                    location.reload();
-                });
-
-            // Start Polling Progress
-            const pollInterval = setInterval(() => {
-                fetch('/progress')
-                    .then(r => r.json())
-                    .then(data => {
-                        document.getElementById('pBar').style.width = data.progress + '%';
-                        document.getElementById('percentTxt').innerText = data.progress + '%';
-                        document.getElementById('statusMsg').innerText = data.msg;
-                        
-                        if (data.status === 'Done') {
-                            clearInterval(pollInterval);
-                            document.getElementById('statusMsg').innerText = "Complete! Redirecting...";
-                        }
-                    });
-            }, 500);
-        });
-    </script>
+    <script src="{{ asset_url('landing.js') }}"></script>
 </body>
 </html>
 """
 
+LANDING_CSS = """
+body { background: #000; color: #fff; font-family: 'Segoe UI', sans-serif; display: flex; justify-content: center; align-items: center; height: 100vh; margin: 0; }
+.container { background: #1f1f1f; padding: 40px; border-radius: 8px; border: 1px solid #333; width: 500px; text-align: center; }
+h1 { color: #00E676; margin-bottom: 20px; }
+input { width: 90%; padding: 12px; margin-bottom: 20px; background: #333; border: 1px solid #555; color: white; border-radius: 4px; font-size: 1rem; }
+button { background: #00E676; color: #000; border: none; padding: 12px 30px; font-weight: bold; cursor: pointer; border-radius: 4px; font-size: 1rem; width: 100%; transition: 0.2s; }
+button:hover { opacity: 0.9; }
+
+/* Progress UI */
+#progressArea { display: none; margin-top: 25px; }
+.progress-track { background: #333; height: 10px; border-radius: 5px; overflow: hidden; margin-bottom: 10px; }
+.progress-fill { background: #00E676; height: 100%; width: 0%; transition: width 0.3s ease; }
+.status-text { color: #aaa; font-size: 0.9rem; margin-bottom: 5px; display: flex; justify-content: space-between; }
+"""
+
+LANDING_JS = """
+document.getElementById('dlForm').addEventListener('submit', function(e) {
+    e.preventDefault();
+    const url = document.getElementById('urlInput').value;
+    const btn = document.getElementById('dlBtn');
+    const progressArea = document.getElementById('progressArea');
+
+    // UI Updates
+    btn.style.display = 'none';
+    progressArea.style.display = 'block';
+
+    // Start Download AJAX
+    const formData = new FormData();
+    formData.append('url', url);
+
+    fetch('/process_url', { method: 'POST', body: formData })
+        .then(response => response.json())
+        .then(data => {
+            if(data.status === 'ok') {
+                watchJob(data.job_id);
+            } else {
+                alert("Error: " + data.message);
+                location.reload();
+            }
+        })
+        .catch(err => {
+            alert("Network Error: " + err);
+            location.reload();
+        });
+});
+
+// Progress is pushed by the server (SSE) instead of polled
+function watchJob(jobId) {
+    const events = new EventSource(`/progress/stream?job=${jobId}`);
+    events.onmessage = (e) => {
+        const data = JSON.parse(e.data);
+        document.getElementById('pBar').style.width = data.progress + '%';
+        document.getElementById('percentTxt').innerText = data.progress + '%';
+        document.getElementById('statusMsg').innerText = data.msg;
+        if (data.playable && data.streamable && data.status === 'Downloading') {
+            const playNow = document.getElementById('playNow');
+            playNow.href = `/set_and_play?mode=advanced&path=${encodeURIComponent(data.path)}`;
+            playNow.style.display = 'inline-block';
+        }
+
+        if (data.status === 'Done') {
+            events.close();
+            document.getElementById('statusMsg').innerText = "Complete! Redirecting...";
+            window.location.href = '/list_files';
+        } else if (data.status === 'Error' || data.status === 'Cancelled') {
+            events.close();
+            alert("Error: " + data.msg);
+            location.reload();
+        }
+    };
+}
+"""
+
+
 # 2. FILE SELECTION
 SELECTION_TEMPLATE = """
 <!DOCTYPE html>
@@ -175,34 +176,61 @@ SELECTION_TEMPLATE = """
 <head>
     <title>Select Content</title>
     <link href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css" rel="stylesheet">
-    <style>
-        body { background: #000; color: #fff; font-family: 'Segoe UI', sans-serif; padding: 50px; }
-        .file-card { background: #1f1f1f; padding: 20px; margin-bottom: 15px; border-left: 4px solid #00E676; display: flex; justify-content: space-between; align-items: center; border-radius: 4px; }
-        .name { font-weight: bold; font-size: 1.1rem; }
-        .btn { padding: 8px 15px; border-radius: 4px; text-decoration: none; font-weight: bold; margin-left: 10px; border: none; cursor: pointer; display: inline-block; }
-        .btn-adv { background: #00E676; color: #000; }
-        .btn-simple { background: #333; color: #fff; border: 1px solid #555; }
-        .btn:hover { opacity: 0.8; }
-        h2 { border-bottom: 1px solid #333; padding-bottom: 10px; margin-bottom: 20px; }
-    </style>
+    <link href="{{ asset_url('selection.css') }}" rel="stylesheet">
 </head>
 <body>
-    <h2>📂 Available Files</h2>
+    <h2>📂 Available Files <span class="count">{{ total }}</span></h2>
+    <form class="search" method="get">
+        <input type="text" name="q" value="{{ q }}" placeholder="Search files..." autocomplete="off">
+        <input type="hidden" name="sort" value="{{ sort }}">
+    </form>
     {% for file in files %}
     <div class="file-card">
-        <div class="name"><i class="fas fa-film"></i> {{ file.name }}</div>
+        <div class="info">
+            {% if file.thumbnail %}<img class="thumb" src="{{ file.thumbnail }}" loading="lazy" alt="">{% endif %}
+            <div>
+                <div class="name"><i class="fas fa-film"></i> {{ file.name }}</div>
+                <div class="meta">{% if file.indexed %}{{ file.duration_formatted or '' }}{% if file.height %} · {{ file.width }}x{{ file.height }}{% endif %}{% if file.audio_tracks|length > 1 %} · {{ file.audio_tracks|length }} audio tracks{% endif %}{% if file.subtitle_tracks %} · {{ file.subtitle_tracks|length }} subtitles{% endif %}{% else %}Indexing...{% endif %}</div>
+            </div>
+        </div>
         <div>
             <a href="/set_and_play?mode=simple&path={{ file.path }}" class="btn btn-simple">⚡ Simple Player</a>
             <a href="/set_and_play?mode=advanced&path={{ file.path }}" class="btn btn-adv">🚀 Advanced Player</a>
         </div>
     </div>
     {% endfor %}
+    {% if pages > 1 %}
+    <div class="pager">
+        {% if page > 1 %}<a href="?q={{ q|urlencode }}&sort={{ sort }}&page={{ page - 1 }}">&larr; Prev</a>{% endif %}
+        <span>Page {{ page }} of {{ pages }}</span>
+        {% if page < pages %}<a href="?q={{ q|urlencode }}&sort={{ sort }}&page={{ page + 1 }}">Next &rarr;</a>{% endif %}
+    </div>
+    {% endif %}
     <br>
     <a href="/" style="color: #666; text-decoration: none;">&larr; Load different URL</a>
 </body>
 </html>
 """
 
+SELECTION_CSS = """
+body { background: #000; color: #fff; font-family: 'Segoe UI', sans-serif; padding: 50px; }
+.file-card { background: #1f1f1f; padding: 20px; margin-bottom: 15px; border-left: 4px solid #00E676; display: flex; justify-content: space-between; align-items: center; border-radius: 4px; }
+.name { font-weight: bold; font-size: 1.1rem; }
+.btn { padding: 8px 15px; border-radius: 4px; text-decoration: none; font-weight: bold; margin-left: 10px; border: none; cursor: pointer; display: inline-block; }
+.btn-adv { background: #00E676; color: #000; }
+.btn-simple { background: #333; color: #fff; border: 1px solid #555; }
+.btn:hover { opacity: 0.8; }
+h2 { border-bottom: 1px solid #333; padding-bottom: 10px; margin-bottom: 20px; }
+.count { color: #666; font-size: 1rem; font-weight: normal; }
+.search input { width: 100%; box-sizing: border-box; padding: 10px; margin-bottom: 20px; background: #1f1f1f; border: 1px solid #333; color: #fff; border-radius: 4px; font-size: 1rem; }
+.info { display: flex; align-items: center; gap: 15px; }
+.thumb { width: 120px; border-radius: 3px; }
+.meta { color: #888; font-size: 0.85rem; margin-top: 5px; }
+.pager { display: flex; justify-content: center; gap: 20px; color: #888; margin-top: 20px; }
+.pager a { color: #00E676; text-decoration: none; }
+"""
+
+
 # 3. ADVANCED PLAYER
 ADVANCED_TEMPLATE = """
 <!DOCTYPE html>
@@ -210,38 +238,8 @@ ADVANCED_TEMPLATE = """
 <head>
     <title>Stream Videos (Advanced)</title>
     <link href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css" rel="stylesheet">
-    <style>
-        body { background: #000; color: #fff; font-family: 'Segoe UI', sans-serif; margin: 0; display: flex; flex-direction: column; height: 100vh; overflow: hidden; }
-        header { background: #1f1f1f; padding: 15px; display: flex; justify-content: space-between; align-items: center; border-bottom: 2px solid #00E676; position: fixed; top: 0; width: 100%; box-sizing: border-box; z-index: 20; transition: transform 0.5s ease-in-out; }
-        .btn-file { background: #00E676; color: #000; border: none; padding: 8px 15px; font-weight: bold; cursor: pointer; border-radius: 4px; text-decoration: none; }
-        .video-container { position: absolute; top: 0; left: 0; width: 100%; height: 100%; background: #000; display: flex; justify-content: center; align-items: center; }
-        video { width: 100%; height: 100%; object-fit: contain; }
-        .loading-overlay { position: absolute; top: 50%; left: 50%; transform: translate(-50%, -50%); z-index: 5; pointer-events: none; display: none; }
-        .spinner { border: 8px solid rgba(255, 255, 255, 0.1); border-top: 8px solid #00E676; border-radius: 50%; width: 60px; height: 60px; animation: spin 1s linear infinite; }
-        @keyframes spin { 0% { transform: rotate(0deg); } 100% { transform: rotate(360deg); } }
-        .controls { background: linear-gradient(to top, rgba(0,0,0,0.9) 0%, rgba(0,0,0,0.6) 60%, transparent 100%); padding: 20px 30px 30px 30px; display: flex; flex-direction: column; gap: 10px; position: fixed; bottom: 0; left: 0; width: 100%; box-sizing: border-box; z-index: 20; transition: opacity 0.5s ease-in-out; opacity: 1; }
-        .ui-hidden header { transform: translateY(-100%); }
-        .ui-hidden .controls { opacity: 0; pointer-events: none; }
-        .ui-hidden { cursor: none; } 
-        .seek-wrapper { display: flex; align-items: center; gap: 15px; margin-bottom: 5px; }
-        input[type=range] { flex: 1; accent-color: #00E676; cursor: pointer; height: 6px; }
-        .volume-wrapper { display: flex; align-items: center; gap: 8px; margin-left: 15px; background: rgba(255,255,255,0.1); padding: 5px 10px; border-radius: 20px; }
-        .volume-wrapper i { width: 20px; text-align: center; font-size: 1.1rem; cursor: pointer; }
-        #volumeBar { width: 80px; height: 4px; accent-color: #fff; }
-        #volumeBar.boosted { accent-color: #ff3d00; }
-        #volPercent { font-family: monospace; font-size: 0.8rem; min-width: 40px; text-align: center; }
-        .vol-reset { font-size: 0.9rem; cursor: pointer; color: #aaa; margin-left: 5px; transition: color 0.2s;}
-        .vol-reset:hover { color: #fff; }
-        .time-display { font-family: monospace; font-size: 14px; min-width: 100px; text-align: right; user-select: none; }
-        .buttons-row { display: flex; align-items: center; gap: 20px; }
-        .btn-ctrl { background: none; border: none; color: white; font-size: 1.5rem; cursor: pointer; width: 35px; transition: color 0.2s; }
-        .btn-ctrl:hover { color: #00E676; transform: scale(1.1); }
-        .right-controls { margin-left: auto; display: flex; align-items: center; gap: 10px; }
-        .select-group { display: flex; flex-direction: column; gap: 2px; }
-        .select-group label { font-size: 0.7rem; color: #aaa; margin-left: 2px; }
-        select { background: #333; color: white; border: 1px solid #555; padding: 5px; border-radius: 4px; cursor: pointer; max-width: 140px; font-size: 0.9rem;}
-        .sync-msg { position: absolute; top: 10%; right: 5%; background: rgba(0,0,0,0.7); color: #fff; padding: 10px 20px; border-radius: 5px; font-weight: bold; display: none; pointer-events: none; z-index: 30; border: 1px solid #00E676; }
-    </style>
+    <script src="https://cdnjs.cloudflare.com/ajax/libs/hls.js/1.5.7/hls.min.js"></script>
+    <link href="{{ asset_url('advanced.css') }}" rel="stylesheet">
 </head>
 <body class="ui-visible">
     <header id="topBar"><h3>🚀 Advanced Player</h3><a href="/list_files" class="btn-file">📂 Menu</a></header>
@@ -254,7 +252,9 @@ ADVANCED_TEMPLATE = """
         </video>
 
         <div class="controls" id="bottomBar">
-            <div class="seek-wrapper"><span id="currentTime">00:00</span><input type="range" id="seekBar" min="0" max="{{ duration }}" value="0" step="1"><span id="totalTime">{{ duration_formatted }}</span></div>
+            <div class="seek-wrapper"><span id="currentTime">00:00</span><input type="range" id="seekBar" min="0" max="{{ duration }}" value="0" step="1"><span id="totalTime">{{ duration_formatted }}</span>
+                <div class="seek-preview" id="seekPreview"><div class="seek-thumb" id="seekThumb"></div><span id="seekPreviewTime">00:00</span></div>
+            </div>
             <div class="buttons-row">
                 <button class="btn-ctrl" onclick="togglePlay()"><i id="playIcon" class="fas fa-pause"></i></button>
                 <button class="btn-ctrl" onclick="seekRelative(-10)"><i class="fas fa-backward"></i></button>
@@ -276,7 +276,8 @@ ADVANCED_TEMPLATE = """
                         </select>
                     </div>
                     
-                    <div class="select-group"><label>Quality</label><select id="qualitySelect" onchange="changeQuality(this.value)"><option value="original" {% if current_quality == 'original' %}selected{% endif %}>Original</option><option value="1080p" {% if current_quality == '1080p' %}selected{% endif %}>1080p</option><option value="720p" {% if current_quality == '720p' %}selected{% endif %}>720p</option></select></div>
+                    <div class="select-group"><label>Stream</label><select id="streamSelect" onchange="changeStreamMode(this.value)"><option value="progressive" {% if stream_mode == 'progressive' %}selected{% endif %}>Progressive</option><option value="hls" {% if stream_mode == 'hls' %}selected{% endif %}>Segmented (HLS)</option></select></div>
+                    <div class="select-group"><label>Quality</label><select id="qualitySelect" onchange="changeQuality(this.value)"><option value="original" {% if current_quality == 'original' %}selected{% endif %}>Original</option><option value="1080p" {% if current_quality == '1080p' %}selected{% endif %}>1080p</option><option value="720p" {% if current_quality == '720p' %}selected{% endif %}>720p</option><option value="auto" {% if current_quality == 'auto' %}selected{% endif %}>Auto (HLS)</option></select></div>
                     <div class="select-group"><label>Subtitles</label><select id="subSelect" onchange="changeSubtitleTrack(this.value)"><option value="-1">Off</option>{% for index, label in sub_tracks.items() %}<option value="{{ index }}">{{ label }}</option>{% endfor %}</select></div>
                     <div class="select-group"><label>Audio</label><select id="audioSelect" onchange="switchAudio(this.value)">{% for index, data in audio_tracks.items() %}<option value="{{ index }}" {% if index == current_audio %}selected{% endif %}>{{ data.label }}</option>{% endfor %}</select></div>
                     <button class="btn-ctrl" onclick="toggleFullScreen()"><i id="fsIcon" class="fas fa-expand"></i></button>
@@ -284,120 +285,235 @@ ADVANCED_TEMPLATE = """
             </div>
         </div>
     </div>
-    <script>
-        const video = document.getElementById('vid'); 
-        const seekBar = document.getElementById('seekBar'); 
-        const playIcon = document.getElementById('playIcon'); 
-        const spinner = document.getElementById('loadingSpinner'); 
-        const syncMsg = document.getElementById('syncMsg'); 
-        const volumeBar = document.getElementById('volumeBar');
-        const volIcon = document.getElementById('volIcon');
-        const volPercent = document.getElementById('volPercent');
-        const body = document.body;
-        let hideTimer, syncTimer, seekTimeout;
-
-        let audioCtx, gainNode, source;
-        function initAudioBoost() {
-            if(!audioCtx) {
-                const AudioContext = window.AudioContext || window.webkitAudioContext;
-                audioCtx = new AudioContext();
-                source = audioCtx.createMediaElementSource(video);
-                gainNode = audioCtx.createGain();
-                source.connect(gainNode);
-                gainNode.connect(audioCtx.destination);
-            }
-        }
-        if(volumeBar) { volumeBar.addEventListener('input', (e) => { applyVolume(parseFloat(e.target.value)); }); }
-        function applyVolume(val) {
-            if(!audioCtx && val > 1) initAudioBoost();
-            if (val <= 1) { video.volume = val; if(gainNode) gainNode.gain.value = 1; volumeBar.classList.remove('boosted'); } 
-            else { video.volume = 1; initAudioBoost(); gainNode.gain.value = val; volumeBar.classList.add('boosted'); }
-            volumeBar.value = val; volPercent.innerText = Math.round(val * 100) + '%'; updateVolIcon(val);
-        }
-        function resetVolume() { applyVolume(1); }
-        function updateVolIcon(val) {
-            if(val == 0) volIcon.className = "fas fa-volume-mute";
-            else if(val < 0.5) volIcon.className = "fas fa-volume-down";
-            else if(val <= 1) volIcon.className = "fas fa-volume-up";
-            else volIcon.className = "fas fa-bolt"; 
-        }
-        function toggleMute() {
-            if(video.muted) { video.muted = false; applyVolume(video.getAttribute('data-last-vol') || 1); } 
-            else { video.setAttribute('data-last-vol', volumeBar.value); video.muted = true; volumeBar.value = 0; volPercent.innerText = "0%"; updateVolIcon(0); }
-        }
-        function showLoading() { if(spinner) spinner.style.display = 'block'; }
-        function hideLoading() { if(spinner) spinner.style.display = 'none'; }
-        if (video) { video.addEventListener('waiting', showLoading); video.addEventListener('playing', hideLoading); video.addEventListener('seeking', showLoading); video.addEventListener('seeked', hideLoading); }
-
-        let isSeeking = false; let totalDuration = {{ duration }}; 
-        const startSeconds = {{ start_time }}; 
-        let currentAudio = "{{ current_audio }}";
-        let currentQuality = "{{ current_quality }}";
-        let currentSubIndex = -1; let globalSubOffset = 0;
-        let currentHw = "{{ current_hw }}";
-
-        window.changeQuality = function(newQuality) { currentQuality = newQuality; reloadStream(); }
-        window.switchAudio = function(newAudio) { currentAudio = newAudio; reloadStream(); }
-        window.changeHardware = function(newHw) { fetch(`/set_hw?mode=${newHw}`).then(() => { currentHw = newHw; reloadStream(); }); }
-
-        function reloadStream() {
-            let time = video.currentTime + (window.lastSeekTime || 0);
-            window.lastSeekTime = time; 
-            destroySubtitleTrack(); showLoading();
-            const url = `/video_feed?start=${time}&audio_index=${currentAudio}&quality=${currentQuality}&hw=${currentHw}`;
-            video.src = url; video.play().catch(e => console.log(e));
-            setTimeout(() => { refreshSubtitles(time); }, 200);
-        }
+    <script>const PLAYER = {{ {'duration': duration, 'start_time': start_time, 'current_audio': current_audio|string, 'current_quality': current_quality, 'current_hw': current_hw, 'stream_mode': stream_mode}|tojson }};</script>
+    <script src="{{ asset_url('advanced.js') }}"></script>
+</body>
+</html>
+"""
 
-        function destroySubtitleTrack() {
-            const oldTrack = document.getElementById('dynamic-sub-track');
-            if (oldTrack) oldTrack.remove(); 
-            for(let i=0; i < video.textTracks.length; i++) video.textTracks[i].mode = 'disabled';
-        }
-        function changeSubtitleTrack(index) { currentSubIndex = index; globalSubOffset = 0; refreshSubtitles(window.lastSeekTime || 0); }
-        function refreshSubtitles(startTime) { 
-            destroySubtitleTrack(); if (currentSubIndex == -1) return; 
-            const timestamp = Date.now();
-            const trackUrl = `/subtitle_feed?index=${currentSubIndex}&start=${startTime}&offset=${globalSubOffset}&t=${timestamp}`;
-            const newTrack = document.createElement('track'); newTrack.id = 'dynamic-sub-track'; newTrack.kind = 'subtitles'; newTrack.label = 'Dynamic Subs'; newTrack.srclang = 'en'; newTrack.default = true; newTrack.src = trackUrl;
-            video.appendChild(newTrack); newTrack.onload = function() { this.track.mode = 'showing'; };
-        }
-        function adjustSync(amount) { 
-            if (currentSubIndex == -1) return; globalSubOffset += amount; 
-            syncMsg.innerText = `Subtitle Delay: ${Math.round(globalSubOffset * 1000)}ms`; syncMsg.style.display = 'block'; 
-            clearTimeout(syncTimer); syncTimer = setTimeout(() => { syncMsg.style.display = 'none'; }, 2000); 
-            refreshSubtitles(window.lastSeekTime + video.currentTime); 
-        }
+ADVANCED_CSS = """
+body { background: #000; color: #fff; font-family: 'Segoe UI', sans-serif; margin: 0; display: flex; flex-direction: column; height: 100vh; overflow: hidden; }
+header { background: #1f1f1f; padding: 15px; display: flex; justify-content: space-between; align-items: center; border-bottom: 2px solid #00E676; position: fixed; top: 0; width: 100%; box-sizing: border-box; z-index: 20; transition: transform 0.5s ease-in-out; }
+.btn-file { background: #00E676; color: #000; border: none; padding: 8px 15px; font-weight: bold; cursor: pointer; border-radius: 4px; text-decoration: none; }
+.video-container { position: absolute; top: 0; left: 0; width: 100%; height: 100%; background: #000; display: flex; justify-content: center; align-items: center; }
+video { width: 100%; height: 100%; object-fit: contain; }
+.loading-overlay { position: absolute; top: 50%; left: 50%; transform: translate(-50%, -50%); z-index: 5; pointer-events: none; display: none; }
+.spinner { border: 8px solid rgba(255, 255, 255, 0.1); border-top: 8px solid #00E676; border-radius: 50%; width: 60px; height: 60px; animation: spin 1s linear infinite; }
+@keyframes spin { 0% { transform: rotate(0deg); } 100% { transform: rotate(360deg); } }
+.controls { background: linear-gradient(to top, rgba(0,0,0,0.9) 0%, rgba(0,0,0,0.6) 60%, transparent 100%); padding: 20px 30px 30px 30px; display: flex; flex-direction: column; gap: 10px; position: fixed; bottom: 0; left: 0; width: 100%; box-sizing: border-box; z-index: 20; transition: opacity 0.5s ease-in-out; opacity: 1; }
+.ui-hidden header { transform: translateY(-100%); }
+.ui-hidden .controls { opacity: 0; pointer-events: none; }
+.ui-hidden { cursor: none; } 
+.seek-wrapper { display: flex; align-items: center; gap: 15px; margin-bottom: 5px; position: relative; }
+input[type=range] { flex: 1; accent-color: #00E676; cursor: pointer; height: 6px; }
+.seek-preview { position: absolute; bottom: 25px; display: none; flex-direction: column; align-items: center; pointer-events: none; background: rgba(0,0,0,0.8); border: 1px solid #333; border-radius: 4px; padding: 3px; font-size: 0.8rem; }
+.seek-thumb { background-repeat: no-repeat; margin-bottom: 3px; }
+.volume-wrapper { display: flex; align-items: center; gap: 8px; margin-left: 15px; background: rgba(255,255,255,0.1); padding: 5px 10px; border-radius: 20px; }
+.volume-wrapper i { width: 20px; text-align: center; font-size: 1.1rem; cursor: pointer; }
+#volumeBar { width: 80px; height: 4px; accent-color: #fff; }
+#volumeBar.boosted { accent-color: #ff3d00; }
+#volPercent { font-family: monospace; font-size: 0.8rem; min-width: 40px; text-align: center; }
+.vol-reset { font-size: 0.9rem; cursor: pointer; color: #aaa; margin-left: 5px; transition: color 0.2s;}
+.vol-reset:hover { color: #fff; }
+.time-display { font-family: monospace; font-size: 14px; min-width: 100px; text-align: right; user-select: none; }
+.buttons-row { display: flex; align-items: center; gap: 20px; }
+.btn-ctrl { background: none; border: none; color: white; font-size: 1.5rem; cursor: pointer; width: 35px; transition: color 0.2s; }
+.btn-ctrl:hover { color: #00E676; transform: scale(1.1); }
+.right-controls { margin-left: auto; display: flex; align-items: center; gap: 10px; }
+.select-group { display: flex; flex-direction: column; gap: 2px; }
+.select-group label { font-size: 0.7rem; color: #aaa; margin-left: 2px; }
+select { background: #333; color: white; border: 1px solid #555; padding: 5px; border-radius: 4px; cursor: pointer; max-width: 140px; font-size: 0.9rem;}
+.sync-msg { position: absolute; top: 10%; right: 5%; background: rgba(0,0,0,0.7); color: #fff; padding: 10px 20px; border-radius: 5px; font-weight: bold; display: none; pointer-events: none; z-index: 30; border: 1px solid #00E676; }
+"""
 
-        if(seekBar) { 
-            seekBar.addEventListener('input', (e) => { isSeeking = true; document.getElementById('currentTime').innerText = formatTime(e.target.value); }); 
-            seekBar.addEventListener('change', (e) => { 
-                let newTime = parseFloat(e.target.value); isSeeking = false; 
-                clearTimeout(seekTimeout);
-                seekTimeout = setTimeout(() => { window.lastSeekTime = newTime; reloadStream(); }, 200);
-            }); 
-        }
+ADVANCED_JS = """
+const video = document.getElementById('vid'); 
+const seekBar = document.getElementById('seekBar'); 
+const playIcon = document.getElementById('playIcon'); 
+const spinner = document.getElementById('loadingSpinner'); 
+const syncMsg = document.getElementById('syncMsg'); 
+const volumeBar = document.getElementById('volumeBar');
+const volIcon = document.getElementById('volIcon');
+const volPercent = document.getElementById('volPercent');
+const body = document.body;
+let hideTimer, syncTimer, seekTimeout, prerollTimeout;
+
+let audioCtx, gainNode, source;
+function initAudioBoost() {
+    if(!audioCtx) {
+        const AudioContext = window.AudioContext || window.webkitAudioContext;
+        audioCtx = new AudioContext();
+        source = audioCtx.createMediaElementSource(video);
+        gainNode = audioCtx.createGain();
+        source.connect(gainNode);
+        gainNode.connect(audioCtx.destination);
+    }
+}
+if(volumeBar) { volumeBar.addEventListener('input', (e) => { applyVolume(parseFloat(e.target.value)); }); }
+function applyVolume(val) {
+    if(!audioCtx && val > 1) initAudioBoost();
+    if (val <= 1) { video.volume = val; if(gainNode) gainNode.gain.value = 1; volumeBar.classList.remove('boosted'); } 
+    else { video.volume = 1; initAudioBoost(); gainNode.gain.value = val; volumeBar.classList.add('boosted'); }
+    volumeBar.value = val; volPercent.innerText = Math.round(val * 100) + '%'; updateVolIcon(val);
+}
+function resetVolume() { applyVolume(1); }
+function updateVolIcon(val) {
+    if(val == 0) volIcon.className = "fas fa-volume-mute";
+    else if(val < 0.5) volIcon.className = "fas fa-volume-down";
+    else if(val <= 1) volIcon.className = "fas fa-volume-up";
+    else volIcon.className = "fas fa-bolt"; 
+}
+function toggleMute() {
+    if(video.muted) { video.muted = false; applyVolume(video.getAttribute('data-last-vol') || 1); } 
+    else { video.setAttribute('data-last-vol', volumeBar.value); video.muted = true; volumeBar.value = 0; volPercent.innerText = "0%"; updateVolIcon(0); }
+}
+function showLoading() { if(spinner) spinner.style.display = 'block'; }
+function hideLoading() { if(spinner) spinner.style.display = 'none'; }
+if (video) { video.addEventListener('waiting', showLoading); video.addEventListener('playing', hideLoading); video.addEventListener('seeking', showLoading); video.addEventListener('seeked', hideLoading); }
+
+let isSeeking = false; let totalDuration = PLAYER.duration; 
+const startSeconds = PLAYER.start_time; 
+let currentAudio = PLAYER.current_audio;
+let currentQuality = PLAYER.current_quality;
+let currentSubIndex = -1; let globalSubOffset = 0;
+let currentHw = PLAYER.current_hw;
+let streamMode = PLAYER.stream_mode;
+let hls = null; let loadSeq = 0;
+
+window.changeQuality = function(newQuality) {
+    currentQuality = newQuality;
+    // The bitrate ladder is only available as HLS, where the player switches renditions itself
+    if (newQuality === 'auto' && streamMode !== 'hls') { document.getElementById('streamSelect').value = 'hls'; changeStreamMode('hls'); return; }
+    reloadStream();
+}
+window.switchAudio = function(newAudio) {
+    currentAudio = newAudio;
+    // HLS carries every audio track as its own rendition, so switching leaves the video alone
+    const trackIndex = Array.from(document.getElementById('audioSelect').options).findIndex(o => o.value === newAudio);
+    if (streamMode === 'hls' && hls && trackIndex < hls.audioTracks.length) { hls.audioTrack = trackIndex; return; }
+    if (streamMode === 'hls' && !hls && video.audioTracks && trackIndex < video.audioTracks.length) {
+        for (let i = 0; i < video.audioTracks.length; i++) video.audioTracks[i].enabled = (i === trackIndex);
+        return;
+    }
+    reloadStream();
+}
+window.changeHardware = function(newHw) { fetch(`/set_hw?mode=${newHw}`).then(() => { currentHw = newHw; reloadStream(); }); }
+window.changeStreamMode = function(newMode) { let time = currentPosition(); streamMode = newMode; loadStream(time); }
+
+// Progressive streams restart at lastSeekTime; HLS streams keep absolute timestamps
+function currentPosition() { return streamMode === 'hls' ? video.currentTime : video.currentTime + (window.lastSeekTime || 0); }
+
+function loadStream(time) {
+    destroySubtitleTrack(); showLoading();
+    const seq = ++loadSeq;
+    const params = `audio_index=${currentAudio}&quality=${currentQuality}&hw=${currentHw}`;
+    if (hls) { hls.destroy(); hls = null; }
+    if (streamMode === 'hls') {
+        window.lastSeekTime = 0;
+        const url = `/hls/playlist.m3u8?${params}`;
+        if (window.Hls && Hls.isSupported()) { hls = new Hls({ startPosition: time }); hls.loadSource(url); hls.attachMedia(video); }
+        else { video.src = url; video.addEventListener('loadedmetadata', () => { video.currentTime = time; }, { once: true }); }
+    } else {
+        // Copy-mode streams start on a keyframe; ask which one, so lastSeekTime stays exact
+        fetch(`/seek_point?start=${time}&quality=${currentQuality}`).then(r => r.json()).catch(() => ({ start: time })).then(point => {
+            if (seq !== loadSeq) return;
+            window.lastSeekTime = point.start;
+            video.src = `/video_feed?start=${point.start}&${params}`;
+            startPlayback(point.start);
+        });
+        return;
+    }
+    startPlayback(0);
+}
+function startPlayback(subStart) {
+    video.play().catch(e => console.log(e));
+    setTimeout(() => { refreshSubtitles(subStart); }, 200);
+}
+function reloadStream() { loadStream(currentPosition()); }
 
-        if(video) { 
-            window.lastSeekTime = startSeconds; 
-            const url = `/video_feed?start=${startSeconds}&audio_index=${currentAudio}&quality=${currentQuality}&hw=${currentHw}`;
-            video.src = url; showControls(); 
-            setTimeout(() => { refreshSubtitles(startSeconds); }, 500);
-        }
+function destroySubtitleTrack() {
+    const oldTrack = document.getElementById('dynamic-sub-track');
+    if (oldTrack) oldTrack.remove(); 
+    for(let i=0; i < video.textTracks.length; i++) video.textTracks[i].mode = 'disabled';
+}
+function changeSubtitleTrack(index) { currentSubIndex = index; globalSubOffset = 0; refreshSubtitles(window.lastSeekTime || 0); }
+function refreshSubtitles(startTime) { 
+    destroySubtitleTrack(); if (currentSubIndex == -1) return; 
+    const timestamp = Date.now();
+    const trackUrl = `/subtitle_feed?index=${currentSubIndex}&start=${startTime}&offset=${globalSubOffset}&t=${timestamp}`;
+    const newTrack = document.createElement('track'); newTrack.id = 'dynamic-sub-track'; newTrack.kind = 'subtitles'; newTrack.label = 'Dynamic Subs'; newTrack.srclang = 'en'; newTrack.default = true; newTrack.src = trackUrl;
+    video.appendChild(newTrack); newTrack.onload = function() { this.track.mode = 'showing'; };
+}
+function adjustSync(amount) { 
+    if (currentSubIndex == -1) return; globalSubOffset += amount; 
+    syncMsg.innerText = `Subtitle Delay: ${Math.round(globalSubOffset * 1000)}ms`; syncMsg.style.display = 'block'; 
+    clearTimeout(syncTimer); syncTimer = setTimeout(() => { syncMsg.style.display = 'none'; }, 2000); 
+    refreshSubtitles(window.lastSeekTime); 
+}
 
-        setInterval(() => { if (video && !isSeeking && !video.paused) { let sessionTime = video.currentTime; let actualPosition = window.lastSeekTime + sessionTime; updateUI(actualPosition); } }, 250);
-        function updateUI(seconds) { if(seconds > totalDuration) seconds = totalDuration; if(seekBar) seekBar.value = seconds; if(document.getElementById('currentTime')) document.getElementById('currentTime').innerText = formatTime(seconds); }
-        function showControls() { body.classList.remove('ui-hidden'); clearTimeout(hideTimer); hideTimer = setTimeout(() => { if (video && !video.paused) body.classList.add('ui-hidden'); }, 5000); }
-        document.addEventListener('mousemove', showControls); document.addEventListener('keydown', (e) => { if (!video) return; if(["Space","ArrowUp","ArrowDown","ArrowLeft","ArrowRight"].indexOf(e.code) > -1) e.preventDefault(); switch(e.code) { case 'Space': case 'k': togglePlay(); break; case 'ArrowRight': case 'l': seekRelative(10); break; case 'ArrowLeft': case 'j': seekRelative(-10); break; case 'KeyF': toggleFullScreen(); break; case 'KeyG': adjustSync(-0.05); break; case 'KeyH': adjustSync(0.05); break; } showControls(); });
-        function togglePlay() { if (video.paused) { video.play(); playIcon.className = "fas fa-pause"; showControls(); } else { video.pause(); playIcon.className = "fas fa-play"; clearTimeout(hideTimer); body.classList.remove('ui-hidden'); } }
-        function seekRelative(seconds) { let current = parseFloat(seekBar.value); let newTime = current + seconds; if(newTime < 0) newTime = 0; if(newTime > totalDuration) newTime = totalDuration; seekBar.value = newTime; seekBar.dispatchEvent(new Event('change')); showControls(); }
-        function toggleFullScreen() { if (!document.fullscreenElement) document.documentElement.requestFullscreen(); else document.exitFullscreen(); }
-        function formatTime(seconds) { let h = Math.floor(seconds / 3600); let m = Math.floor((seconds % 3600) / 60); let s = Math.floor(seconds % 60); if (h > 0) return `${h}:${m.toString().padStart(2,'0')}:${s.toString().padStart(2,'0')}`; return `${m}:${s.toString().padStart(2,'0')}`; }
-    </script>
-</body>
-</html>
+// Seek previews: tiles of the sprite sheets named by the server's WebVTT thumbnail map
+let thumbCues = [];
+function vttSeconds(stamp) { return stamp.split(':').reduce((total, part) => total * 60 + parseFloat(part), 0); }
+function loadSeekPreview(attempt = 0) {
+    fetch('/seek_preview').then(r => r.json()).then(data => {
+        if (data.status === 'building' && attempt < 40) { setTimeout(() => loadSeekPreview(attempt + 1), 3000); return; }
+        if (data.status !== 'ready') return;
+        return fetch(data.vtt).then(r => r.text()).then(text => {
+            thumbCues = [];
+            for (const block of text.split(/\\n\\n+/)) {
+                const lines = block.trim().split('\\n'); const m = lines[0].match(/^([\\d:.]+) --> ([\\d:.]+)/);
+                if (!m || !lines[1] || !lines[1].includes('#xywh=')) continue;
+                const [url, xywh] = lines[1].split('#xywh='); const [x, y, w, h] = xywh.split(',').map(Number);
+                thumbCues.push({ start: vttSeconds(m[1]), end: vttSeconds(m[2]), url, x, y, w, h });
+            }
+        });
+    }).catch(() => {});
+}
+function showSeekPreview(seconds) {
+    const preview = document.getElementById('seekPreview'); const thumb = document.getElementById('seekThumb');
+    const cue = thumbCues.find(c => seconds >= c.start && seconds < c.end) || (thumbCues.length && seconds >= thumbCues[thumbCues.length - 1].start ? thumbCues[thumbCues.length - 1] : null);
+    if (cue) { thumb.style.display = 'block'; thumb.style.width = cue.w + 'px'; thumb.style.height = cue.h + 'px'; thumb.style.backgroundImage = `url(${cue.url})`; thumb.style.backgroundPosition = `-${cue.x}px -${cue.y}px`; }
+    else thumb.style.display = 'none';
+    document.getElementById('seekPreviewTime').innerText = formatTime(seconds);
+    preview.style.display = 'flex';
+    const fraction = totalDuration ? Math.min(1, Math.max(0, seconds / totalDuration)) : 0;
+    const center = seekBar.offsetLeft + fraction * seekBar.offsetWidth; const half = preview.offsetWidth / 2;
+    preview.style.left = Math.min(Math.max(0, center - half), seekBar.parentElement.clientWidth - preview.offsetWidth) + 'px';
+}
+function hideSeekPreview() { document.getElementById('seekPreview').style.display = 'none'; }
+
+if(seekBar) { 
+    seekBar.addEventListener('mousemove', (e) => { if (!isSeeking) showSeekPreview(e.offsetX / seekBar.offsetWidth * totalDuration); });
+    seekBar.addEventListener('mouseleave', () => { if (!isSeeking) hideSeekPreview(); });
+    seekBar.addEventListener('input', (e) => {
+        isSeeking = true; document.getElementById('currentTime').innerText = formatTime(e.target.value);
+        showSeekPreview(parseFloat(e.target.value));
+        // Let the server start on the likely target while the thumb is still moving
+        clearTimeout(prerollTimeout);
+        prerollTimeout = setTimeout(() => {
+            fetch(`/preroll?start=${e.target.value}&stream=${streamMode}&audio_index=${currentAudio}&quality=${currentQuality}&hw=${currentHw}`).catch(() => {});
+        }, 150);
+    }); 
+    seekBar.addEventListener('change', (e) => { 
+        let newTime = parseFloat(e.target.value); isSeeking = false; hideSeekPreview();
+        clearTimeout(seekTimeout); clearTimeout(prerollTimeout);
+        seekTimeout = setTimeout(() => { if (streamMode === 'hls') video.currentTime = newTime; else loadStream(newTime); }, 200);
+    }); 
+}
+
+if(video) { loadStream(startSeconds); showControls(); loadSeekPreview(); }
+
+setInterval(() => { if (video && !isSeeking && !video.paused) updateUI(currentPosition()); }, 250);
+function updateUI(seconds) { if(seconds > totalDuration) seconds = totalDuration; if(seekBar) seekBar.value = seconds; if(document.getElementById('currentTime')) document.getElementById('currentTime').innerText = formatTime(seconds); }
+function showControls() { body.classList.remove('ui-hidden'); clearTimeout(hideTimer); hideTimer = setTimeout(() => { if (video && !video.paused) body.classList.add('ui-hidden'); }, 5000); }
+document.addEventListener('mousemove', showControls); document.addEventListener('keydown', (e) => { if (!video) return; if(["Space","ArrowUp","ArrowDown","ArrowLeft","ArrowRight"].indexOf(e.code) > -1) e.preventDefault(); switch(e.code) { case 'Space': case 'k': togglePlay(); break; case 'ArrowRight': case 'l': seekRelative(10); break; case 'ArrowLeft': case 'j': seekRelative(-10); break; case 'KeyF': toggleFullScreen(); break; case 'KeyG': adjustSync(-0.05); break; case 'KeyH': adjustSync(0.05); break; } showControls(); });
+function togglePlay() { if (video.paused) { video.play(); playIcon.className = "fas fa-pause"; showControls(); } else { video.pause(); playIcon.className = "fas fa-play"; clearTimeout(hideTimer); body.classList.remove('ui-hidden'); } }
+function seekRelative(seconds) { let current = parseFloat(seekBar.value); let newTime = current + seconds; if(newTime < 0) newTime = 0; if(newTime > totalDuration) newTime = totalDuration; seekBar.value = newTime; seekBar.dispatchEvent(new Event('change')); showControls(); }
+function toggleFullScreen() { if (!document.fullscreenElement) document.documentElement.requestFullscreen(); else document.exitFullscreen(); }
+function formatTime(seconds) { let h = Math.floor(seconds / 3600); let m = Math.floor((seconds % 3600) / 60); let s = Math.floor(seconds % 60); if (h > 0) return `${h}:${m.toString().padStart(2,'0')}:${s.toString().padStart(2,'0')}`; return `${m}:${s.toString().padStart(2,'0')}`; }
 """
 
+
 # 4. SIMPLE PLAYER
 SIMPLE_TEMPLATE = """
 <!DOCTYPE html>
@@ -405,36 +521,7 @@ SIMPLE_TEMPLATE = """
 <head>
     <title>Stream Videos (Simple)</title>
     <link href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css" rel="stylesheet">
-    <style>
-        /* Exact copy of Advanced CSS */
-        body { background: #000; color: #fff; font-family: 'Segoe UI', sans-serif; margin: 0; display: flex; flex-direction: column; height: 100vh; overflow: hidden; }
-        header { background: #1f1f1f; padding: 15px; display: flex; justify-content: space-between; align-items: center; border-bottom: 2px solid #00E676; position: fixed; top: 0; width: 100%; box-sizing: border-box; z-index: 20; transition: transform 0.5s ease-in-out; }
-        .btn-file { background: #333; color: #fff; border: 1px solid #555; padding: 8px 15px; font-weight: bold; cursor: pointer; border-radius: 4px; text-decoration: none; }
-        .video-container { position: absolute; top: 0; left: 0; width: 100%; height: 100%; background: #000; display: flex; justify-content: center; align-items: center; }
-        video { width: 100%; height: 100%; object-fit: contain; }
-        .controls { background: linear-gradient(to top, rgba(0,0,0,0.9) 0%, rgba(0,0,0,0.6) 60%, transparent 100%); padding: 20px 30px 30px 30px; display: flex; flex-direction: column; gap: 10px; position: fixed; bottom: 0; left: 0; width: 100%; box-sizing: border-box; z-index: 20; transition: opacity 0.5s ease-in-out; opacity: 1; }
-        .ui-hidden header { transform: translateY(-100%); }
-        .ui-hidden .controls { opacity: 0; pointer-events: none; }
-        .ui-hidden { cursor: none; } 
-        .seek-wrapper { display: flex; align-items: center; gap: 15px; margin-bottom: 5px; }
-        input[type=range] { flex: 1; accent-color: #00E676; cursor: pointer; height: 6px; }
-        .volume-wrapper { display: flex; align-items: center; gap: 8px; margin-left: 15px; background: rgba(255,255,255,0.1); padding: 5px 10px; border-radius: 20px; }
-        .volume-wrapper i { width: 20px; text-align: center; font-size: 1.1rem; cursor: pointer; }
-        #volumeBar { width: 80px; height: 4px; accent-color: #fff; }
-        #volumeBar.boosted { accent-color: #ff3d00; }
-        #volPercent { font-family: monospace; font-size: 0.8rem; min-width: 40px; text-align: center; }
-        .buttons-row { display: flex; align-items: center; gap: 20px; }
-        .btn-ctrl { background: none; border: none; color: white; font-size: 1.5rem; cursor: pointer; width: 35px; transition: color 0.2s; }
-        .btn-ctrl:hover { color: #00E676; transform: scale(1.1); }
-        .right-controls { margin-left: auto; display: flex; align-items: center; gap: 10px; }
-        .select-group { display: flex; flex-direction: column; gap: 2px; }
-        .select-group label { font-size: 0.7rem; color: #aaa; margin-left: 2px; }
-        select { background: #333; color: white; border: 1px solid #555; padding: 5px; border-radius: 4px; cursor: pointer; max-width: 140px; font-size: 0.9rem;}
-        .loading-overlay { position: absolute; top: 50%; left: 50%; transform: translate(-50%, -50%); z-index: 5; pointer-events: none; display: none; }
-        .spinner { border: 8px solid rgba(255, 255, 255, 0.1); border-top: 8px solid #00E676; border-radius: 50%; width: 60px; height: 60px; animation: spin 1s linear infinite; }
-        @keyframes spin { 0% { transform: rotate(0deg); } 100% { transform: rotate(360deg); } }
-        .time-display { font-family: monospace; font-size: 14px; min-width: 100px; text-align: right; user-select: none; }
-    </style>
+    <link href="{{ asset_url('simple.css') }}" rel="stylesheet">
 </head>
 <body class="ui-visible">
     <header id="topBar"><h3>⚡ Simple player</h3><a href="/list_files" class="btn-file">📂 Menu</a></header>
@@ -442,7 +529,7 @@ SIMPLE_TEMPLATE = """
         <div class="loading-overlay" id="loadingSpinner"><div class="spinner"></div></div>
         
         <video id="vid" autoplay onclick="togglePlay()" ondblclick="toggleFullScreen()">
-            <source src="/raw_stream" type="video/mp4">
+            <source src="{{ media_url }}" type="video/mp4">
         </video>
 
         <div class="controls" id="bottomBar">
@@ -474,101 +561,367 @@ SIMPLE_TEMPLATE = """
             </div>
         </div>
     </div>
-    <script>
-        const video = document.getElementById('vid');
-        const seekBar = document.getElementById('seekBar');
-        const playIcon = document.getElementById('playIcon');
-        const spinner = document.getElementById('loadingSpinner');
-        const volumeBar = document.getElementById('volumeBar');
-        const volIcon = document.getElementById('volIcon');
-        const volPercent = document.getElementById('volPercent');
-        const body = document.body;
-        let hideTimer;
-
-        // --- AUDIO BOOST (Client Side) ---
-        let audioCtx, gainNode, source;
-        function initAudioBoost() {
-            if(!audioCtx) {
-                const AudioContext = window.AudioContext || window.webkitAudioContext;
-                audioCtx = new AudioContext();
-                source = audioCtx.createMediaElementSource(video);
-                gainNode = audioCtx.createGain();
-                source.connect(gainNode);
-                gainNode.connect(audioCtx.destination);
-            }
-        }
-        volumeBar.addEventListener('input', (e) => { applyVolume(parseFloat(e.target.value)); });
-        function applyVolume(val) {
-            if(!audioCtx && val > 1) initAudioBoost();
-            if (val <= 1) { video.volume = val; if(gainNode) gainNode.gain.value = 1; volumeBar.classList.remove('boosted'); } 
-            else { video.volume = 1; initAudioBoost(); gainNode.gain.value = val; volumeBar.classList.add('boosted'); }
-            volumeBar.value = val;
-            volPercent.innerText = Math.round(val * 100) + '%';
-            updateVolIcon(val);
-        }
-        function updateVolIcon(val) {
-            if(val == 0) volIcon.className = "fas fa-volume-mute";
-            else if(val < 0.5) volIcon.className = "fas fa-volume-down";
-            else if(val <= 1) volIcon.className = "fas fa-volume-up";
-            else volIcon.className = "fas fa-bolt"; 
-        }
-        function toggleMute() {
-            if(video.muted) { video.muted = false; applyVolume(video.getAttribute('data-last-vol') || 1); } 
-            else { video.setAttribute('data-last-vol', volumeBar.value); video.muted = true; volumeBar.value = 0; volPercent.innerText = "0%"; updateVolIcon(0); }
-        }
-
-        // --- CONTROLS ---
-        video.addEventListener('loadedmetadata', () => { 
-            seekBar.max = video.duration; 
-            document.getElementById('totalTime').innerText = formatTime(video.duration);
-        });
-        video.addEventListener('timeupdate', () => { 
-            if (!seekBar.dragging) seekBar.value = video.currentTime; 
-            document.getElementById('currentTime').innerText = formatTime(video.currentTime);
-        });
-        
-        seekBar.onmousedown = () => seekBar.dragging = true;
-        seekBar.onmouseup = () => { video.currentTime = seekBar.value; seekBar.dragging = false; };
-        seekBar.oninput = (e) => { document.getElementById('currentTime').innerText = formatTime(e.target.value); };
-
-        function togglePlay() { 
-            if (video.paused) { video.play(); playIcon.className = "fas fa-pause"; showControls(); } 
-            else { video.pause(); playIcon.className = "fas fa-play"; clearTimeout(hideTimer); body.classList.remove('ui-hidden'); } 
-        }
-        function seekRelative(s) { video.currentTime += s; showControls(); }
-        function toggleFullScreen() { if (!document.fullscreenElement) document.documentElement.requestFullscreen(); else document.exitFullscreen(); }
-        function formatTime(s) { 
-            if(isNaN(s)) return "00:00";
-            let h = Math.floor(s / 3600); let m = Math.floor((s % 3600) / 60); let sc = Math.floor(s % 60); 
-            if (h > 0) return `${h}:${m.toString().padStart(2,'0')}:${sc.toString().padStart(2,'0')}`; 
-            return `${m}:${sc.toString().padStart(2,'0')}`; 
-        }
-        
-        function showControls() { body.classList.remove('ui-hidden'); clearTimeout(hideTimer); hideTimer = setTimeout(() => { if (!video.paused) body.classList.add('ui-hidden'); }, 3000); }
-        document.addEventListener('mousemove', showControls);
-        video.addEventListener('waiting', () => spinner.style.display = 'block');
-        video.addEventListener('playing', () => spinner.style.display = 'none');
-    </script>
+    <script src="{{ asset_url('simple.js') }}"></script>
 </body>
 </html>
 """
 
+SIMPLE_CSS = """
+/* Exact copy of Advanced CSS */
+body { background: #000; color: #fff; font-family: 'Segoe UI', sans-serif; margin: 0; display: flex; flex-direction: column; height: 100vh; overflow: hidden; }
+header { background: #1f1f1f; padding: 15px; display: flex; justify-content: space-between; align-items: center; border-bottom: 2px solid #00E676; position: fixed; top: 0; width: 100%; box-sizing: border-box; z-index: 20; transition: transform 0.5s ease-in-out; }
+.btn-file { background: #333; color: #fff; border: 1px solid #555; padding: 8px 15px; font-weight: bold; cursor: pointer; border-radius: 4px; text-decoration: none; }
+.video-container { position: absolute; top: 0; left: 0; width: 100%; height: 100%; background: #000; display: flex; justify-content: center; align-items: center; }
+video { width: 100%; height: 100%; object-fit: contain; }
+.controls { background: linear-gradient(to top, rgba(0,0,0,0.9) 0%, rgba(0,0,0,0.6) 60%, transparent 100%); padding: 20px 30px 30px 30px; display: flex; flex-direction: column; gap: 10px; position: fixed; bottom: 0; left: 0; width: 100%; box-sizing: border-box; z-index: 20; transition: opacity 0.5s ease-in-out; opacity: 1; }
+.ui-hidden header { transform: translateY(-100%); }
+.ui-hidden .controls { opacity: 0; pointer-events: none; }
+.ui-hidden { cursor: none; } 
+.seek-wrapper { display: flex; align-items: center; gap: 15px; margin-bottom: 5px; }
+input[type=range] { flex: 1; accent-color: #00E676; cursor: pointer; height: 6px; }
+.volume-wrapper { display: flex; align-items: center; gap: 8px; margin-left: 15px; background: rgba(255,255,255,0.1); padding: 5px 10px; border-radius: 20px; }
+.volume-wrapper i { width: 20px; text-align: center; font-size: 1.1rem; cursor: pointer; }
+#volumeBar { width: 80px; height: 4px; accent-color: #fff; }
+#volumeBar.boosted { accent-color: #ff3d00; }
+#volPercent { font-family: monospace; font-size: 0.8rem; min-width: 40px; text-align: center; }
+.buttons-row { display: flex; align-items: center; gap: 20px; }
+.btn-ctrl { background: none; border: none; color: white; font-size: 1.5rem; cursor: pointer; width: 35px; transition: color 0.2s; }
+.btn-ctrl:hover { color: #00E676; transform: scale(1.1); }
+.right-controls { margin-left: auto; display: flex; align-items: center; gap: 10px; }
+.select-group { display: flex; flex-direction: column; gap: 2px; }
+.select-group label { font-size: 0.7rem; color: #aaa; margin-left: 2px; }
+select { background: #333; color: white; border: 1px solid #555; padding: 5px; border-radius: 4px; cursor: pointer; max-width: 140px; font-size: 0.9rem;}
+.loading-overlay { position: absolute; top: 50%; left: 50%; transform: translate(-50%, -50%); z-index: 5; pointer-events: none; display: none; }
+.spinner { border: 8px solid rgba(255, 255, 255, 0.1); border-top: 8px solid #00E676; border-radius: 50%; width: 60px; height: 60px; animation: spin 1s linear infinite; }
+@keyframes spin { 0% { transform: rotate(0deg); } 100% { transform: rotate(360deg); } }
+.time-display { font-family: monospace; font-size: 14px; min-width: 100px; text-align: right; user-select: none; }
+"""
+
+SIMPLE_JS = """
+const video = document.getElementById('vid');
+const seekBar = document.getElementById('seekBar');
+const playIcon = document.getElementById('playIcon');
+const spinner = document.getElementById('loadingSpinner');
+const volumeBar = document.getElementById('volumeBar');
+const volIcon = document.getElementById('volIcon');
+const volPercent = document.getElementById('volPercent');
+const body = document.body;
+let hideTimer;
+
+// --- AUDIO BOOST (Client Side) ---
+let audioCtx, gainNode, source;
+function initAudioBoost() {
+    if(!audioCtx) {
+        const AudioContext = window.AudioContext || window.webkitAudioContext;
+        audioCtx = new AudioContext();
+        source = audioCtx.createMediaElementSource(video);
+        gainNode = audioCtx.createGain();
+        source.connect(gainNode);
+        gainNode.connect(audioCtx.destination);
+    }
+}
+volumeBar.addEventListener('input', (e) => { applyVolume(parseFloat(e.target.value)); });
+function applyVolume(val) {
+    if(!audioCtx && val > 1) initAudioBoost();
+    if (val <= 1) { video.volume = val; if(gainNode) gainNode.gain.value = 1; volumeBar.classList.remove('boosted'); } 
+    else { video.volume = 1; initAudioBoost(); gainNode.gain.value = val; volumeBar.classList.add('boosted'); }
+    volumeBar.value = val;
+    volPercent.innerText = Math.round(val * 100) + '%';
+    updateVolIcon(val);
+}
+function updateVolIcon(val) {
+    if(val == 0) volIcon.className = "fas fa-volume-mute";
+    else if(val < 0.5) volIcon.className = "fas fa-volume-down";
+    else if(val <= 1) volIcon.className = "fas fa-volume-up";
+    else volIcon.className = "fas fa-bolt"; 
+}
+function toggleMute() {
+    if(video.muted) { video.muted = false; applyVolume(video.getAttribute('data-last-vol') || 1); } 
+    else { video.setAttribute('data-last-vol', volumeBar.value); video.muted = true; volumeBar.value = 0; volPercent.innerText = "0%"; updateVolIcon(0); }
+}
+
+// --- CONTROLS ---
+video.addEventListener('loadedmetadata', () => { 
+    seekBar.max = video.duration; 
+    document.getElementById('totalTime').innerText = formatTime(video.duration);
+});
+video.addEventListener('timeupdate', () => { 
+    if (!seekBar.dragging) seekBar.value = video.currentTime; 
+    document.getElementById('currentTime').innerText = formatTime(video.currentTime);
+});
+
+seekBar.onmousedown = () => seekBar.dragging = true;
+seekBar.onmouseup = () => { video.currentTime = seekBar.value; seekBar.dragging = false; };
+seekBar.oninput = (e) => { document.getElementById('currentTime').innerText = formatTime(e.target.value); };
+
+function togglePlay() { 
+    if (video.paused) { video.play(); playIcon.className = "fas fa-pause"; showControls(); } 
+    else { video.pause(); playIcon.className = "fas fa-play"; clearTimeout(hideTimer); body.classList.remove('ui-hidden'); } 
+}
+function seekRelative(s) { video.currentTime += s; showControls(); }
+function toggleFullScreen() { if (!document.fullscreenElement) document.documentElement.requestFullscreen(); else document.exitFullscreen(); }
+function formatTime(s) { 
+    if(isNaN(s)) return "00:00";
+    let h = Math.floor(s / 3600); let m = Math.floor((s % 3600) / 60); let sc = Math.floor(s % 60); 
+    if (h > 0) return `${h}:${m.toString().padStart(2,'0')}:${sc.toString().padStart(2,'0')}`; 
+    return `${m}:${sc.toString().padStart(2,'0')}`; 
+}
+
+function showControls() { body.classList.remove('ui-hidden'); clearTimeout(hideTimer); hideTimer = setTimeout(() => { if (!video.paused) body.classList.add('ui-hidden'); }, 3000); }
+document.addEventListener('mousemove', showControls);
+video.addEventListener('waiting', () => spinner.style.display = 'block');
+video.addEventListener('playing', () => spinner.style.display = 'none');
+"""
+
+
+# 5. COMPILED TEMPLATES & STATIC ASSETS
+# Templates are compiled once at startup rather than parsed on every request. CSS and JS are
+# served under content-hashed names, so browsers may cache them forever and a change gets a new URL.
+TEMPLATES = {'landing.html': LANDING_TEMPLATE, 'selection.html': SELECTION_TEMPLATE,
+             'advanced.html': ADVANCED_TEMPLATE, 'simple.html': SIMPLE_TEMPLATE}
+STATIC_ASSETS = {'landing.css': LANDING_CSS, 'landing.js': LANDING_JS, 'selection.css': SELECTION_CSS,
+                 'advanced.css': ADVANCED_CSS, 'advanced.js': ADVANCED_JS, 'simple.css': SIMPLE_CSS, 'simple.js': SIMPLE_JS}
+hashed_assets = {}  # hashed name -> {'mimetype', 'etag', 'bodies': {content-coding: bytes}}
+asset_names = {}  # logical name -> hashed name
+
+def build_static_assets():
+    """Hashes and precompresses every asset once; requests are then served straight from memory."""
+    for name, source in STATIC_ASSETS.items():
+        body = source.encode('utf-8')
+        digest = hashlib.sha256(body).hexdigest()[:12]
+        stem, ext = os.path.splitext(name)
+        bodies = {'identity': body, 'gzip': gzip.compress(body, 9, mtime=0)}
+        if brotli: bodies['br'] = brotli.compress(body, quality=11)
+        hashed = f"{stem}.{digest}{ext}"
+        mimetype = 'text/css' if ext == '.css' else 'text/javascript'
+        hashed_assets[hashed] = {'mimetype': mimetype, 'etag': digest, 'bodies': {k: v for k, v in bodies.items() if len(v) < len(body) or k == 'identity'}}
+        asset_names[name] = hashed
+
+def asset_url(name):
+    return f"/assets/{asset_names[name]}"
+
+build_static_assets()
+app.jinja_env.loader = DictLoader(TEMPLATES)
+app.jinja_env.globals['asset_url'] = asset_url
+for template_name in TEMPLATES: app.jinja_env.get_template(template_name)
+
 # ==========================================
 # BACKEND LOGIC
 # ==========================================
 
-def get_media_info(filepath):
+def _startupinfo():
+    """Hides the console window of spawned FFmpeg tools on Windows."""
+    if os.name != 'nt': return None
+    startupinfo = subprocess.STARTUPINFO()
+    startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    return startupinfo
+
+# --- PROCESS SUPERVISOR ---
+# Every ffmpeg/ffprobe child is started through spawn() and tracked until it has been reaped. A
+# supervisor thread collects exited children (killing a process elsewhere is enough, no zombie is
+# left behind), kills children whose client has gone away, and enforces per-kind limits on
+# wall-clock time, CPU time and resident memory.
+SUPERVISOR_INTERVAL = 2
+PROCESS_LIMITS = {  # kind -> (wall seconds, CPU seconds, RSS MiB); None means unlimited
+    'probe': (300, 120, 1024),     # ffprobe, keyframe scans, version checks
+    'task': (3600, None, 2048),    # sprites, posters, subtitle extraction, trial encodes
+    'stream': (None, None, 2048),  # progressive streams and pre-rolls, as long as their viewer
+    'encode': (None, None, 4096),  # segment encoders; the HLS janitor stops idle ones
+}
+children = {}  # pid -> {'process', 'kind', 'started', 'alive'}
+children_lock = threading.Lock()
+child_counters = {'spawned': 0, 'reaped': 0, 'killed': {'client_gone': 0, 'wall': 0, 'cpu': 0, 'rss': 0}}
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+def spawn(cmd, kind, **kwargs):
+    """subprocess.Popen for a supervised child of the given kind (a PROCESS_LIMITS key)."""
+    kwargs.setdefault('startupinfo', _startupinfo())
+    process = subprocess.Popen(cmd, **kwargs)
+    with children_lock:
+        children[process.pid] = {'process': process, 'kind': kind, 'started': time.time(), 'alive': None}
+        child_counters['spawned'] += 1
+    return process
+
+def watch_client(process, alive):
+    """Ties a child to its client: once alive() returns False the supervisor kills it."""
+    with children_lock:
+        if process.pid in children: children[process.pid]['alive'] = alive
+
+def supervised_run(cmd, kind, timeout=None, check=False, **kwargs):
+    """subprocess.run for a supervised child."""
+    process = spawn(cmd, kind, **kwargs)
+    try:
+        stdout, stderr = process.communicate(timeout=timeout)
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    if check and process.returncode: raise subprocess.CalledProcessError(process.returncode, cmd, stdout, stderr)
+    return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+
+def supervised_output(cmd, kind, **kwargs):
+    """subprocess.check_output for a supervised child."""
+    return supervised_run(cmd, kind, check=True, stdout=subprocess.PIPE, **kwargs).stdout
+
+def child_usage(pid):
+    """(CPU seconds, RSS bytes) of a child from /proc, or None where that is not available."""
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as f: fields = f.read().rsplit(b')', 1)[1].split()
+        with open(f'/proc/{pid}/statm', 'rb') as f: pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS, pages * PAGE_SIZE
+
+def _supervise_once():
+    now = time.time()
+    with children_lock: tracked = list(children.items())
+    for pid, child in tracked:
+        process = child['process']
+        if process.poll() is not None:
+            with children_lock:
+                if children.pop(pid, None): child_counters['reaped'] += 1
+            continue
+        wall, cpu, rss = PROCESS_LIMITS.get(child['kind'], (None, None, None))
+        reason = None
+        try:
+            if child['alive'] and not child['alive']():
+                reason = 'client_gone'
+        except Exception:
+            reason = 'client_gone'
+        if reason is None and wall and now - child['started'] > wall: reason = 'wall'
+        usage = None if reason else child_usage(pid)
+        if usage and cpu and usage[0] > cpu: reason = 'cpu'
+        if usage and rss and usage[1] > rss * 1024 * 1024: reason = 'rss'
+        if reason:
+            logger.warning(f"Killing {child['kind']} process {pid} ({reason})")
+            try: process.kill()
+            except OSError: pass
+            with children_lock: child_counters['killed'][reason] += 1
+
+def _supervisor():
+    while True:
+        time.sleep(SUPERVISOR_INTERVAL)
+        try: _supervise_once()
+        except Exception as e: logger.error(f"Supervisor error: {e}")
+
+def supervisor_status():
+    with children_lock:
+        live = {}
+        for child in children.values():
+            if child['process'].poll() is None: live[child['kind']] = live.get(child['kind'], 0) + 1
+        return {'live': live, 'spawned': child_counters['spawned'], 'reaped': child_counters['reaped'],
+                'killed': dict(child_counters['killed'])}
+
+threading.Thread(target=_supervisor, daemon=True).start()
+
+# --- MEDIA METADATA CACHE ---
+# ffprobe results are keyed by file identity, so a replaced or modified file is re-probed
+PROBE_CACHE_SIZE = 256
+PROBE_SIDECAR = True  # Also persist probe results under CACHE_DIR/probe
+PROBE_VERSION = 3     # Bump when run_ffprobe asks for more fields, so older sidecars are not reused
+probe_cache = OrderedDict()  # abs path -> (fingerprint key, ffprobe data); a changed file replaces its own entry
+probe_cache_lock = threading.Lock()
+
+class KeyedLocks:
+    """One lock per key for work that must not run twice at once. An entry lives as long as some
+    thread holds or waits for it, so a caller arriving after a failure queues behind the retry."""
+    def __init__(self):
+        self.entries, self.lock = {}, threading.Lock()  # key -> [Lock, threads holding or waiting]
+
+    @contextlib.contextmanager
+    def hold(self, key):
+        with self.lock:
+            entry = self.entries.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]: yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]: del self.entries[key]
+
+probe_locks = KeyedLocks()  # Concurrent first requests for a file share one ffprobe run
+
+def file_fingerprint(filepath):
+    """Identity of a file on disk: (path, size, mtime, inode). A zip member takes the archive's mtime and inode."""
+    member = archive_member(filepath)
+    st = os.stat(member['archive'] if member else filepath)
+    size = member['size'] if member else st.st_size
+    partial = get_partial(filepath)
+    if partial: return (os.path.abspath(filepath), size, 'partial', partial['token'])  # mtime moves while downloading
+    return (os.path.abspath(filepath), size, st.st_mtime_ns, st.st_ino)
+
+def fingerprint_key(fingerprint):
+    """Stable short hash of a fingerprint, used for cache file names."""
+    return hashlib.sha1(repr(fingerprint).encode('utf-8')).hexdigest()
+
+def _probe_sidecar_path(path):
+    # Named by path, not fingerprint: every version of a file shares one sidecar, so a new probe replaces the old one
+    return os.path.join(CACHE_DIR, 'probe', f"{hashlib.sha1(path.encode('utf-8', 'surrogateescape')).hexdigest()}.json")
+
+def run_ffprobe(filepath):
     logger.info(f"Analyzing: {filepath}")
     cmd = [
         "ffprobe", "-v", "error", "-show_entries", "format=duration", 
-        "-show_entries", "stream=index,codec_type,codec_name,tags:stream_tags=language,title,handler_name",
-        "-of", "json", filepath
+        "-show_entries", "stream=index,codec_type,codec_name,pix_fmt,width,height,channels,tags:stream_tags=language,title,handler_name",
+        "-of", "json", media_input(filepath)
     ]
+    output = supervised_output(cmd, 'probe').decode("utf-8")
+    return json.loads(output)
+
+def write_json_atomic(path, data):
+    """Writes a cache file so concurrent readers never see it half-written."""
     try:
-        startupinfo = None
-        if os.name == 'nt': startupinfo = subprocess.STARTUPINFO(); startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-        output = subprocess.check_output(cmd, startupinfo=startupinfo).decode("utf-8")
-        data = json.loads(output)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(data, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Could not write cache file {path}: {e}")
+
+def _cached_probe(path, key):
+    with probe_cache_lock:
+        entry = probe_cache.get(path)
+        if entry is None or entry[0] != key: return None
+        probe_cache.move_to_end(path)
+        return entry[1]
+
+def probe_media(filepath):
+    """Returns the raw ffprobe data for a file, served from memory or the sidecar store when possible."""
+    fingerprint = file_fingerprint(filepath)
+    path, key = fingerprint[0], fingerprint_key(fingerprint + (PROBE_VERSION,))
+    data = _cached_probe(path, key)
+    if data is not None: return data
+
+    with probe_locks.hold(key):
+        data = _cached_probe(path, key)  # Probed by the thread we waited for
+        if data is not None: return data
+        sidecar = _probe_sidecar_path(path)
+        if PROBE_SIDECAR and os.path.exists(sidecar):
+            try:
+                with open(sidecar, 'r', encoding='utf-8') as f: stored = json.load(f)
+                if stored.get('key') == key: data = stored['data']
+            except (OSError, ValueError, AttributeError, KeyError) as e:
+                logger.warning(f"Ignoring unreadable probe sidecar {sidecar}: {e}")
+        if data is None:
+            data = run_ffprobe(filepath)
+            if PROBE_SIDECAR: write_json_atomic(sidecar, {'key': key, 'data': data})
+        with probe_cache_lock:
+            probe_cache[path] = (key, data)
+            probe_cache.move_to_end(path)
+            while len(probe_cache) > PROBE_CACHE_SIZE: probe_cache.popitem(last=False)
+    return data
+
+def forget_probe(path):
+    """Drops what is known about a file that is gone from disk."""
+    with probe_cache_lock: probe_cache.pop(path, None)
+    try: os.remove(_probe_sidecar_path(path))
+    except OSError: pass
+
+def get_media_info(filepath):
+    try:
+        data = probe_media(filepath)
         duration = float(data['format']['duration'])
         audio_tracks, sub_tracks = {}, {}
         has_video_h264 = False
@@ -581,63 +934,1439 @@ def get_media_info(filepath):
             if stream['codec_type'] == 'video' and codec == 'h264': has_video_h264 = True
             if title: label = f"{lang.upper()}: {title}"
             else: label = f"Track {idx} ({lang.upper()})"
-            if stream['codec_type'] == 'audio': audio_tracks[str(idx)] = {'label': label, 'codec': codec}
+            if stream['codec_type'] == 'audio': audio_tracks[str(idx)] = {'label': label, 'codec': codec, 'channels': stream.get('channels')}
             elif stream['codec_type'] == 'subtitle': sub_tracks[str(idx)] = label
         return audio_tracks, sub_tracks, duration, has_video_h264
     except Exception as e:
         logger.error(f"Metadata Error: {e}")
         return {}, {}, 0, False
 
+# --- SUBTITLE CUE CACHE ---
+# Each subtitle stream is converted to WebVTT once and kept as a sorted cue list (in memory and
+# under CACHE_DIR/subs). Seeks and sync nudges are answered by slicing and shifting that list.
+SUBTITLE_CACHE_SIZE = 32
+subtitle_cache = OrderedDict()   # key -> {'cues': [(start, end, settings, text)], 'reach': [running max of end]}
+subtitle_locks = KeyedLocks()    # A stream is only extracted once at a time, failed extractions included
+subtitle_cache_lock = threading.Lock()
+VTT_TIMING = re.compile(r'^((?:\d+:)?\d{2}:\d{2}\.\d{3})\s+-->\s+((?:\d+:)?\d{2}:\d{2}\.\d{3})(.*)$')
+
+def _vtt_seconds(stamp):
+    seconds = 0.0
+    for part in stamp.split(':'): seconds = seconds * 60 + float(part)
+    return seconds
+
+def _vtt_stamp(seconds):
+    ms = int(round(seconds * 1000))
+    return f"{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d}.{ms % 1000:03d}"
+
+def parse_webvtt(text):
+    """Cues of a WebVTT document as (start, end, settings, text), sorted by start time."""
+    cues = []
+    for block in re.split(r'\r?\n\r?\n', text.replace('\r\n', '\n')):
+        lines = block.strip('\n').split('\n')
+        for i, line in enumerate(lines):
+            m = VTT_TIMING.match(line.strip())
+            if m:
+                cues.append((_vtt_seconds(m.group(1)), _vtt_seconds(m.group(2)), m.group(3).strip(), '\n'.join(lines[i + 1:])))
+                break
+    cues.sort(key=lambda c: c[0])
+    return cues
+
+def extract_subtitle_cues(filepath, sub_index):
+    cmd = ['ffmpeg', '-i', media_input(filepath), '-map', f'0:{sub_index}', '-vn', '-an', '-f', 'webvtt', '-loglevel', 'error', 'pipe:1']
+    output = supervised_output(cmd, 'task', stderr=subprocess.DEVNULL)
+    return parse_webvtt(output.decode('utf-8', errors='replace'))
+
+def get_subtitle_cues(filepath, sub_index):
+    """Cue list of one subtitle stream, extracted on first use."""
+    # Named after the file's fingerprint key, so forget_media can find every stream of a file
+    key = f"{fingerprint_key(file_fingerprint(filepath))}-{int(sub_index)}"
+    with subtitle_cache_lock:
+        if key in subtitle_cache:
+            subtitle_cache.move_to_end(key)
+            return subtitle_cache[key]
+
+    with subtitle_locks.hold(key):
+        with subtitle_cache_lock:
+            if key in subtitle_cache: return subtitle_cache[key]
+        cues = None
+        store = os.path.join(CACHE_DIR, 'subs', f"{key}.json")
+        if os.path.exists(store):
+            try:
+                with open(store, 'r', encoding='utf-8') as f: cues = [tuple(c) for c in json.load(f)]
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring unreadable subtitle cache {store}: {e}")
+        if cues is None:
+            logger.info(f"Extracting subtitle stream {sub_index} of {filepath}")
+            cues = extract_subtitle_cues(filepath, sub_index)
+            write_json_atomic(store, cues)
+        reach, latest = [], 0.0
+        for cue in cues:
+            latest = max(latest, cue[1])
+            reach.append(latest)
+        entry = {'cues': cues, 'reach': reach}
+        with subtitle_cache_lock:
+            subtitle_cache[key] = entry
+            while len(subtitle_cache) > SUBTITLE_CACHE_SIZE: subtitle_cache.popitem(last=False)
+    return entry
+
+def render_subtitle_window(entry, start_time, offset):
+    """WebVTT for a stream that starts at start_time, with cues delayed by offset seconds.
+    A cue at T is shown at T - start_time + offset; cues already over are left out."""
+    origin = start_time - offset
+    first = bisect.bisect_right(entry['reach'], origin)  # Every cue before this one ended by origin
+    out = ['WEBVTT', '']
+    for start, end, settings, text in entry['cues'][first:]:
+        if end <= origin: continue
+        timing = f"{_vtt_stamp(max(0.0, start - origin))} --> {_vtt_stamp(end - origin)}"
+        out.extend([f"{timing} {settings}".rstrip(), text, ''])
+    return '\n'.join(out)
+
+# --- KEYFRAME INDEX ---
+# Stream copy can only start on a keyframe. Keyframe times of a file's first video stream are read
+# once from ffprobe packet flags (in the background) and cached, so copy-mode seeks can be snapped
+# to the exact point the stream will start from.
+KEYFRAME_CACHE_SIZE = 64
+keyframe_cache = OrderedDict()   # fingerprint key -> sorted keyframe times, relative to the file's start
+keyframe_builds = set()
+keyframe_lock = threading.Lock()
+
+def run_keyframe_probe(filepath):
+    cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags',
+           '-show_entries', 'format=start_time', '-of', 'csv=p=0', media_input(filepath)]
+    output = supervised_output(cmd, 'probe').decode('utf-8', errors='replace')
+    times, start = [], 0.0
+    for line in output.splitlines():
+        fields = line.strip().split(',')
+        if len(fields) >= 2:
+            if 'K' in fields[1] and fields[0] not in ('', 'N/A'): times.append(float(fields[0]))
+        elif fields[0] not in ('', 'N/A'):
+            start = float(fields[0])
+    # -ss counts from the container's start time, so store times the same way
+    return sorted(max(0.0, t - start) for t in times)
+
+def _build_keyframe_index(filepath, key):
+    store = os.path.join(CACHE_DIR, 'keyframes', f"{key}.json")
+    try:
+        times = None
+        if os.path.exists(store):
+            try:
+                with open(store, 'r', encoding='utf-8') as f: times = json.load(f)
+            except (OSError, ValueError): pass
+        if times is None:
+            started = time.time()
+            times = run_keyframe_probe(filepath)
+            logger.info(f"Indexed {len(times)} keyframes of {filepath} in {time.time() - started:.1f}s")
+            write_json_atomic(store, times)
+        with keyframe_lock:
+            keyframe_cache[key] = times
+            while len(keyframe_cache) > KEYFRAME_CACHE_SIZE: keyframe_cache.popitem(last=False)
+    except Exception as e:
+        logger.error(f"Keyframe index error: {e}")
+    finally:
+        with keyframe_lock: keyframe_builds.discard(key)
+
+def get_keyframes(filepath):
+    """Keyframe times of a file, or None while the index is being built (the build is started here).
+    Files that are still downloading are not indexed."""
+    if get_partial(filepath): return None
+    key = fingerprint_key(file_fingerprint(filepath))
+    with keyframe_lock:
+        if key in keyframe_cache:
+            keyframe_cache.move_to_end(key)
+            return keyframe_cache[key]
+        if key in keyframe_builds: return None
+        keyframe_builds.add(key)
+    threading.Thread(target=_build_keyframe_index, args=(filepath, key), daemon=True).start()
+    return None
+
+def load_keyframes(filepath):
+    """Blocking variant of get_keyframes for background work; None for files still downloading."""
+    if get_partial(filepath): return None
+    key = fingerprint_key(file_fingerprint(filepath))
+    with keyframe_lock:
+        if key in keyframe_cache: return keyframe_cache[key]
+        if key in keyframe_builds: return None
+        keyframe_builds.add(key)
+    _build_keyframe_index(filepath, key)
+    with keyframe_lock: return keyframe_cache.get(key)
+
+def snap_to_keyframe(filepath, seconds):
+    """The keyframe at or before seconds, or None if the index is not available yet."""
+    times = get_keyframes(filepath)
+    if not times: return None
+    return times[max(0, bisect.bisect_right(times, seconds) - 1)]
+
 def format_seconds(seconds):
     m, s = divmod(seconds, 60); h, m = divmod(m, 60)
     if h > 0: return f"{int(h)}:{int(m):02d}:{int(s):02d}"
     return f"{int(m)}:{int(s):02d}"
 
-def get_video_codec_flags(quality, is_h264_source):
-    if quality == 'original' and is_h264_source: return ['-c:v', 'copy']
-    mode = CURRENT_HW_MODE 
-    base = []
+def video_encoder_flags(mode):
+    """H.264 encoder arguments of a hardware mode; libx264 for 'cpu' or anything unknown."""
     if mode == 'nvenc': 
-        base = ['-c:v', 'h264_nvenc', '-pix_fmt', 'yuv420p', '-preset', 'p2', '-profile:v', 'high', '-b:v', '5M', '-bufsize', '10M']
+        return ['-c:v', 'h264_nvenc', '-pix_fmt', 'yuv420p', '-preset', 'p2', '-profile:v', 'high', '-b:v', '5M', '-bufsize', '10M']
     elif mode == 'qsv': 
-        base = ['-c:v', 'h264_qsv', '-preset', 'veryfast', '-pix_fmt', 'yuv420p']
+        return ['-c:v', 'h264_qsv', '-preset', 'veryfast', '-pix_fmt', 'yuv420p']
     elif mode == 'videotoolbox': 
-        base = ['-c:v', 'h264_videotoolbox', '-realtime', 'true', '-pix_fmt', 'yuv420p']
+        return ['-c:v', 'h264_videotoolbox', '-realtime', 'true', '-pix_fmt', 'yuv420p']
     elif mode == 'amf': 
-        base = ['-c:v', 'h264_amf', '-usage', 'lowlatency', '-pix_fmt', 'yuv420p']
-    else: 
-        base = ['-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '23', '-threads', '0', '-pix_fmt', 'yuv420p']
+        return ['-c:v', 'h264_amf', '-usage', 'lowlatency', '-pix_fmt', 'yuv420p']
+    return ['-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '23', '-threads', str(encoder_threads()), '-pix_fmt', 'yuv420p']
+
+def get_video_codec_flags(quality, is_h264_source, hw_mode=None):
+    if quality == 'original' and is_h264_source: return ['-c:v', 'copy']
+    base = video_encoder_flags(hw_mode or CURRENT_HW_MODE)
     if quality == '1080p': base.extend(['-vf', 'scale=-2:1080'])
     elif quality == '720p': base.extend(['-vf', 'scale=-2:720'])
     return base
 
-# ==========================================
-# ROUTES
-# ==========================================
+# --- THUMBNAIL SPRITES ---
+# Seek previews come from sprite sheets: small frames tiled into JPEGs plus a WebVTT map of which
+# tile covers which time span. They are built once per file in the background from keyframes
+# only (no full decode), so scrubbing is an image lookup instead of a trial seek.
+SPRITE_DIR = os.path.join(CACHE_DIR, 'sprites')
+SPRITE_WIDTH = 160
+SPRITE_COLUMNS, SPRITE_ROWS = 10, 10
+SPRITE_MIN_INTERVAL = 2
+SPRITE_MAX_TILES = 300
+sprite_builds = set()
+sprite_lock = threading.Lock()
+
+def sprite_interval(duration):
+    """Seconds per tile: every SPRITE_MIN_INTERVAL seconds, spread out so a file never needs more than SPRITE_MAX_TILES."""
+    return max(SPRITE_MIN_INTERVAL, math.ceil(duration / SPRITE_MAX_TILES))
+
+def build_sprite_vtt(key, duration, interval, tile_size):
+    """The WebVTT thumbnail map: one cue per tile, pointing into its sheet with a #xywh fragment."""
+    width, height = tile_size
+    lines, per_sheet, n = ['WEBVTT', ''], SPRITE_COLUMNS * SPRITE_ROWS, 0
+    while n * interval < duration:
+        sheet, cell = divmod(n, per_sheet)
+        x, y = cell % SPRITE_COLUMNS * width, cell // SPRITE_COLUMNS * height
+        lines += [f"{_vtt_stamp(n * interval)} --> {_vtt_stamp(min(duration, (n + 1) * interval))}",
+                  f"/sprites/{key}/sheet_{sheet + 1:03d}.jpg#xywh={x},{y},{width},{height}", '']
+        n += 1
+    return '\n'.join(lines)
+
+def build_sprites(filepath):
+    """Builds the sprite sheets of a file unless they exist. Returns the fingerprint key, or None."""
+    if get_partial(filepath): return None  # Seeking through it would stall on missing pieces
+    key = fingerprint_key(file_fingerprint(filepath))
+    target = os.path.join(SPRITE_DIR, key)
+    if os.path.exists(os.path.join(target, 'thumbnails.vtt')): return key
+    with sprite_lock:
+        if key in sprite_builds: return None
+        sprite_builds.add(key)
+    work_dir = f"{target}.{threading.get_ident()}.tmp"
+    try:
+        _, _, duration, _ = get_media_info(filepath)
+        size = source_video_size(filepath)
+        if not duration or not size: return None
+        interval = sprite_interval(duration)
+        tile_size = (SPRITE_WIDTH, max(2, round(SPRITE_WIDTH * size[1] / size[0] / 2) * 2))
+        os.makedirs(work_dir, exist_ok=True)
+        started = time.time()
+        cmd = ['ffmpeg', '-v', 'error', '-skip_frame', 'nokey', '-threads', str(encoder_threads()), '-i', media_input(filepath), '-map', '0:v:0', '-an', '-sn',
+               '-vf', f"fps=1/{interval},scale={tile_size[0]}:{tile_size[1]},tile={SPRITE_COLUMNS}x{SPRITE_ROWS}",
+               '-threads', str(encoder_threads()), '-q:v', '6', os.path.join(work_dir, 'sheet_%03d.jpg')]
+        supervised_run(cmd, 'task', stdout=subprocess.DEVNULL, stderr=sys.stderr, check=True)
+        with open(os.path.join(work_dir, 'thumbnails.vtt'), 'w', encoding='utf-8') as f:
+            f.write(build_sprite_vtt(key, duration, interval, tile_size))
+        os.replace(work_dir, target)
+        logger.info(f"Built seek previews for {filepath} in {time.time() - started:.1f}s")
+        return key
+    except Exception as e:
+        logger.error(f"Sprite build error for {filepath}: {e}")
+        return None
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        with sprite_lock: sprite_builds.discard(key)
+
+def get_sprites(filepath):
+    """Fingerprint key of a file's finished sprite sheets, or None while they are built (the build is started here)."""
+    if get_partial(filepath): return None
+    key = fingerprint_key(file_fingerprint(filepath))
+    if os.path.exists(os.path.join(SPRITE_DIR, key, 'thumbnails.vtt')): return key
+    with sprite_lock:
+        if key in sprite_builds: return None
+    threading.Thread(target=build_sprites, args=(filepath,), daemon=True).start()
+    return None
+
+# --- HARDWARE DETECTION ---
+# Runs in the background so the server takes requests right away; until it finishes every session
+# uses the CPU. Results are stored per ffmpeg build, so later starts skip the trial encodes.
+HW_CANDIDATES = [('nvenc', 'h264_nvenc', 'NVIDIA (NVENC)'), ('qsv', 'h264_qsv', 'Intel (QuickSync)'),
+                 ('videotoolbox', 'h264_videotoolbox', 'Mac (VideoToolbox)'), ('amf', 'h264_amf', 'AMD (AMF)')]
+HW_CAPS_DIR = os.path.join(CACHE_DIR, 'hwcaps')
+HW_TRIAL_TIMEOUT = 20
+AVAILABLE_HW_MODES = {'cpu': 'CPU (Software)'}
+CURRENT_HW_MODE = 'cpu'
+hw_detection_done = threading.Event()
+
+def ffmpeg_identity():
+    """Version line and SHA-256 of the ffmpeg binary on PATH, or None if there is none."""
+    binary = shutil.which('ffmpeg')
+    if not binary: return None
+    output = supervised_output(['ffmpeg', '-version'], 'probe')
+    digest = hashlib.sha256()
+    with open(os.path.realpath(binary), 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''): digest.update(block)
+    return output.decode('utf-8', 'replace').splitlines()[0], digest.hexdigest()
+
+def trial_encode(encoder):
+    """Encodes a few frames of a test pattern. Listing an encoder says nothing about the device or
+    driver behind it; only a real encode does."""
+    cmd = ['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', 'testsrc2=size=320x240:rate=25:duration=0.2', '-c:v', encoder, '-f', 'null', '-']
+    try:
+        return supervised_run(cmd, 'task', stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=HW_TRIAL_TIMEOUT).returncode == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
 
-@app.route('/')
-def index():
-    return render_template_string(LANDING_TEMPLATE)
+def detect_hardware_encoders():
+    """Finds the GPU encoders that actually work and makes the best one the default."""
+    global AVAILABLE_HW_MODES, CURRENT_HW_MODE
+    try:
+        identity = ffmpeg_identity()
+        if identity is None: raise OSError("ffmpeg not found on PATH")
+        caps_path = os.path.join(HW_CAPS_DIR, hashlib.sha1('\n'.join(identity).encode('utf-8')).hexdigest() + '.json')
+        try:
+            with open(caps_path, 'r', encoding='utf-8') as f: working = json.load(f)['modes']
+            logger.info(f"Hardware capabilities loaded for {identity[0]}")
+        except (OSError, ValueError, KeyError):
+            logger.info("Scanning for Hardware Acceleration...")
+            working = [mode for mode, encoder, _ in HW_CANDIDATES if trial_encode(encoder)]
+            write_json_atomic(caps_path, {'ffmpeg': identity[0], 'sha256': identity[1], 'modes': working})
+        modes = {'cpu': 'CPU (Software)'}
+        modes.update((mode, label) for mode, _, label in HW_CANDIDATES if mode in working)
+        # Rebound, not mutated: request threads may be iterating over the old dict
+        AVAILABLE_HW_MODES = modes
+        CURRENT_HW_MODE = next((mode for mode in modes if mode != 'cpu'), 'cpu')
+    except Exception as e:
+        logger.warning(f"Could not detect encoders: {e}")
+    finally:
+        hw_detection_done.set()
+    logger.info(f"Defaulting to: {CURRENT_HW_MODE}")
 
-@app.route('/progress')
-def progress_check():
-    """Endpoint for polling download status."""
-    return jsonify(download_state)
+threading.Thread(target=detect_hardware_encoders, daemon=True).start()
+
+# --- HARDWARE PIPELINES ---
+# A hardware mode can do more than encode: decode and scale can stay on the device too, so frames
+# never cross the bus. Each mode falls back along a chain when a level fails (unsupported source
+# codec, 10-bit input, missing driver): full device pipeline -> hardware encode only -> software.
+HW_PIPELINES = {
+    'nvenc': {'decode': ['-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda'], 'scale': 'scale_cuda=-2:{height}'},
+    'qsv': {'decode': ['-hwaccel', 'qsv', '-hwaccel_output_format', 'qsv'], 'scale': 'scale_qsv=w=-1:h={height}'},
+    # Decoded frames come back to system memory, scaling stays on the CPU
+    'videotoolbox': {'decode': ['-hwaccel', 'videotoolbox'], 'scale': None},
+    'amf': {'decode': ['-hwaccel', 'd3d11va'], 'scale': None},
+}
+# A level fails for a kind of source (a codec or bit depth the device cannot decode), so demotions
+# are kept per (hw mode, source codec, source pixel format): other files keep the full pipeline
+pipeline_demotions = {}  # (hw mode, codec, pix_fmt) -> index into the mode's fallback chain
 
-@app.route('/process_url', methods=['POST'])
-def process_url():
-    global download_state
-    url = request.form.get('url')
-    if not url: return jsonify({'status': 'error', 'message': 'Missing URL'})
-    
-    # Reset State
-    download_state = {'progress': 0, 'status': 'Downloading', 'msg': 'Connecting...', 'filename': ''}
-    
-    # Clean previous downloads
-    if os.path.exists(DOWNLOAD_DIR): shutil.rmtree(DOWNLOAD_DIR)
-    os.makedirs(DOWNLOAD_DIR)
+def source_profile(filepath):
+    """(codec, pix_fmt) of the first video stream, the source traits a pipeline level depends on."""
+    try:
+        for stream in probe_media(filepath).get('streams', []):
+            if stream['codec_type'] == 'video': return stream.get('codec_name'), stream.get('pix_fmt')
+    except Exception as e:
+        logger.warning(f"No source profile for {filepath}: {e}")
+    return None, None
+
+def pipeline_chain(hw_mode):
+    """Pipeline levels to try for a hardware mode, best first."""
+    if hw_mode == 'cpu' or hw_mode not in AVAILABLE_HW_MODES: return ['software']
+    return (['full'] if hw_mode in HW_PIPELINES else []) + ['encode', 'software']
+
+def current_pipeline_level(hw_mode, source=(None, None)):
+    chain = pipeline_chain(hw_mode)
+    return chain[min(pipeline_demotions.get((hw_mode,) + tuple(source), 0), len(chain) - 1)]
+
+def demote_pipeline(hw_mode, level, source=(None, None)):
+    """Moves a mode past a level that failed for sources like this one. False if there is nothing left to fall back to."""
+    chain = pipeline_chain(hw_mode)
+    if level not in chain or chain.index(level) + 1 >= len(chain): return False
+    key = (hw_mode,) + tuple(source)
+    if pipeline_demotions.get(key, 0) <= chain.index(level):
+        pipeline_demotions[key] = chain.index(level) + 1
+        logger.warning(f"{hw_mode} pipeline level '{level}' failed for {source[0]}/{source[1]}, falling back to '{chain[chain.index(level) + 1]}'")
+    return True
+
+def build_video_pipeline(hw_mode, level, heights):
+    """Decode, scale and encode arguments for the first video stream, one output per entry of
+    heights (None keeps the source size). Returns (input_args, filter_graph, encoder_args); the
+    graph labels its outputs [v0], [v1], ... Pure, so every level can be checked on any machine."""
+    profile = HW_PIPELINES.get(hw_mode) if level == 'full' else None
+    input_args = (list(profile['decode']) if profile else []) + ['-threads', str(encoder_threads())]  # Decoder threads
+    on_device = '-hwaccel_output_format' in input_args
+    scale = profile['scale'] if on_device else 'scale=-2:{height}'
+    if len(heights) == 1: branches, graph = ['[0:v:0]'], ''
+    else:
+        branches = [f'[s{i}]' for i in range(len(heights))]
+        graph = f"[0:v:0]split={len(heights)}{''.join(branches)};"
+    graph += ';'.join(f"{branch}{scale.format(height=h) if h else 'null'}[v{i}]" for i, (branch, h) in enumerate(zip(branches, heights)))
+    encoder_args = video_encoder_flags('cpu' if level == 'software' else hw_mode)
+    if on_device and '-pix_fmt' in encoder_args:
+        # Frames are already in the device's format; a pix_fmt would force a download
+        i = encoder_args.index('-pix_fmt')
+        del encoder_args[i:i + 2]
+    return input_args, graph, encoder_args
+
+# What ffmpeg says when the device, its driver or a device filter is the problem. Anything else (a
+# read timeout on a file still downloading, a corrupt source) fails the same way at every level.
+HW_FAILURE_PATTERN = re.compile(r'hwaccel|hwupload|hwdownload|hw_?frames|hw_?device|device (?:creation|setup)|no device|'
+                                r'cuda|cuvid|nvenc|nvdec|qsv|mfx|vaapi|videotoolbox|d3d11|dxva|amf|scale_cuda|scale_qsv|'
+                                r'error (?:initializing|reinitializing|configuring)(?: the)? filter|impossible to convert between the formats|'
+                                r'failed to (?:inject frame into|configure output pad on) filter|function not implemented', re.I)
+
+def hardware_failure(stderr_text):
+    """True if an encoder's stderr blames the hardware pipeline rather than the source."""
+    return bool(HW_FAILURE_PATTERN.search(stderr_text))
+
+# Audio every browser plays inside MP4 and MPEG-TS; anything else (AC-3, DTS, Opus, FLAC,
+# surround layouts) is encoded to stereo AAC
+BROWSER_AUDIO_CODECS = ('aac', 'mp3')
+BROWSER_AUDIO_MAX_CHANNELS = 2
+
+def get_audio_codec_flags(track):
+    """Stream copy for a browser-compatible track (see get_media_info), stereo AAC otherwise."""
+    if track and track.get('codec') in BROWSER_AUDIO_CODECS and (track.get('channels') or 99) <= BROWSER_AUDIO_MAX_CHANNELS:
+        return ['-c:a', 'copy']
+    return ['-c:a', 'aac', '-ac', '2', '-b:a', '192k']
+
+# --- STREAM SESSIONS ---
+# Each viewer (browser cookie) gets its own selected file, encoder process, hardware mode and quality
+SESSION_COOKIE = 'wp_session'
+SESSION_IDLE_TIMEOUT = int(os.environ.get('SESSION_IDLE_TIMEOUT', '900'))
+TRANSCODE_CORES = int(os.environ.get('TRANSCODE_CORES', str(os.cpu_count() or 1)))
+# Four slots, but never more than there are cores to share: a slot must get at least one core
+MAX_CONCURRENT_TRANSCODES = int(os.environ.get('MAX_CONCURRENT_TRANSCODES', str(max(1, min(4, TRANSCODE_CORES)))))
+stream_sessions = {}   # session id -> {'file', 'process', 'job', 'preroll', 'warming', 'hw', 'quality', 'last_seen'}
+session_lock = threading.Lock()
+
+def get_stream_session():
+    """Returns the stream session of the current request, creating it (and its cookie) on first use.
+    Routes that never call this, such as the shared-cacheable assets and media, never set a cookie."""
+    if g.session_id is None:
+        g.session_id, g.new_session = uuid.uuid4().hex, True
+    session_id = g.session_id
+    with session_lock:
+        session = stream_sessions.get(session_id)
+        if session is None:
+            session = {'file': None, 'process': None, 'job': None, 'preroll': None, 'warming': [], 'hw': CURRENT_HW_MODE, 'quality': 'original', 'last_seen': time.time()}
+            stream_sessions[session_id] = session
+        session['last_seen'] = time.time()
+        return session
+
+def stop_session_process(session):
+    process = session.get('process')
+    if process and process.poll() is None:
+        try: process.kill()
+        except OSError: pass
+    session['process'] = None
+    release_transcode(session.get('job'))
+    session['job'] = None
+
+def _session_reaper():
+    """Stops the encoders of idle sessions and forgets them, and drops unclaimed pre-rolls."""
+    while True:
+        time.sleep(5)
+        cutoff = time.time() - SESSION_IDLE_TIMEOUT
+        with session_lock:
+            for session_id, session in list(stream_sessions.items()):
+                if session['preroll'] and time.time() - session['preroll']['started'] > PREROLL_TTL: discard_preroll(session)
+                if session['last_seen'] < cutoff:
+                    logger.info(f"Closing idle session {session_id[:8]}")
+                    stop_session_process(session)
+                    discard_warm_segments(session)
+                    del stream_sessions[session_id]
+
+threading.Thread(target=_session_reaper, daemon=True).start()
+
+# --- TRANSCODE SCHEDULER ---
+# Encoders are admitted against a fixed number of slots that share the CPU budget. Requests
+# over the limit wait briefly in a queue and are then degraded (720p, or stream copy when the
+# source allows it) instead of oversubscribing every core.
+TRANSCODE_QUEUE_MAX = int(os.environ.get('TRANSCODE_QUEUE_MAX', '8'))
+TRANSCODE_QUEUE_TIMEOUT = 10
+transcode_jobs = {}    # owner -> job dict; an owner (session or HLS variant) holds at most one slot
+scheduler_state = {'queued': 0, 'admitted': 0, 'degraded': 0, 'rejected': 0}
+scheduler_cond = threading.Condition()
+
+def encoder_threads():
+    """Threads handed to each encoder, and to its decoder, so that all slots together fit the core budget."""
+    return max(1, TRANSCODE_CORES // MAX_CONCURRENT_TRANSCODES)
+
+def admit_transcode(owner, wait=True):
+    """Claims an encoder slot for owner. Returns (job, waited) or (None, waited) when no slot is free."""
+    with scheduler_cond:
+        # A session replacing its own stream (seek, quality change) reuses its slot
+        transcode_jobs.pop(owner, None)
+        scheduler_cond.notify_all()
+        waited = False
+        if len(transcode_jobs) >= MAX_CONCURRENT_TRANSCODES:
+            if not wait or scheduler_state['queued'] >= TRANSCODE_QUEUE_MAX:
+                scheduler_state['rejected'] += 1
+                return None, waited
+            waited = True
+            scheduler_state['queued'] += 1
+            try:
+                scheduler_cond.wait_for(lambda: len(transcode_jobs) < MAX_CONCURRENT_TRANSCODES, TRANSCODE_QUEUE_TIMEOUT)
+            finally:
+                scheduler_state['queued'] -= 1
+            if len(transcode_jobs) >= MAX_CONCURRENT_TRANSCODES:
+                scheduler_state['rejected'] += 1
+                return None, waited
+        job = {'owner': owner, 'started': time.time()}
+        transcode_jobs[owner] = job
+        scheduler_state['admitted'] += 1
+        return job, waited
+
+def release_transcode(job):
+    if job is None: return
+    with scheduler_cond:
+        if transcode_jobs.get(job['owner']) is job:
+            del transcode_jobs[job['owner']]
+            scheduler_cond.notify_all()
+
+def transfer_transcode(job, owner):
+    """Hands a held slot to another owner (a session passing its slot to a shared encoder)."""
+    with scheduler_cond:
+        if transcode_jobs.get(job['owner']) is not job: return None
+        del transcode_jobs[job['owner']]
+        transcode_jobs.pop(owner, None)
+        # A new job object, so releasing the old one later is a no-op
+        new_job = {'owner': owner, 'started': job['started']}
+        transcode_jobs[owner] = new_job
+        scheduler_cond.notify_all()
+        return new_job
+
+def schedule_stream(owner, quality, is_h264_source):
+    """Admission policy for one progressive stream. Returns (job, quality to use);
+    job is None for stream copy, quality is None if the request must be rejected."""
+    if quality == 'original' and is_h264_source: return None, quality  # Stream copy needs no encoder slot
+    job, waited = admit_transcode(owner)
+    degraded_quality = quality
+    if job is None:
+        if not is_h264_source: return None, None
+        degraded_quality = 'original'
+    elif waited and quality != '720p':
+        degraded_quality = '720p'
+    if degraded_quality != quality:
+        logger.info(f"Scheduler degraded stream {quality} -> {degraded_quality}")
+        with scheduler_cond: scheduler_state['degraded'] += 1
+    return job, degraded_quality
+
+def scheduler_status():
+    with scheduler_cond:
+        return {'active': len(transcode_jobs), 'slots': MAX_CONCURRENT_TRANSCODES, 'queue_depth': scheduler_state['queued'],
+                'queue_max': TRANSCODE_QUEUE_MAX, 'cores': TRANSCODE_CORES, 'threads_per_job': encoder_threads(),
+                'admitted': scheduler_state['admitted'], 'degraded': scheduler_state['degraded'], 'rejected': scheduler_state['rejected']}
+
+# --- SEGMENTED (HLS) STREAMING ---
+# Segments are encoded lazily around the playhead and kept on disk, so seeking back
+# into an encoded range is free and seeking forward restarts at a segment boundary.
+# The segment store is also the transcode cache for progressive streams: it is keyed by file
+# fingerprint, audio track, quality and encoder. Each running encoder covers one position window
+# of a variant; viewers in the same window share it, viewers far apart get windows of their own.
+SEGMENT_DURATION = 6        # Seconds per HLS segment
+SEGMENT_LOOKAHEAD = 4       # Wait for a running encoder if it is at most this many segments behind
+SEGMENT_MAX_AHEAD = 20      # Stop an encoder that runs this far past the last requested segment
+SEGMENT_IDLE_TIMEOUT = 3 * SEGMENT_DURATION  # Stop one that is ahead of its viewers and has not been asked for a segment this long
+SEGMENT_WINDOWS = 3         # Encoders per variant before an idle window is moved instead of adding one
+SEGMENT_WAIT_TIMEOUT = 60
+SEGMENT_CACHE_BUDGET = int(os.environ.get('TRANSCODE_CACHE_MB', '10240')) * 1024 * 1024  # Segments and sprite sheets together
+HLS_DIR = os.path.join(CACHE_DIR, 'hls')
+hls_variants = {}   # variant id -> {'path', 'audio_index', 'quality', 'hw', 'dir', 'renditions', 'source', 'sessions'}
+hls_encoders = {}   # (variant id, start segment) -> {'process', 'start', 'end', 'last_requested', 'touched', 'job', 'level', 'waiters'}
+cache_last_used = {}  # segment or sprite folder path -> time it was last served; unserved ones count from their mtime
+hls_lock = threading.RLock()
+
+# The 'auto' quality is a bitrate ladder: one FFmpeg decodes once, splits and scales the picture
+# and encodes every rung with the same forced keyframes, so players can switch at any segment.
+ABR_LADDER = [('1080p', 1080, 5000), ('720p', 720, 2800), ('480p', 480, 1200), ('360p', 360, 700)]  # name, height, max kbit/s
+HLS_AUDIO_KBPS = 192
+HLS_VIDEO_KBPS = 5000  # Advertised for single-quality variants, which are encoded at constant quality
+
+def source_video_size(filepath):
+    """(width, height) of the first video stream, or None if unknown."""
+    try:
+        for stream in probe_media(filepath).get('streams', []):
+            if stream['codec_type'] == 'video' and stream.get('height'): return stream['width'], stream['height']
+    except Exception as e:
+        logger.warning(f"No video size for {filepath}: {e}")
+    return None
+
+def abr_renditions(filepath):
+    """Rungs of the ladder that do not upscale the source; a source below the ladder gets one rung of its own size."""
+    size = source_video_size(filepath)
+    rungs = [r for r in ABR_LADDER if size is None or r[1] <= size[1]] or [(f'{size[1]}p', size[1], ABR_LADDER[-1][2])]
+    renditions = []
+    for name, height, kbps in rungs:
+        width = int(round(size[0] * height / size[1] / 2)) * 2 if size else None
+        renditions.append({'name': name, 'height': height, 'width': width, 'kbps': kbps})
+    return renditions
+
+def get_hls_variant(filepath, audio_index, quality, hw_mode):
+    """Registers (or looks up) the segment store for one file/audio/quality/encoder combination."""
+    variant_id = fingerprint_key((file_fingerprint(filepath), audio_index, quality, hw_mode))
+    with hls_lock:
+        if variant_id not in hls_variants:
+            variant_dir = os.path.abspath(os.path.join(HLS_DIR, variant_id))
+            renditions = abr_renditions(filepath) if quality == 'auto' else None
+            for rendition in renditions or [{'name': ''}]: os.makedirs(os.path.join(variant_dir, rendition['name']), exist_ok=True)
+            hls_variants[variant_id] = {'path': filepath, 'audio_index': audio_index, 'quality': quality, 'hw': hw_mode,
+                                        'dir': variant_dir, 'renditions': renditions, 'source': source_profile(filepath), 'sessions': set()}
+    return variant_id
+
+def touch_variant_sessions(variant_id):
+    """Keeps the sessions playing a variant alive, since its playlists and segments never go through
+    get_stream_session: the requesting session if it opened the variant, else every session that did."""
+    variant = hls_variants.get(variant_id)
+    if not variant: return
+    with session_lock:
+        variant['sessions'].intersection_update(stream_sessions)  # Forget sessions that were closed
+        for session_id in [g.session_id] if g.session_id in variant['sessions'] else list(variant['sessions']):
+            stream_sessions[session_id]['last_seen'] = time.time()
+
+def build_hls_playlist(variant_id, duration, rendition=None):
+    """VOD playlist covering the whole file; segments are produced when requested."""
+    count = max(1, int(-(-duration // SEGMENT_DURATION)))
+    prefix = f'/hls/{variant_id}/{rendition}' if rendition else f'/hls/{variant_id}'
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', f'#EXT-X-TARGETDURATION:{SEGMENT_DURATION}',
+             '#EXT-X-MEDIA-SEQUENCE:0', '#EXT-X-PLAYLIST-TYPE:VOD']
+    for n in range(count):
+        seg_len = min(SEGMENT_DURATION, duration - n * SEGMENT_DURATION) if duration else SEGMENT_DURATION
+        lines.append(f'#EXTINF:{seg_len:.6f},')
+        lines.append(f'{prefix}/{n}.ts')
+    lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
+
+def build_master_playlist(variant_id, audio_variants, default_audio):
+    """Master playlist for a video-only variant (every rung, for 'auto') plus one alternate
+    audio rendition per audio track ({stream index: variant id}), so players switch language
+    without touching the video."""
+    variant = hls_variants[variant_id]
+    audio_tracks, _, _, _ = get_media_info(variant['path'])
+    lines = ['#EXTM3U', '#EXT-X-VERSION:4', '#EXT-X-INDEPENDENT-SEGMENTS']
+    for index, audio_variant_id in audio_variants.items():
+        name = audio_tracks[index]['label'].replace('"', "'")
+        default = 'YES' if index == default_audio else 'NO'
+        lines.append(f'#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="audio",NAME="{name}",DEFAULT={default},AUTOSELECT={default},'
+                     f'URI="/hls/{audio_variant_id}/index.m3u8"')
+    audio_group = ',AUDIO="audio"' if audio_variants else ''
+    audio_kbps = HLS_AUDIO_KBPS if audio_variants else 0
+    for rendition in variant['renditions'] or [{'name': None, 'width': None, 'kbps': HLS_VIDEO_KBPS}]:
+        attrs = f"BANDWIDTH={(rendition['kbps'] + audio_kbps) * 1000}"
+        if rendition['width']: attrs += f",RESOLUTION={rendition['width']}x{rendition['height']}"
+        lines.append(f'#EXT-X-STREAM-INF:{attrs}{audio_group}')
+        lines.append(f"/hls/{variant_id}/{rendition['name']}/index.m3u8" if rendition['name'] else f"/hls/{variant_id}/index.m3u8")
+    return '\n'.join(lines) + '\n'
+
+def _segment_path(variant, n, rendition=None):
+    return os.path.join(variant['dir'], rendition or '', f'{n}.ts')
+
+def _reference_rendition(variant):
+    # Every rung is cut at the same time, so the last one is as good as any
+    return variant['renditions'][-1]['name'] if variant['renditions'] else None
+
+def _encoder_log_path(variant, n):
+    return os.path.join(variant['dir'], f'encoder-{n}.log')
+
+def _encoder_errors(variant, encoder):
+    """The end of what an encoder wrote to stderr, without the source path (a file name can contain anything)."""
+    try:
+        with open(_encoder_log_path(variant, encoder['start']), 'rb') as f: text = f.read()[-8192:].decode('utf-8', 'replace')
+    except OSError:
+        return ''
+    return text.replace(media_input(variant['path']), '').replace(variant['path'], '')
+
+def _encoded_upto(variant, encoder):
+    """Highest segment the encoder has finished, counting from where it started."""
+    rendition = _reference_rendition(variant)
+    n = encoder['start']
+    while (encoder['end'] is None or n < encoder['end']) and os.path.exists(_segment_path(variant, n, rendition)): n += 1
+    return n - 1
+
+def _window_end(variant, n):
+    """First segment after n that is already cached, where an encoder starting at n should stop;
+    None if nothing past n is cached."""
+    try: names = os.listdir(os.path.join(variant['dir'], _reference_rendition(variant) or ''))
+    except OSError: return None
+    return min((int(name[:-3]) for name in names if name.endswith('.ts') and name[:-3].isdigit() and int(name[:-3]) > n), default=None)
+
+def _start_segment_encoder(variant, n, level, end=None):
+    audio_tracks, _, _, _ = get_media_info(variant['path'])
+    has_audio = bool(audio_tracks) and variant['audio_index'] in audio_tracks
+    start = n * SEGMENT_DURATION
+    renditions = variant['renditions']
+    # Stop where an earlier run left cached segments instead of encoding them again
+    limit = ['-t', str((end - n) * SEGMENT_DURATION)] if end is not None else []
+    # Absolute timestamps, so segments of every encoder (and every rendition) line up
+    hls_output = ['-output_ts_offset', str(start), '-f', 'hls', '-hls_time', str(SEGMENT_DURATION), '-hls_list_size', '0',
+                  '-hls_segment_type', 'mpegts', '-hls_flags', 'temp_file', '-start_number', str(n), '-loglevel', 'warning']
+    if variant['quality'] == 'audio':
+        # Alternate audio rendition: audio only, cut at the same boundaries as the video
+        cmd = ['ffmpeg', '-ss', str(start)] + limit + ['-i', media_input(variant['path'])]
+        cmd.extend(['-map', f"0:{variant['audio_index']}", '-vn'] + get_audio_codec_flags(audio_tracks.get(variant['audio_index'])))
+        outputs = ['-hls_segment_filename', os.path.join(variant['dir'], '%d.ts'), os.path.join(variant['dir'], 'encoder.m3u8')]
+        logger.info(f"Segment encoder starting at segment {n} ({start}s)")
+        with open(_encoder_log_path(variant, n), 'wb') as log:
+            return spawn(cmd + hls_output + outputs, 'encode', stdout=subprocess.DEVNULL, stderr=log)
+
+    # Segments must start on a keyframe at exact boundaries, so video is always encoded here
+    heights = [r['height'] for r in renditions] if renditions else [{'1080p': 1080, '720p': 720}.get(variant['quality'])]
+    input_args, graph, encoder_args = build_video_pipeline(variant['hw'], level, heights)
+    cmd = ['ffmpeg'] + input_args + ['-ss', str(start)] + limit + ['-i', media_input(variant['path']), '-filter_complex', graph]
+    if renditions:
+        for i in range(len(renditions)):
+            cmd.extend(['-map', f'[v{i}]'])
+            if has_audio: cmd.extend(['-map', f"0:{variant['audio_index']}"])
+        if has_audio: cmd.extend(get_audio_codec_flags(audio_tracks[variant['audio_index']]))
+        cmd.extend(encoder_args)
+        for i, r in enumerate(renditions):
+            # Capped quality: the cap is what the master playlist advertises as BANDWIDTH
+            cmd.extend([f'-b:v:{i}', f"{r['kbps']}k", f'-maxrate:v:{i}', f"{r['kbps']}k", f'-bufsize:v:{i}', f"{r['kbps'] * 2}k"])
+        stream_map = ' '.join(f"v:{i},a:{i},name:{r['name']}" if has_audio else f"v:{i},name:{r['name']}" for i, r in enumerate(renditions))
+        outputs = ['-var_stream_map', stream_map, '-hls_segment_filename', os.path.join(variant['dir'], '%v', '%d.ts'),
+                   os.path.join(variant['dir'], '%v', 'encoder.m3u8')]
+    else:
+        cmd.extend(['-map', '[v0]'])
+        if has_audio: cmd.extend(['-map', f"0:{variant['audio_index']}"] + get_audio_codec_flags(audio_tracks[variant['audio_index']]))
+        cmd.extend(encoder_args)
+        outputs = ['-hls_segment_filename', os.path.join(variant['dir'], '%d.ts'), os.path.join(variant['dir'], 'encoder.m3u8')]
+    cmd.extend(['-force_key_frames', f'expr:gte(t,n_forced*{SEGMENT_DURATION})'] + hls_output + outputs)
+    logger.info(f"Segment encoder starting at segment {n} ({start}s, {level} pipeline)")
+    # stderr goes to a log in the variant, so a failure can be told apart from a device problem
+    with open(_encoder_log_path(variant, n), 'wb') as log:
+        return spawn(cmd, 'encode', stdout=subprocess.DEVNULL, stderr=log)
+
+def _encoder_covers(variant, encoder, n):
+    """True if a running encoder will reach segment n soon enough to wait for it."""
+    return encoder is not None and encoder['process'].poll() is None and (encoder['end'] is None or n < encoder['end']) and \
+        encoder['start'] <= n <= _encoded_upto(variant, encoder) + 1 + SEGMENT_LOOKAHEAD
+
+def _variant_encoders(variant_id):
+    return [e for (v, _), e in hls_encoders.items() if v == variant_id]
+
+def _stop_segment_encoder(variant_id, encoder):
+    if encoder['process'].poll() is None: encoder['process'].kill()
+    release_transcode(encoder['job'])
+    if hls_encoders.get((variant_id, encoder['start'])) is encoder: del hls_encoders[(variant_id, encoder['start'])]
+
+def hls_segment_available(variant_id, n):
+    """True if segment n is cached or being encoded right now, i.e. no new encoder is needed."""
+    variant = hls_variants.get(variant_id)
+    if not variant or variant['renditions']: return False
+    with hls_lock:
+        return os.path.exists(_segment_path(variant, n)) or any(_encoder_covers(variant, e, n) for e in _variant_encoders(variant_id))
+
+def _claim_segment_encoder(variant_id, variant, n, job):
+    """Joins the encoder that will produce segment n, or starts one there, and counts the caller
+    as its waiter. job (a slot the caller holds) is handed to a new encoder or released.
+    Returns None when no encoder slot is free. Call with hls_lock held."""
+    encoder = next((e for e in _variant_encoders(variant_id) if _encoder_covers(variant, e, n)), None)
+    if encoder:
+        release_transcode(job)
+    else:
+        running = [e for e in _variant_encoders(variant_id) if e['process'].poll() is None]
+        idle = [e for e in running if not e['waiters']]
+        if len(running) >= SEGMENT_WINDOWS and idle:
+            # Move the window nobody waits on that was used longest ago; a window with waiters is
+            # never taken away from them, past the cap the encoder slots are the limit
+            _stop_segment_encoder(variant_id, min(idle, key=lambda e: e['touched']))
+        stale = hls_encoders.get((variant_id, n))
+        if stale: _stop_segment_encoder(variant_id, stale)
+        if variant['quality'] == 'audio':
+            # An AAC encode is cheap enough to run without an encoder slot
+            release_transcode(job)
+            job, level = None, None
+        else:
+            owner = ('hls', variant_id, n)
+            if job: job = transfer_transcode(job, owner)
+            if job is None: job, _ = admit_transcode(owner, wait=False)
+            if job is None: return None
+            level = current_pipeline_level(variant['hw'], variant['source'])
+        end = _window_end(variant, n)
+        encoder = {'process': _start_segment_encoder(variant, n, level, end), 'start': n, 'end': end, 'last_requested': n,
+                   'touched': time.time(), 'job': job, 'level': level, 'retried': False, 'waiters': 0}
+        hls_encoders[(variant_id, n)] = encoder
+    encoder['waiters'] += 1
+    encoder['last_requested'], encoder['touched'] = n, time.time()
+    return encoder
+
+def get_hls_segment(variant_id, n, job=None, rendition=None):
+    """Returns the path of segment n (of one rung, for 'auto'), joining or starting an encoder if needed.
+    job is an encoder slot the caller already holds: it is handed to a new encoder, or released."""
+    variant = hls_variants.get(variant_id)
+    renditions = [r['name'] for r in variant['renditions']] if variant and variant['renditions'] else [None]
+    if not variant or rendition not in renditions:
+        release_transcode(job)
+        return None
+    path = _segment_path(variant, n, rendition)
+    if os.path.exists(path):
+        release_transcode(job)
+        with hls_lock:
+            # The viewer is still inside this window: keep its encoder from being judged idle
+            window = max((e for e in _variant_encoders(variant_id) if e['start'] <= n), key=lambda e: e['start'], default=None)
+            if window: window['last_requested'], window['touched'] = n, time.time()
+        cache_last_used[path] = time.time()
+        return path
+
+    deadline = time.time() + SEGMENT_WAIT_TIMEOUT
+    encoder = None
+    try:
+        while not os.path.exists(path) and time.time() < deadline:
+            if encoder is None:
+                with hls_lock: encoder = _claim_segment_encoder(variant_id, variant, n, job)
+                job = None
+                if encoder is None: break  # No encoder slot free
+                continue
+            code = encoder['process'].poll()
+            if code is None:
+                time.sleep(0.1)
+            elif code < 0 or hls_encoders.get((variant_id, encoder['start'])) is not encoder:
+                # Stopped (moved by another viewer, redundant, over a limit; a kill exits with 1 on
+                # Windows): join or start whatever encoder covers segment n now
+                with hls_lock: encoder['waiters'] -= 1
+                encoder = None
+            elif code > 0 and encoder['level'] and _encoded_upto(variant, encoder) < encoder['start']:
+                # Failed before its first segment. Tried once more as is (a read timeout, a busy
+                # device), then the level is demoted only if the device or a device filter is to blame
+                with hls_lock:
+                    if hls_encoders.get((variant_id, encoder['start'])) is not encoder: continue
+                    errors = _encoder_errors(variant, encoder)
+                    if not encoder['retried']:
+                        encoder['retried'] = True
+                    elif hardware_failure(errors) and demote_pipeline(variant['hw'], encoder['level'], variant['source']):
+                        encoder['level'], encoder['retried'] = current_pipeline_level(variant['hw'], variant['source']), False
+                    else:
+                        logger.warning(f"Segment encoder {variant_id[:8]}@{encoder['start']} failed: {errors.strip()[-500:]}")
+                        break
+                    encoder['process'] = _start_segment_encoder(variant, encoder['start'], encoder['level'], encoder['end'])
+            else:
+                break  # Encoder reached the end (or failed); the segment may have been its last one
+    finally:
+        if encoder:
+            with hls_lock: encoder['waiters'] -= 1
+    if not os.path.exists(path): return None
+    cache_last_used[path] = time.time()
+    return path
+
+def _sprite_sets():
+    """(last used, folder, size) of every finished set of sprite sheets."""
+    sets = []
+    if not os.path.isdir(SPRITE_DIR): return sets
+    for name in os.listdir(SPRITE_DIR):
+        path = os.path.abspath(os.path.join(SPRITE_DIR, name))
+        if name.endswith('.tmp') or not os.path.isdir(path): continue  # A build in progress
+        try: size, mtime = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)), os.path.getmtime(path)
+        except OSError: continue  # Removed meanwhile
+        sets.append((cache_last_used.get(path, mtime), path, size))
+    return sets
+
+def enforce_cache_budget():
+    """Deletes least recently used segments and sprite sets until both stores together fit
+    SEGMENT_CACHE_BUDGET. Segments of variants that are being encoded are kept, their encoders rely
+    on them. Sprite sheets of a file go together, since its map points into every sheet."""
+    with hls_lock:
+        busy = tuple(hls_variants[v]['dir'] + os.sep for (v, _), e in hls_encoders.items() if e['process'].poll() is None)
+    entries, total = [], 0
+    for root, _, names in os.walk(HLS_DIR):
+        for name in names:
+            if not name.endswith('.ts'): continue
+            path = os.path.abspath(os.path.join(root, name))
+            try: st = os.stat(path)
+            except OSError: continue
+            total += st.st_size
+            if not path.startswith(busy): entries.append((cache_last_used.get(path, st.st_mtime), path, st.st_size))
+    for entry in _sprite_sets():
+        total += entry[2]
+        entries.append(entry)
+    if total <= SEGMENT_CACHE_BUDGET: return
+    for _, path, size in sorted(entries):
+        if os.path.isdir(path): shutil.rmtree(path, ignore_errors=True)
+        else:
+            try: os.remove(path)
+            except OSError: continue  # Still being sent on Windows; try again next round
+        cache_last_used.pop(path, None)
+        total -= size
+        if total <= SEGMENT_CACHE_BUDGET * 0.9: break
+    logger.info(f"Segment and sprite cache trimmed to {total // (1024 * 1024)} MiB")
+
+def _hls_janitor():
+    """Stops encoders that ran far past the last requested segment, that are ahead of viewers who
+    stopped asking for segments (a paused tab, whose stalled feed or player no longer requests any),
+    or that ran into the window of a later encoder, and keeps the segment store within its disk budget."""
+    while True:
+        time.sleep(5)
+        with hls_lock:
+            for (variant_id, start), encoder in list(hls_encoders.items()):
+                if encoder['process'].poll() is not None:
+                    if not encoder['waiters']: _stop_segment_encoder(variant_id, encoder)
+                    continue
+                upto = _encoded_upto(hls_variants[variant_id], encoder)
+                ahead = upto - encoder['last_requested']
+                if ahead > SEGMENT_MAX_AHEAD and not encoder['waiters']:
+                    logger.info(f"Pausing segment encoder {variant_id[:8]}@{start}: far ahead of playhead")
+                    _stop_segment_encoder(variant_id, encoder)
+                elif ahead > SEGMENT_LOOKAHEAD and not encoder['waiters'] and time.time() - encoder['touched'] > SEGMENT_IDLE_TIMEOUT:
+                    # The next request past the cached run starts a new window there
+                    logger.info(f"Pausing segment encoder {variant_id[:8]}@{start}: no segment requested for {SEGMENT_IDLE_TIMEOUT}s")
+                    _stop_segment_encoder(variant_id, encoder)
+                elif any(start < e['start'] <= upto + 1 and e['process'].poll() is None for e in _variant_encoders(variant_id)):
+                    # Caught up with a later window; that encoder already makes everything from here on
+                    logger.info(f"Stopping segment encoder {variant_id[:8]}@{start}: reached the next window")
+                    _stop_segment_encoder(variant_id, encoder)
+        enforce_cache_budget()
+
+threading.Thread(target=_hls_janitor, daemon=True).start()
+
+# --- SPECULATIVE PRE-ROLL ---
+# While the seek bar is dragged the player announces the position under the pointer. A transcoded
+# stream gets its segment encoder started there. A stream-copy stream gets its FFmpeg spawned
+# (container opened, first fragments waiting in the pipe) and the /video_feed that follows adopts it.
+PREROLL_TTL = 10  # Seconds an unclaimed pre-rolled process is kept
+
+def direct_stream_cmd(filepath, start_time, audio_index, audio_tracks, quality, is_h264, hw_mode):
+    """FFmpeg command for a progressive stream that is piped straight from the source."""
+    input_flags = ['-ss', f"{start_time:.6f}"]
+    if not (quality == 'original' and is_h264): input_flags.extend(['-threads', str(encoder_threads())])  # Decoder threads
+    cmd = ['ffmpeg'] + input_flags + ['-i', media_input(filepath), '-map', '0:v:0']
+
+    # --- AUDIO CHECK ---
+    # Only map audio if valid tracks exist and index is valid
+    if audio_tracks and audio_index in audio_tracks:
+        cmd.extend(['-map', f'0:{audio_index}'])
+        # Copy browser-compatible audio, transcode anything else to Stereo AAC
+        cmd.extend(get_audio_codec_flags(audio_tracks[audio_index]))
+    else:
+        # No audio track? Do not map audio.
+        logger.info("No audio track detected or selected. Streaming video only.")
+        # If no audio, just video flags
 
-    # --- FIX STARTS HERE ---
+    cmd.extend(get_video_codec_flags(quality, is_h264, hw_mode))
+
+    cmd.extend(['-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-loglevel', 'warning', 'pipe:1'])
+    return cmd
+
+def discard_preroll(session):
+    preroll, session['preroll'] = session.get('preroll'), None
+    if preroll and preroll['process'].poll() is None:
+        try: preroll['process'].kill()
+        except OSError: pass
+
+def start_preroll(session, cmd):
+    """Spawns cmd for a session ahead of its request, replacing the previous guess."""
+    discard_preroll(session)
+    process = spawn(cmd, 'stream', stdout=subprocess.PIPE, stderr=sys.stderr, bufsize=65536)
+    session['preroll'] = {'cmd': cmd, 'process': process, 'started': time.time()}
+
+def take_preroll(session, cmd):
+    """The session's pre-rolled process if it runs exactly cmd; any other pre-roll is discarded."""
+    preroll = session.get('preroll')
+    if preroll and preroll['cmd'] == cmd and preroll['process'].poll() is None and time.time() - preroll['started'] < PREROLL_TTL:
+        session['preroll'] = None
+        return preroll['process']
+    discard_preroll(session)
+    return None
+
+def discard_warm_segments(session):
+    """Stops the windows a session's earlier pre-rolls started, unless a viewer has asked them for a segment since."""
+    with hls_lock:
+        for variant_id, encoder, touched in session['warming']:
+            if encoder['touched'] == touched and not encoder['waiters']: _stop_segment_encoder(variant_id, encoder)
+    session['warming'] = []
+
+def warm_segment(session, variant_id, n):
+    """Starts an encoder at segment n for a session's pre-roll, unless the segment is cached or on its way.
+    Pre-rolls never queue for a slot, and the caller discards the session's previous ones first, so
+    scrubbing holds at most one window per variant instead of a slot for every drag position."""
+    variant = hls_variants.get(variant_id)
+    if not variant: return
+    with hls_lock:
+        if os.path.exists(_segment_path(variant, n, _reference_rendition(variant))): return
+        if any(_encoder_covers(variant, e, n) for e in _variant_encoders(variant_id)): return
+        encoder = _claim_segment_encoder(variant_id, variant, n, None)
+        if encoder is None: return
+        encoder['waiters'] -= 1  # Nobody waits on a pre-roll; the request that follows joins the encoder
+        session['warming'].append((variant_id, encoder, encoder['touched']))
+
+# --- PARTIAL FILES (PLAY WHILE DOWNLOADING) ---
+# A file that is still being downloaded in pieces can already be played. Readers block until
+# the bytes they need have arrived, and tell the downloader which piece to fetch next.
+# FFmpeg reads such files through a loopback URL served by this app, so it waits the same way.
+PARTIAL_WAIT_TIMEOUT = 120
+partial_files = {}   # abs path -> {'size', 'piece_size', 'done', 'cond', 'wanted', 'skip', 'token', 'state'}
+partial_tokens = {}  # loopback token -> abs path; kept after completion so running FFmpegs can finish reading
+partial_lock = threading.Lock()
+
+def register_partial(filepath, size, done):
+    entry = {'size': size, 'piece_size': DOWNLOAD_PIECE_SIZE, 'done': done, 'cond': threading.Condition(),
+             'wanted': None, 'skip': set(), 'token': uuid.uuid4().hex, 'state': 'downloading'}
+    with partial_lock:
+        partial_files[os.path.abspath(filepath)] = entry
+        partial_tokens[entry['token']] = os.path.abspath(filepath)
+    return entry
+
+def finish_partial(filepath, complete):
+    with partial_lock: entry = partial_files.pop(os.path.abspath(filepath), None)
+    if entry:
+        with entry['cond']:
+            entry['state'] = 'complete' if complete else 'failed'
+            entry['cond'].notify_all()
+
+def get_partial(filepath):
+    member = archive_member(filepath)
+    return partial_files.get(os.path.abspath(member['archive'] if member else filepath))
+
+def restrict_partial(filepath, spans):
+    """Only fetch the pieces of a downloading file that overlap the given inclusive byte spans."""
+    entry = get_partial(filepath)
+    if entry is None: return
+    keep = set()
+    for start, end in spans: keep.update(range(start // entry['piece_size'], end // entry['piece_size'] + 1))
+    entry['skip'] = set(range(-(-entry['size'] // entry['piece_size']))) - keep - entry['done']
+
+def wait_for_range(filepath, start, end):
+    """Blocks until bytes start..end of a downloading file are present. False if they never arrive."""
+    member = archive_member(filepath)
+    if member: start, end = start + member['offset'], end + member['offset']
+    entry = get_partial(filepath)
+    if entry is None: return True
+    first, last = start // entry['piece_size'], end // entry['piece_size']
+    deadline = time.time() + PARTIAL_WAIT_TIMEOUT
+    with entry['cond']:
+        while True:
+            if entry['state'] != 'downloading': return entry['state'] == 'complete'
+            missing = next((i for i in range(first, last + 1) if i not in entry['done']), None)
+            if missing is None: return True
+            if time.time() > deadline: return False
+            entry['wanted'] = missing  # The downloader fetches this piece next
+            entry['cond'].wait(1)
+
+def media_input(filepath):
+    """What FFmpeg should open: the file itself, or a loopback URL that waits for missing bytes.
+    A member stored inside a zip is opened as a byte window of the archive."""
+    member = archive_member(filepath)
+    if member:
+        return f"subfile,,start,{member['offset']},end,{member['offset'] + member['size']},,:{media_input(member['archive'])}"
+    entry = get_partial(filepath)
+    if entry: return f"http://127.0.0.1:{SERVER_PORT}/internal/partial/{entry['token']}"
+    return filepath
+
+# --- ZIP ARCHIVES ---
+# Archives are not unpacked wholesale. The central directory is read in place (through blocking
+# reads while the archive is still downloading), only the pieces holding video and subtitle members
+# are fetched, compressed members are inflated once, and stored video members are never copied:
+# they are served and decoded straight from their byte window in the archive.
+archive_members = {}  # virtual path (<archive>/<member name>) -> {'archive', 'offset', 'size'}
+
+def archive_member(filepath):
+    return archive_members.get(os.path.abspath(filepath))
+
+def media_exists(filepath):
+    member = archive_member(filepath)
+    return os.path.exists(member['archive'] if member else filepath)
+
+def _members_index_path(archive):
+    return archive + '.members.json'
+
+def register_archive_member(archive, name, offset, size):
+    path = os.path.join(os.path.abspath(archive), *name.split('/'))
+    archive_members[path] = {'archive': os.path.abspath(archive), 'offset': offset, 'size': size}
+    return path
+
+def load_archive_members(archive):
+    """Re-registers the stored members recorded for an archive by an earlier unpack."""
+    try:
+        with open(_members_index_path(archive), 'r', encoding='utf-8') as f: members = json.load(f)
+    except (OSError, ValueError):
+        return []
+    return [register_archive_member(archive, name, m['offset'], m['size']) for name, m in members.items()]
+
+class PartialFileReader(io.RawIOBase):
+    """Read-only file over a file that may still be downloading; reads wait for the bytes they need."""
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.size = os.path.getsize(filepath)
+        self.f = open(filepath, 'rb')
+
+    def readable(self): return True
+    def seekable(self): return True
+    def seek(self, pos, whence=io.SEEK_SET): return self.f.seek(pos, whence)
+    def tell(self): return self.f.tell()
+
+    def readinto(self, b):
+        pos = self.f.tell()
+        n = min(len(b), self.size - pos)
+        if n <= 0: return 0
+        while not wait_for_range(self.filepath, pos, pos + n - 1):
+            if not get_partial(self.filepath): raise IOError(f"Download of {self.filepath} stopped")
+        return self.f.readinto(memoryview(b)[:n])
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+def _member_data_offset(fp, info):
+    """The local header repeats the name and has its own extra field, so the data offset is read from it."""
+    fp.seek(info.header_offset)
+    header = fp.read(zipfile.sizeFileHeader)
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    return info.header_offset + zipfile.sizeFileHeader + name_length + extra_length
+
+def unpack_archive(archive, dest_dir, state, cancel=None):
+    """Makes the video and subtitle members of a zip playable and returns the members served in
+    place ({name: {'offset', 'size'}}). Works on a finished archive or one still downloading."""
+    with PartialFileReader(archive) as reader, zipfile.ZipFile(reader) as z:
+        infos = sorted(z.infolist(), key=lambda i: i.header_offset)
+        # A member's bytes run up to the next local header (or the central directory)
+        ends = {i.filename: (nxt.header_offset if nxt else z.start_dir) - 1 for i, nxt in zip(infos, infos[1:] + [None])}
+        media = [i for i in infos if not i.is_dir() and not i.flag_bits & 0x1 and i.filename.lower().endswith(VIDEO_EXTS + SUBTITLE_EXTS)]
+        restrict_partial(archive, [(i.header_offset, ends[i.filename]) for i in media] + [(z.start_dir, reader.size - 1)])
+        logger.info(f"Archive has {len(infos)} members, {len(media)} of them video or subtitles")
+
+        stored = {}
+        for info in media:
+            if info.compress_type != zipfile.ZIP_STORED or not info.filename.lower().endswith(VIDEO_EXTS): continue
+            stored[info.filename] = {'offset': _member_data_offset(reader, info), 'size': info.file_size}
+            path = register_archive_member(archive, info.filename, **stored[info.filename])
+            if not state.get('streamable'): state.update({'path': path, 'streamable': True})
+
+        for info in media:
+            if info.filename in stored: continue
+            if cancel and cancel.is_set(): raise DownloadCancelled()
+            target = os.path.join(dest_dir, *[p for p in info.filename.split('/') if p not in ('', '.', '..')])
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            state['msg'] = f"Extracting {os.path.basename(target)}..."
+            with z.open(info) as src, open(target + '.part', 'wb') as dst:
+                while True:
+                    chunk = src.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk: break
+                    if cancel and cancel.is_set(): raise DownloadCancelled()
+                    dst.write(chunk)
+            os.replace(target + '.part', target)
+            if not state.get('streamable') and target.lower().endswith(VIDEO_EXTS):
+                state.update({'path': os.path.abspath(target), 'streamable': True})
+
+    return stored
+
+def save_archive_members(archive, stored):
+    """Records the members served in place, so they are listed again after a restart."""
+    with open(_members_index_path(archive), 'w', encoding='utf-8') as f: json.dump(stored, f)
+
+# --- RAW FILE SERVING ---
+RAW_CHUNK_SIZE = int(os.environ.get('RAW_CHUNK_SIZE', str(1024 * 1024)))
+
+def _mmap_range(filepath, start, length, chunk_size):
+    """Yields memoryview slices of an mmap over the range, so no chunk is copied in Python.
+    Chunks of a file that is still downloading are only yielded once they have arrived."""
+    if length <= 0: return
+    member = archive_member(filepath)
+    base = member['offset'] if member else 0
+    with open(member['archive'] if member else filepath, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mm)
+    try:
+        for pos in range(start, start + length, chunk_size):
+            chunk_end = min(pos + chunk_size, start + length)
+            if not wait_for_range(filepath, pos, chunk_end - 1):
+                logger.warning(f"Gave up waiting for bytes {pos}-{chunk_end - 1} of {filepath}")
+                return
+            yield view[base + pos:base + chunk_end]
+    finally:
+        try:
+            view.release()
+            mm.close()
+        except BufferError: pass  # The server still holds the last chunk; the map goes with it
+
+def file_range_body(filepath, start, length):
+    """Body for a byte range of a file. Uses the server's wsgi.file_wrapper when it has one
+    (waitress then streams the file from its I/O thread, bounded by Content-Length) and
+    falls back to mmap-backed memoryviews."""
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper and not get_partial(filepath):
+        member = archive_member(filepath)
+        f = open(member['archive'] if member else filepath, 'rb')
+        f.seek(start + (member['offset'] if member else 0))
+        return file_wrapper(f, RAW_CHUNK_SIZE)
+    return _mmap_range(filepath, start, length, RAW_CHUNK_SIZE)
+
+MAX_RANGES = 16  # More ranges than this in one request are ignored and the whole file is sent
+media_paths_by_key = {}  # content key -> path, for the cacheable /media URLs
+
+def parse_byte_ranges(header, size):
+    """Parses a Range header into inclusive (start, end) pairs clipped to the file size.
+    Returns None if the header is absent or malformed (send the whole file) and []
+    if no range is satisfiable (416)."""
+    if not header: return None
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec.strip(): return None
+    parts = spec.split(',')
+    if len(parts) > MAX_RANGES: return None
+    ranges = []
+    for part in parts:
+        first, sep, last = part.strip().partition('-')
+        if not sep: return None
+        if not first:
+            # Suffix range: the last N bytes
+            if not last.isdigit(): return None
+            if int(last) > 0 and size > 0: ranges.append((max(0, size - int(last)), size - 1))
+            continue
+        if not first.isdigit() or (last and not last.isdigit()): return None
+        start, end = int(first), (int(last) if last else size - 1)
+        if last and end < start: return None
+        if start < size: ranges.append((start, min(end, size - 1)))
+    return ranges
+
+def _multipart_body(filepath, ranges, size, mimetype, boundary):
+    for start, end in ranges:
+        yield f"\r\n--{boundary}\r\nContent-Type: {mimetype}\r\nContent-Range: bytes {start}-{end}/{size}\r\n\r\n".encode('latin-1')
+        yield from _mmap_range(filepath, start, end + 1 - start, RAW_CHUNK_SIZE)
+    yield f"\r\n--{boundary}--\r\n".encode('latin-1')
+
+def serve_media_file(filepath, cache_control):
+    """Serves a file with strong validators, conditional GET, If-Range, suffix and multipart ranges."""
+    member = archive_member(filepath)
+    st = os.stat(member['archive'] if member else filepath)
+    size = member['size'] if member else st.st_size
+    etag = f"{size:x}-{st.st_mtime_ns:x}-{st.st_ino:x}"
+    partial = get_partial(filepath)
+    if partial:
+        # The mtime changes with every piece written, so it cannot be part of the validator
+        etag = f"{size:x}-{partial['token']}"
+        cache_control = 'no-store'
+    if member: etag += f"-{member['offset']:x}"
+    last_modified = datetime.fromtimestamp(int(st.st_mtime), timezone.utc)
+    mimetype = mimetypes.guess_type(filepath)[0] or 'application/octet-stream'
+    headers = {'ETag': quote_etag(etag), 'Last-Modified': http_date(last_modified),
+               'Cache-Control': cache_control, 'Accept-Ranges': 'bytes'}
+
+    # If-None-Match takes precedence over If-Modified-Since
+    if request.if_none_match:
+        if request.if_none_match.contains_weak(etag): return Response(status=304, headers=headers)
+    elif request.if_modified_since and last_modified <= request.if_modified_since:
+        return Response(status=304, headers=headers)
+
+    ranges = parse_byte_ranges(request.headers.get('Range'), size)
+    if_range = request.headers.get('If-Range')
+    if ranges is not None and if_range:
+        # If-Range needs a strong match; otherwise the client gets the full, current file
+        if request.if_range.date: fresh = request.if_range.date == last_modified
+        else: fresh = not if_range.strip().startswith('W/') and request.if_range.etag == etag
+        if not fresh: ranges = None
+
+    if ranges == []:
+        headers['Content-Range'] = f"bytes */{size}"
+        return Response("Range Not Satisfiable", 416, headers=headers)
+    is_head = request.method == 'HEAD'
+    if ranges is None:
+        status, length = 200, size
+        body = b'' if is_head else file_range_body(filepath, 0, size)
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        status, length = 206, end + 1 - start
+        headers['Content-Range'] = f"bytes {start}-{end}/{size}"
+        body = b'' if is_head else file_range_body(filepath, start, length)
+    else:
+        boundary = uuid.uuid4().hex
+        status = 206
+        length = sum(len(f"\r\n--{boundary}\r\nContent-Type: {mimetype}\r\nContent-Range: bytes {start}-{end}/{size}\r\n\r\n") + end + 1 - start for start, end in ranges)
+        length += len(f"\r\n--{boundary}--\r\n")
+        body = b'' if is_head else _multipart_body(filepath, ranges, size, mimetype, boundary)
+        mimetype = f"multipart/byteranges; boundary={boundary}"
+    rv = Response(body, status, mimetype=mimetype, headers=headers, direct_passthrough=True)
+    rv.headers['Content-Length'] = str(length)
+    return rv
+
+def media_url(filepath):
+    """Content-addressed URL for a file. It changes whenever the file does, so it can be cached forever."""
+    key = fingerprint_key(file_fingerprint(filepath))
+    media_paths_by_key[key] = filepath
+    return url_for('media_file', key=key, name=os.path.basename(filepath))
+
+# --- PARALLEL DOWNLOADER ---
+# Remote files are split into fixed-size pieces fetched over several pooled connections and
+# written in place into a preallocated file. A journal next to the file records finished
+# pieces, so an interrupted download continues where it stopped.
+DOWNLOAD_CONNECTIONS = int(os.environ.get('DOWNLOAD_CONNECTIONS', '4'))
+DOWNLOAD_PIECE_SIZE = 8 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_HEADERS = {'User-Agent': 'Mozilla/5.0'}  # mimic a browser, often helps with direct download links
+
+def _download_session():
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=DOWNLOAD_CONNECTIONS)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update(DOWNLOAD_HEADERS)
+    return session
+
+def probe_remote(http, url):
+    """Returns (size, supports_ranges, validator) using a one-byte range request."""
+    with http.get(url, stream=True, headers={'Range': 'bytes=0-0'}) as r:
+        r.raise_for_status()
+        validator = r.headers.get('ETag') or r.headers.get('Last-Modified') or ''
+        m = re.match(r'bytes 0-0/(\d+)', r.headers.get('Content-Range', ''))
+        if r.status_code == 206 and m: return int(m.group(1)), True, validator
+        return int(r.headers.get('content-length', 0)), False, validator
+
+def _journal_path(save_path):
+    return save_path + '.journal'
+
+def load_journal(save_path, url, size, validator):
+    """Finished piece indexes of an earlier attempt at the same download, if it can be resumed."""
+    try:
+        with open(_journal_path(save_path), 'r', encoding='utf-8') as f: journal = json.load(f)
+    except (OSError, ValueError):
+        return set()
+    if (journal.get('url'), journal.get('size'), journal.get('validator'), journal.get('piece_size')) != (url, size, validator, DOWNLOAD_PIECE_SIZE):
+        return set()
+    if not os.path.exists(save_path) or os.path.getsize(save_path) != size: return set()
+    return set(journal.get('done', []))
+
+def _save_journal(save_path, url, size, validator, done):
+    tmp_path = _journal_path(save_path) + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'url': url, 'size': size, 'validator': validator, 'piece_size': DOWNLOAD_PIECE_SIZE, 'done': sorted(done)}, f)
+    os.replace(tmp_path, _journal_path(save_path))
+
+def _download_single(http, url, save_path, state, cancel):
+    """Plain sequential download for servers without range support."""
+    with http.get(url, stream=True) as r:
+        r.raise_for_status()
+        total_length = int(r.headers.get('content-length', 0))
+        dl = 0
+        with open(save_path, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if cancel and cancel.is_set(): raise DownloadCancelled()
+                if chunk:
+                    dl += len(chunk)
+                    f.write(chunk)
+                    if total_length > 0:
+                        percent = int((dl / total_length) * 100)
+                        state['progress'] = percent
+                        state['msg'] = f"Downloading: {percent}%"
+
+def download_file(url, save_path, state, cancel=None, on_start=None):
+    """Downloads url to save_path, in parallel pieces when the server supports ranges.
+    on_start is called once the file is registered as partial (ranged downloads only).
+    Raises DownloadCancelled once the cancel event is set."""
+    http = _download_session()
+    size, supports_ranges, validator = probe_remote(http, url)
+    if not supports_ranges or size <= 0:
+        logger.info("Server does not support ranges, downloading over one connection")
+        return _download_single(http, url, save_path, state, cancel)
+
+    piece_count = -(-size // DOWNLOAD_PIECE_SIZE)
+    done = load_journal(save_path, url, size, validator)
+    if done: logger.info(f"Resuming download: {len(done)}/{piece_count} pieces already present")
+    else:
+        with open(save_path, 'wb') as f: f.truncate(size)  # Preallocate so pieces can land at their offsets
+        _save_journal(save_path, url, size, validator, done)
+
+    def piece_range(index):
+        start = index * DOWNLOAD_PIECE_SIZE
+        return start, min(size, start + DOWNLOAD_PIECE_SIZE) - 1
+
+    # Head and tail first: containers keep their index at either end, so playback can start early
+    pending = sorted((i for i in range(piece_count) if i not in done), key=lambda i: (i not in (0, piece_count - 1), i))
+    partial = register_partial(save_path, size, done)
+    if on_start: on_start()
+    piece_progress = {}   # piece index -> bytes received so far, for pieces in flight
+    progress = {'done_bytes': sum(piece_range(i)[1] + 1 - piece_range(i)[0] for i in done)}
+    lock = threading.Lock()
+
+    def report():
+        wanted_bytes = size - sum(piece_range(i)[1] + 1 - piece_range(i)[0] for i in partial['skip'])
+        percent = min(100, int((progress['done_bytes'] + sum(piece_progress.values())) * 100 / max(1, wanted_bytes)))
+        state['progress'] = percent
+        state['msg'] = f"Downloading: {percent}% ({len(piece_progress)} connections)"
+        state['parts'] = {str(i): int(n * 100 / DOWNLOAD_PIECE_SIZE) for i, n in piece_progress.items()}
+        state['playable'] = 0 in done and piece_count - 1 in done
+
+    def next_piece():
+        """The piece a blocked reader is waiting for (or the next one after it), else the next in order."""
+        if partial['skip']: pending[:] = [i for i in pending if i not in partial['skip']]
+        if not pending: return None
+        wanted = partial['wanted']
+        if wanted is not None:
+            index = min((i for i in pending if i >= wanted), default=None)
+            if index is not None:
+                pending.remove(index)
+                return index
+        return pending.pop(0)
+
+    def fetch_piece(f, index):
+        start, end = piece_range(index)
+        for attempt in range(DOWNLOAD_RETRIES):
+            offset = start + piece_progress[index]
+            try:
+                with http.get(url, stream=True, headers={'Range': f'bytes={offset}-{end}'}, timeout=30) as r:
+                    if r.status_code != 206: raise IOError(f"Expected 206 for piece {index}, got {r.status_code}")
+                    f.seek(offset)
+                    for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        if cancel and cancel.is_set(): raise DownloadCancelled()
+                        f.write(chunk)
+                        with lock:
+                            piece_progress[index] += len(chunk)
+                            report()
+                if start + piece_progress[index] > end: return
+                raise IOError(f"Piece {index} ended early")
+            except (requests.RequestException, IOError) as e:
+                if attempt == DOWNLOAD_RETRIES - 1: raise
+                logger.warning(f"Piece {index} failed ({e}), retrying")
+
+    def worker():
+        with open(save_path, 'r+b') as f:
+            while True:
+                with lock:
+                    index = next_piece()
+                    if index is None: return
+                    piece_progress[index] = 0
+                try:
+                    fetch_piece(f, index)
+                    f.flush()
+                except Exception:
+                    with lock: pending.clear()  # Stop the other connections; the journal keeps what finished
+                    raise
+                with lock:
+                    progress['done_bytes'] += piece_progress.pop(index)
+                    done.add(index)
+                    _save_journal(save_path, url, size, validator, done)
+                    report()
+                with partial['cond']: partial['cond'].notify_all()
+
+    connections = min(DOWNLOAD_CONNECTIONS, len(pending))
+    logger.info(f"Downloading {size} bytes in {len(pending)} pieces over {connections} connections")
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, connections)) as pool:
+            futures = [pool.submit(worker) for _ in range(connections)]
+        for future in futures: future.result()
+    except BaseException:
+        finish_partial(save_path, complete=False)
+        raise
+    os.remove(_journal_path(save_path))
+    finish_partial(save_path, complete=True)
+    state.pop('parts', None)
+
+# --- DOWNLOAD JOBS ---
+# Downloads run on a bounded worker pool instead of the request thread. Each job downloads into
+# its own folder (named after the URL, so resubmitting a URL resumes it) and keeps its own state.
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', '2'))
+MAX_JOB_HISTORY = 50
+download_jobs = OrderedDict()   # job id -> JSON-serialisable state
+job_cancel_events = {}          # job id -> threading.Event
+jobs_lock = threading.Lock()
+job_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix='download')
+
+class DownloadCancelled(Exception):
+    pass
+
+def filename_from_url(url):
     try:
         # 1. Parse the URL to get the path without query parameters
         parsed_url = urlparse(url)
@@ -657,80 +2386,859 @@ def process_url():
 
     except Exception as e:
         filename = "downloaded_file"
-    # --- FIX ENDS HERE ---
-
-    save_path = os.path.join(DOWNLOAD_DIR, filename)
-    download_state['filename'] = filename
-
+    return filename
+
+def _job_is_active(job):
+    return job['status'] in ('Queued', 'Downloading', 'Extracting')
+
+def _has_journal(path):
+    """True if a download folder holds an unfinished download that a retry would resume."""
+    for _, _, filenames in os.walk(path):
+        if any(f.endswith('.journal') for f in filenames): return True
+    return False
+
+def clean_downloads(keep_dir):
+    """Empties DOWNLOAD_DIR except keep_dir, folders of running or retryable jobs, folders with a
+    download journal and files open in a stream session."""
+    keep = {os.path.abspath(keep_dir)}
+    with jobs_lock:
+        keep.update(os.path.abspath(job['dir']) for job in download_jobs.values()
+                    if _job_is_active(job) or job['status'] in ('Error', 'Cancelled'))
+    with session_lock:
+        open_files = [os.path.abspath(s['file']) for s in stream_sessions.values() if s['file']]
+    download_root = os.path.abspath(DOWNLOAD_DIR)
+    for path in open_files:
+        if path.startswith(download_root + os.sep):
+            keep.add(os.path.join(download_root, os.path.relpath(path, download_root).split(os.sep)[0]))
+    for entry in os.listdir(DOWNLOAD_DIR):
+        path = os.path.abspath(os.path.join(DOWNLOAD_DIR, entry))
+        if path in keep: continue
+        if os.path.isdir(path):
+            if _has_journal(path): continue  # Left by a job from before a restart; retrying it resumes
+            shutil.rmtree(path, ignore_errors=True)
+        else: os.remove(path)
+
+def run_download_job(job_id):
+    with jobs_lock: job = download_jobs[job_id]
+    cancel = job_cancel_events[job_id]
+    save_path = os.path.join(job['dir'], job['filename'])
+    job.update({'progress': 0, 'status': 'Downloading', 'msg': 'Connecting...', 'path': os.path.abspath(save_path),
+                'playable': False, 'streamable': job['filename'].lower().endswith(VIDEO_EXTS)})
     try:
+        if cancel.is_set(): raise DownloadCancelled()
+        os.makedirs(job['dir'], exist_ok=True)
+        clean_downloads(keep_dir=job['dir'])
+
+        # A zip is unpacked while it downloads, which also limits the download to its media members
+        unpacker = {}
+        def unpack():
+            try: unpacker['stored'] = unpack_archive(save_path, job['dir'], job, cancel)
+            except BaseException as e: unpacker['error'] = e
+        def start_unpacking():
+            unpacker['thread'] = threading.Thread(target=unpack, daemon=True)
+            unpacker['thread'].start()
+
         # Download with Progress Tracking
-        download_state['msg'] = 'Starting Download...'
-        # headers added to mimic a browser, often helps with direct download links
-        headers = {'User-Agent': 'Mozilla/5.0'} 
-        
-        with requests.get(url, stream=True, headers=headers) as r:
-            r.raise_for_status()
-            total_length = int(r.headers.get('content-length', 0))
-            dl = 0
-            with open(save_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    if chunk:
-                        dl += len(chunk)
-                        f.write(chunk)
-                        if total_length > 0:
-                            percent = int((dl / total_length) * 100)
-                            download_state['progress'] = percent
-                            download_state['msg'] = f"Downloading: {percent}%"
-        
-        download_state['progress'] = 100
+        job['msg'] = 'Starting Download...'
+        is_zip_name = job['filename'].lower().endswith('.zip')
+        download_file(job['url'], save_path, job, cancel, on_start=start_unpacking if is_zip_name else None)
+        job['progress'] = 100
         
-        # Unzip if needed
-        if zipfile.is_zipfile(save_path):
-            download_state['msg'] = 'Extracting Zip Archive...'
-            with zipfile.ZipFile(save_path, 'r') as z:
-                z.extractall(DOWNLOAD_DIR)
-            os.remove(save_path) # remove zip after extraction
-
-        download_state['status'] = 'Done'
-        download_state['msg'] = 'Finished!'
-        
-        return jsonify({'status': 'ok'})
-
+        # Unzip if needed (servers without ranges, or zips without a .zip name)
+        if 'thread' not in unpacker and zipfile.is_zipfile(save_path):
+            job['status'] = 'Extracting'
+            job['msg'] = 'Extracting Zip Archive...'
+            unpack()
+        elif 'thread' in unpacker:
+            job['status'] = 'Extracting'
+            unpacker['thread'].join()
+        if 'error' in unpacker: raise unpacker['error']
+        if 'stored' in unpacker:
+            if unpacker['stored']: save_archive_members(save_path, unpacker['stored'])
+            else: os.remove(save_path)  # Everything was extracted, the archive is no longer needed
+
+        scan_library()  # The file list the landing page redirects to must already show it
+        job['status'] = 'Done'
+        job['msg'] = 'Finished!'
+    except DownloadCancelled:
+        logger.info(f"Download {job_id[:8]} cancelled")
+        job['status'] = 'Cancelled'
+        job['msg'] = 'Cancelled'
     except Exception as e:
         logger.error(f"Download Error: {e}")
-        download_state['status'] = 'Error'
-        download_state['msg'] = str(e)
-        return jsonify({'status': 'error', 'message': str(e)})
+        job['status'] = 'Error'
+        job['msg'] = str(e)
+    finally:
+        job.pop('parts', None)
+        library_wakeup.set()
+
+def submit_download_job(url):
+    """Queues a download and returns its job id. A URL that is already downloading returns the running job."""
+    with jobs_lock:
+        for job in download_jobs.values():
+            if job['url'] == url and _job_is_active(job): return job['id']
+        job_id = uuid.uuid4().hex
+        download_jobs[job_id] = {
+            'id': job_id, 'url': url, 'progress': 0, 'status': 'Queued', 'msg': 'Waiting for a download slot...',
+            'filename': filename_from_url(url), 'dir': os.path.join(DOWNLOAD_DIR, hashlib.sha1(url.encode('utf-8')).hexdigest()[:12]),
+            'created': time.time()
+        }
+        job_cancel_events[job_id] = threading.Event()
+        # Forget the oldest finished jobs
+        for old_id in [i for i, j in download_jobs.items() if not _job_is_active(j)][:max(0, len(download_jobs) - MAX_JOB_HISTORY)]:
+            del download_jobs[old_id]
+            job_cancel_events.pop(old_id, None)
+    job_executor.submit(run_download_job, job_id)
+    return job_id
+
+def cancel_download_job(job_id):
+    with jobs_lock:
+        job = download_jobs.get(job_id)
+        if not job or not _job_is_active(job): return False
+        job_cancel_events[job_id].set()
+        return True
+
+def retry_download_job(job_id):
+    """Re-queues a failed or cancelled job; finished pieces are kept, so it resumes."""
+    with jobs_lock:
+        job = download_jobs.get(job_id)
+        if not job or job['status'] not in ('Error', 'Cancelled'): return False
+        job_cancel_events[job_id].clear()
+        job.update({'status': 'Queued', 'msg': 'Waiting for a download slot...'})
+    job_executor.submit(run_download_job, job_id)
+    return True
+
+def get_download_job(job_id=None):
+    """Job state by id, or the most recent job when no id is given."""
+    with jobs_lock:
+        if job_id: job = download_jobs.get(job_id)
+        else: job = next(reversed(download_jobs.values()), None)
+        return dict(job) if job else None
+
+# --- MEDIA LIBRARY ---
+# Playable files are indexed in SQLite instead of walking DOWNLOAD_DIR per request. A scanner
+# thread diffs sizes and mtimes against the index and probes new or changed files in the
+# background (metadata, keyframe summary, poster frame). With inotify_simple installed, changes
+# wake it right away; otherwise it rescans every LIBRARY_SCAN_INTERVAL seconds.
+LIBRARY_DB = os.path.join(CACHE_DIR, 'library.db')
+LIBRARY_SCHEMA = 2
+LIBRARY_SCAN_INTERVAL = int(os.environ.get('LIBRARY_SCAN_INTERVAL', '30'))
+LIBRARY_PAGE_MAX = 200
+LIBRARY_SORTS = {'name': 'name COLLATE NOCASE, path', 'added': 'added DESC, path',
+                 'duration': 'duration DESC, path', 'size': 'size DESC, path'}
+THUMB_DIR = os.path.join(CACHE_DIR, 'thumbs')
+library_local = threading.local()  # one connection per thread
+library_lock = threading.Lock()    # one scan at a time
+library_wakeup = threading.Event()  # set when files changed and the scanner should run now
+library_ready = threading.Event()  # set once the first scan is in
+
+def library_db():
+    conn = getattr(library_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(LIBRARY_DB, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')  # Readers never wait for the scanner
+        conn.execute('PRAGMA synchronous=NORMAL')
+        library_local.conn = conn
+    return conn
+
+def init_library():
+    """Creates the index; one written by a different schema is dropped, it is only a cache."""
+    db = library_db()
+    with db:
+        if db.execute('PRAGMA user_version').fetchone()[0] != LIBRARY_SCHEMA:
+            db.execute('DROP TABLE IF EXISTS media')
+            db.execute(f'PRAGMA user_version = {LIBRARY_SCHEMA}')
+        # probed: 0 queued, 1 done, -1 waiting for its download to finish
+        # extras (keyframe summary, poster, sprites): 0 queued, 1 done; only looked at once probed
+        db.execute("""CREATE TABLE IF NOT EXISTS media (
+            path TEXT PRIMARY KEY, name TEXT NOT NULL, size INTEGER, mtime_ns INTEGER, added REAL,
+            probed INTEGER NOT NULL DEFAULT 0, extras INTEGER NOT NULL DEFAULT 0, fingerprint TEXT, duration REAL, width INTEGER, height INTEGER,
+            video_codec TEXT, audio_tracks TEXT, subtitle_tracks TEXT, keyframes INTEGER, max_gop REAL, thumbnail INTEGER)""")
+        db.execute('CREATE INDEX IF NOT EXISTS media_name ON media (name COLLATE NOCASE)')
+        db.execute('CREATE INDEX IF NOT EXISTS media_added ON media (added)')
+        db.execute('CREATE INDEX IF NOT EXISTS media_queued ON media (probed) WHERE probed != 1')
+        db.execute('CREATE INDEX IF NOT EXISTS media_extras ON media (extras) WHERE extras = 0')
+
+def _library_walk():
+    """Playable files below DOWNLOAD_DIR, including stored zip members: path -> (size, mtime_ns)."""
+    found = {}
+    for root, _, filenames in os.walk(DOWNLOAD_DIR):
+        for f in filenames:
+            lower = f.lower()
+            if not lower.endswith(VIDEO_EXTS) and not lower.endswith('.zip'): continue
+            full_path = os.path.abspath(os.path.join(root, f))
+            try: st = os.stat(full_path)
+            except OSError: continue
+            if lower.endswith('.zip'):
+                # Video stored uncompressed in an archive is played from inside it
+                for member_path in load_archive_members(full_path): found[member_path] = (archive_member(member_path)['size'], st.st_mtime_ns)
+            else:
+                found[full_path] = (st.st_size, st.st_mtime_ns)
+    return found
+
+def scan_library():
+    """Brings the index in line with the disk. Only stats files; new or changed ones are queued for probing."""
+    with library_lock:
+        found = _library_walk()
+        db = library_db()
+        known = {row['path']: row for row in db.execute('SELECT path, size, mtime_ns, probed, fingerprint FROM media')}
+        gone = [(path,) for path in known if path not in found]
+        changed = [(path, os.path.basename(path), size, mtime_ns, time.time()) for path, (size, mtime_ns) in found.items()
+                   if path not in known or (known[path]['size'], known[path]['mtime_ns']) != (size, mtime_ns)]
+        finished = [(path,) for path, row in known.items() if row['probed'] == -1 and path in found and not get_partial(path)]
+        with db:
+            db.executemany('DELETE FROM media WHERE path = ?', gone)
+            db.executemany('INSERT INTO media (path, name, size, mtime_ns, added) VALUES (?, ?, ?, ?, ?) ON CONFLICT (path) '
+                           'DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns, probed = 0, extras = 0', changed)
+            db.executemany('UPDATE media SET probed = 0 WHERE path = ?', finished)
+        # Everything derived from a removed file, or from the previous version of a changed one
+        for path in [p for (p,) in gone] + [c[0] for c in changed if c[0] in known]:
+            forget_media(path, known[path]['fingerprint'])
+    library_ready.set()
+    if gone or changed: logger.info(f"Library: {len(changed)} new or changed, {len(gone)} removed, {len(found)} total")
+
+def forget_media(path, key):
+    """Deletes what the caches hold for a file that is gone or has changed. key is the fingerprint
+    key it was indexed under, or None if it never was."""
+    forget_probe(path)
+    if not key: return
+    stale = [os.path.join(THUMB_DIR, f"{key}.jpg"), os.path.join(CACHE_DIR, 'keyframes', f"{key}.json")]
+    subs_dir = os.path.join(CACHE_DIR, 'subs')
+    if os.path.isdir(subs_dir): stale.extend(os.path.join(subs_dir, name) for name in os.listdir(subs_dir) if name.startswith(f"{key}-"))
+    for stale_path in stale:
+        try: os.remove(stale_path)
+        except OSError: pass
+    with keyframe_lock: keyframe_cache.pop(key, None)
+    shutil.rmtree(os.path.join(SPRITE_DIR, key), ignore_errors=True)
+
+def make_poster(filepath, duration, key):
+    """Grabs a 320px wide frame at 10% of the runtime into THUMB_DIR. True if one was written."""
+    path = os.path.join(THUMB_DIR, f"{key}.jpg")
+    if os.path.exists(path): return True
+    os.makedirs(THUMB_DIR, exist_ok=True)
+    tmp_path = os.path.join(THUMB_DIR, f"{key}.{threading.get_ident()}.tmp.jpg")
+    cmd = ['ffmpeg', '-v', 'error', '-ss', str(duration * 0.1), '-i', media_input(filepath), '-frames:v', '1',
+           '-vf', 'scale=320:-2', '-q:v', '5', '-y', tmp_path]
+    try:
+        supervised_run(cmd, 'task', stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=60)
+        if not os.path.exists(tmp_path): return False
+        os.replace(tmp_path, path)
+        return True
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+def probe_library_batch(limit=8):
+    """Indexes the metadata of a few queued files. Returns how many were taken from the queue."""
+    db = library_db()
+    rows = db.execute('SELECT path, size, mtime_ns FROM media WHERE probed = 0 LIMIT ?', (limit,)).fetchall()
+    for row in rows:
+        path, current = row['path'], (row['path'], row['size'], row['mtime_ns'])
+        if get_partial(path):
+            with db: db.execute('UPDATE media SET probed = -1 WHERE path = ? AND size = ? AND mtime_ns = ?', current)
+            continue
+        try:
+            audio_tracks, sub_tracks, duration, _ = get_media_info(path)
+            video = next((st for st in probe_media(path).get('streams', []) if st['codec_type'] == 'video'), {})
+            values = (fingerprint_key(file_fingerprint(path)), duration, video.get('width'), video.get('height'),
+                      video.get('codec_name'), json.dumps(audio_tracks), json.dumps(sub_tracks))
+        except Exception as e:
+            logger.warning(f"Library could not index {path}: {e}")
+            values = (None,) * 7
+        # A file that changed meanwhile keeps its queued state and is probed again
+        with db:
+            db.execute('UPDATE media SET probed = 1, extras = 0, fingerprint = ?, duration = ?, width = ?, height = ?, video_codec = ?, '
+                       'audio_tracks = ?, subtitle_tracks = ? WHERE path = ? AND size = ? AND mtime_ns = ?', values + current)
+    return len(rows)
+
+def extras_library_batch():
+    """Decodes for one indexed file: keyframe summary (H.264 only), poster and sprite sheets. Yields to
+    streams: nothing is started while any transcode holds a slot. Returns how many files were taken."""
+    with scheduler_cond:
+        if transcode_jobs: return 0
+    db = library_db()
+    row = db.execute('SELECT path, size, mtime_ns, fingerprint, duration, video_codec FROM media '
+                     'WHERE extras = 0 AND probed = 1 LIMIT 1').fetchone()
+    if row is None: return 0
+    path, current, values = row['path'], (row['path'], row['size'], row['mtime_ns'], row['fingerprint']), (None, None, 0)
+    try:
+        if row['fingerprint'] and fingerprint_key(file_fingerprint(path)) != row['fingerprint']:
+            forget_media(path, row['fingerprint'])  # Replaced in place: index it again
+            with db: db.execute('UPDATE media SET probed = 0 WHERE path = ?', (path,))
+            return 1
+        if row['fingerprint'] and row['video_codec']:
+            times = load_keyframes(path) if row['video_codec'] == 'h264' else None
+            values = (len(times) if times else None, round(max((b - a for a, b in zip(times, times[1:])), default=0), 3) if times else None,
+                      int(bool(row['duration']) and make_poster(path, row['duration'], row['fingerprint'])))
+            build_sprites(path)
+    except Exception as e:
+        logger.warning(f"Library could not build previews of {path}: {e}")
+    with db:
+        db.execute('UPDATE media SET extras = 1, keyframes = ?, max_gop = ?, thumbnail = ? '
+                   'WHERE path = ? AND size = ? AND mtime_ns = ? AND fingerprint IS ?', values + current)
+    return 1
+
+def _library_scanner():
+    # inotify catches changes as they happen; the periodic rescan is then only a safety net
+    interval = LIBRARY_SCAN_INTERVAL * (10 if INotify else 1)
+    last_scan = 0
+    while True:
+        try:
+            if library_wakeup.is_set() or time.time() - last_scan >= interval:
+                library_wakeup.clear()
+                last_scan = time.time()
+                scan_library()
+            if probe_library_batch(): continue
+            if extras_library_batch(): continue  # Only once every queued file has its metadata
+        except Exception as e:
+            logger.error(f"Library scan error: {e}")
+        library_wakeup.wait(max(1, interval - (time.time() - last_scan)))
+
+def _library_watcher():
+    """Wakes the scanner on changes below DOWNLOAD_DIR; new subdirectories are watched as they appear."""
+    inotify = INotify()
+    mask = inotify_flags.CREATE | inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO | inotify_flags.MOVED_FROM | inotify_flags.DELETE
+    watched = {}  # directory -> watch descriptor
+    while True:
+        for root, _, _ in os.walk(DOWNLOAD_DIR):
+            if root not in watched:
+                try: watched[root] = inotify.add_watch(root, mask)
+                except OSError: pass
+        events = inotify.read(read_delay=1000)  # Coalesces bursts such as an archive being unpacked
+        gone = {e.wd for e in events if e.mask & inotify_flags.IGNORED}
+        watched = {d: wd for d, wd in watched.items() if wd not in gone}
+        library_wakeup.set()
+
+def query_library(q='', page=1, per_page=50, sort='name'):
+    """One page of the index, optionally filtered by a substring of the file name. Returns (total, rows)."""
+    where, args = '', []
+    if q:
+        where = "WHERE name LIKE ? ESCAPE '\\'"
+        args.append('%' + re.sub(r'([\\%_])', r'\\\1', q) + '%')
+    db = library_db()
+    total = db.execute(f'SELECT COUNT(*) FROM media {where}', args).fetchone()[0]
+    rows = db.execute(f'SELECT * FROM media {where} ORDER BY {LIBRARY_SORTS.get(sort, LIBRARY_SORTS["name"])} LIMIT ? OFFSET ?',
+                      args + [per_page, (page - 1) * per_page]).fetchall()
+    return total, rows
+
+def library_item(row):
+    """JSON-friendly view of an index row."""
+    return {
+        'path': row['path'], 'name': row['name'], 'size': row['size'], 'indexed': row['probed'] == 1,
+        'duration': row['duration'], 'duration_formatted': format_seconds(row['duration']) if row['duration'] else None,
+        'width': row['width'], 'height': row['height'], 'video_codec': row['video_codec'],
+        'audio_tracks': json.loads(row['audio_tracks']) if row['audio_tracks'] else {},
+        'subtitle_tracks': json.loads(row['subtitle_tracks']) if row['subtitle_tracks'] else {},
+        'keyframes': row['keyframes'], 'max_gop': row['max_gop'],
+        'thumbnail': f"/library/thumb/{row['fingerprint']}.jpg" if row['thumbnail'] else None,
+    }
+
+init_library()
+threading.Thread(target=_library_scanner, daemon=True).start()
+if INotify: threading.Thread(target=_library_watcher, daemon=True).start()
+
+# --- ASYNC SERVING CORE ---
+# The server is an asyncio HTTP/1.1 loop. Flask still handles every request, in a small thread pool,
+# but streaming routes answer with body objects (PipeBody, EventStreamBody, the file wrapper) that
+# the loop pumps itself: non-blocking pipe reads, sendfile, and writes that wait for the socket to
+# drain. A viewer therefore holds no thread while waiting on ffmpeg or on a slow network.
+# SERVER_CORE=waitress runs Waitress instead, where the same objects are plain blocking iterables
+# and every open stream holds a thread. The loop is meant to sit behind a reverse proxy, and rejects
+# request framing a proxy could read differently (conflicting Content-Length, Content-Length with
+# Transfer-Encoding).
+SERVER_CORE = os.environ.get('SERVER_CORE', 'asyncio')
+WSGI_THREADS = int(os.environ.get('WSGI_THREADS', '16'))
+KEEPALIVE_TIMEOUT = 75
+SEND_BUFFER = 256 * 1024  # Socket writes wait for the client once this much is queued
+REQUEST_BODY_MAX = int(os.environ.get('REQUEST_BODY_MAX_KB', '1024')) * 1024  # Larger bodies get 413
+HEADER_NAME = re.compile(r"[!#$%&'*+\-.^_`|~0-9A-Za-z]+")
+
+# Between ffmpeg and the client sits a bounded relay buffer. When the client stops taking data (a
+# paused tab, a slow link) and the buffer fills, the piped ffmpeg is suspended with SIGSTOP and
+# resumed with SIGCONT once the client has drained it to a quarter. For stream copy that is the
+# whole cost of the viewer. A transcoded stream pipes only a remuxer; its suspended remuxer stalls
+# feed_segments, and the shared segment encoder, no longer asked for segments, is stopped by the
+# HLS janitor after SEGMENT_IDLE_TIMEOUT. Without SIGSTOP (Windows) the relay just stops reading
+# and ffmpeg blocks on the full pipe. Under Waitress a reader thread fills the same buffer, since
+# Waitress stops asking the body for chunks once a client falls behind.
+RELAY_BUFFER = int(os.environ.get('RELAY_BUFFER_MB', '8')) * 1024 * 1024
+RELAY_RESUME = RELAY_BUFFER // 4
+active_relays = set()
+
+class PipeBody:
+    """Response body relaying a subprocess's stdout. on_data runs for every chunk, on_close once at the end."""
+    def __init__(self, process, on_data=None, on_close=None, chunk_size=65536):
+        self.process, self.on_data, self.on_close, self.chunk_size = process, on_data, on_close, chunk_size
+        self.closed = False
+        self.buffered, self.sent, self.suspended = 0, 0, False
+        self.client_gone = None  # Set by the serving core: returns True once the connection is dead
+        self.wakeup = threading.Condition()  # Guards the blocking relay's buffer; notified on close
+
+    def suspend(self, stop):
+        """Stops or continues the encoder; a no-op where the platform has no job control."""
+        if self.suspended == stop or not hasattr(signal, 'SIGSTOP') or self.process.poll() is not None: return
+        try: os.kill(self.process.pid, signal.SIGSTOP if stop else signal.SIGCONT)
+        except OSError: return
+        self.suspended = stop
+
+    def __iter__(self):
+        chunks, state = deque(), {'eof': False}
+
+        def pump():
+            try:
+                while not self.closed:
+                    data = self.process.stdout.read1(self.chunk_size)
+                    if not data: break
+                    with self.wakeup:
+                        chunks.append(data)
+                        self.buffered += len(data)
+                        self.wakeup.notify_all()
+                        if self.buffered >= RELAY_BUFFER:
+                            # The client is this far behind: park the encoder until it has caught up
+                            self.suspend(True)
+                            self.wakeup.wait_for(lambda: self.buffered <= RELAY_RESUME or self.closed)
+                            self.suspend(False)
+            except (OSError, ValueError): pass  # The pipe was closed under us
+            finally:
+                with self.wakeup:
+                    state['eof'] = True
+                    self.wakeup.notify_all()
+
+        threading.Thread(target=pump, daemon=True).start()
+        active_relays.add(self)
+        try:
+            while True:
+                with self.wakeup:
+                    self.wakeup.wait_for(lambda: chunks or state['eof'])
+                    if not chunks: break
+                    data = chunks.popleft()
+                    self.buffered -= len(data)
+                    if self.buffered <= RELAY_RESUME: self.wakeup.notify_all()
+                if self.on_data: self.on_data()
+                yield data
+                self.sent += len(data)
+        finally:
+            active_relays.discard(self)
+
+    async def stream(self, send):
+        loop = asyncio.get_running_loop()
+        if os.name == 'nt':
+            # The proactor loop cannot watch anonymous pipes; read them in a thread instead
+            while True:
+                data = await loop.run_in_executor(None, self.process.stdout.read1, self.chunk_size)
+                if not data: break
+                if self.on_data: self.on_data()
+                await send(data)
+            return
+        body, chunks, ready, state = self, deque(), asyncio.Event(), {'eof': False}
+
+        class RelayProtocol(asyncio.Protocol):
+            def connection_made(self, transport): self.transport = transport
+            def data_received(self, data):
+                chunks.append(data)
+                body.buffered += len(data)
+                ready.set()
+                if body.buffered >= RELAY_BUFFER:
+                    # The client is this far behind: stop reading and park the encoder
+                    self.transport.pause_reading()
+                    body.suspend(True)
+            def eof_received(self):
+                state['eof'] = True
+                ready.set()
+            def connection_lost(self, exc):
+                state['eof'] = True
+                ready.set()
+
+        transport, _ = await loop.connect_read_pipe(RelayProtocol, self.process.stdout)
+        active_relays.add(self)
+        try:
+            while True:
+                if not chunks:
+                    if state['eof']: break
+                    ready.clear()
+                    await ready.wait()
+                    continue
+                data = chunks.popleft()
+                self.buffered -= len(data)
+                if not transport.is_reading() and self.buffered <= RELAY_RESUME:
+                    self.suspend(False)
+                    transport.resume_reading()
+                if self.on_data: self.on_data()
+                await send(data)
+                self.sent += len(data)
+        finally:
+            active_relays.discard(self)
+            transport.close()
+
+    def close(self):
+        if self.closed: return
+        with self.wakeup:
+            self.closed = True
+            self.wakeup.notify_all()
+        if self.on_close: self.on_close()
+
+class EventStreamBody:
+    """Server-sent events body. poll() returns (payload or None, finished) and is called every interval seconds."""
+    def __init__(self, poll, interval=0.25):
+        self.poll, self.interval = poll, interval
+
+    def __iter__(self):
+        while True:
+            payload, finished = self.poll()
+            if payload is not None: yield f"data: {payload}\n\n".encode('utf-8')
+            if finished: break
+            time.sleep(self.interval)
+
+    async def stream(self, send):
+        while True:
+            payload, finished = self.poll()
+            if payload is not None: await send(f"data: {payload}\n\n".encode('utf-8'))
+            if finished: break
+            await asyncio.sleep(self.interval)
+
+    def close(self): pass
+
+class AsyncFileWrapper:
+    """wsgi.file_wrapper of the asyncio core: the file is handed to loop.sendfile, zero-copy where the OS allows."""
+    def __init__(self, f, block_size=8192):
+        self.f, self.block_size = f, block_size
+
+    def __iter__(self):
+        while True:
+            data = self.f.read(self.block_size)
+            if not data: break
+            yield data
+
+    async def stream(self, send, transport=None, length=None):
+        loop = asyncio.get_running_loop()
+        if transport is None or length is None:
+            while True:
+                data = await loop.run_in_executor(None, self.f.read, self.block_size)
+                if not data: break
+                await send(data)
+            return
+        await loop.sendfile(transport, self.f, self.f.tell(), length)
+
+    def close(self): self.f.close()
+
+def _wsgi_environ(method, target, version, headers, body, peer):
+    path, _, query = target.partition('?')
+    environ = {
+        'REQUEST_METHOD': method, 'SCRIPT_NAME': '', 'PATH_INFO': unquote_to_bytes(path).decode('latin-1'),
+        'QUERY_STRING': query, 'SERVER_PROTOCOL': version, 'SERVER_NAME': '0.0.0.0', 'SERVER_PORT': str(SERVER_PORT),
+        'REMOTE_ADDR': peer[0] if peer else '', 'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(body), 'wsgi.errors': sys.stderr, 'wsgi.multithread': True,
+        'wsgi.multiprocess': False, 'wsgi.run_once': False, 'wsgi.file_wrapper': AsyncFileWrapper,
+    }
+    for name, value in headers:
+        key = name.upper().replace('-', '_')
+        if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'): environ[key] = value
+        else:
+            key = 'HTTP_' + key
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    if 'HTTP_HOST' in environ: environ['SERVER_NAME'] = environ['HTTP_HOST'].rsplit(':', 1)[0]
+    return environ
+
+async def _respond(app, reader, writer, pool, method, target, version, headers, body, keep_alive):
+    """Runs one request through the WSGI app and writes the response. Returns whether the connection stays open."""
+    loop = asyncio.get_running_loop()
+    environ = _wsgi_environ(method, target, version, headers, body, writer.get_extra_info('peername'))
+    started = {}
+    def start_response(status, response_headers, exc_info=None):
+        started['status'], started['headers'] = status, response_headers
+        return lambda data: None  # The legacy write() callable is not supported
+    try:
+        app_iter = await loop.run_in_executor(pool, app, environ, start_response)
+    except Exception as e:
+        logger.error(f"Unhandled error for {target}: {e}")
+        writer.write(b"HTTP/1.1 500 Internal Server Error\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+        return False
+    closer = app_iter
+    try:
+        if 'status' not in started:
+            # start_response may be deferred to the first chunk of a generator
+            it = iter(app_iter)
+            first = await loop.run_in_executor(pool, next, it, None)
+            app_iter = itertools.chain([first] if first is not None else [], it)
+        status, response_headers = started['status'], list(started['headers'])
+        names = {name.lower() for name, _ in response_headers}
+        code = int(status.split(' ', 1)[0])
+        length = next((int(v) for n, v in response_headers if n.lower() == 'content-length'), None)
+        bodiless = method == 'HEAD' or code in (204, 304) or 100 <= code < 200
+        chunked = not bodiless and length is None and version == 'HTTP/1.1'
+        if not bodiless and length is None and not chunked: keep_alive = False  # HTTP/1.0: the body ends with the connection
+        if chunked: response_headers.append(('Transfer-Encoding', 'chunked'))
+        if 'date' not in names: response_headers.append(('Date', http_date(time.time())))
+        response_headers.append(('Connection', 'keep-alive' if keep_alive else 'close'))
+        head = f"HTTP/1.1 {status}\r\n" + ''.join(f"{n}: {v}\r\n" for n, v in response_headers) + "\r\n"
+        writer.write(head.encode('latin-1'))
+
+        async def send(data):
+            if not data: return
+            if chunked: writer.write(b'%x\r\n' % len(data))
+            writer.write(data)
+            if chunked: writer.write(b'\r\n')
+            await writer.drain()
+
+        if not bodiless:
+            if isinstance(app_iter, AsyncFileWrapper) and not chunked:
+                await writer.drain()
+                await app_iter.stream(send, writer.transport, length)
+            elif hasattr(app_iter, 'stream'):
+                # A stalled send never notices a vanished client; let the process supervisor ask instead
+                if hasattr(app_iter, 'client_gone'):
+                    app_iter.client_gone = lambda: reader.at_eof() or writer.transport.is_closing()
+                await app_iter.stream(send)
+            else:
+                # Any other body: each chunk is produced in the pool, the thread is free while the socket drains
+                it = iter(app_iter)
+                while True:
+                    data = await loop.run_in_executor(pool, next, it, None)
+                    if data is None: break
+                    await send(data)
+            if chunked: writer.write(b'0\r\n\r\n')
+        await writer.drain()
+        return keep_alive
+    except (ConnectionError, asyncio.IncompleteReadError):
+        return False  # The client went away mid-response
+    finally:
+        if hasattr(closer, 'close'): await loop.run_in_executor(pool, closer.close)
+
+class RequestError(Exception):
+    """A request the asyncio core answers itself, with this status, before closing the connection."""
+
+def _parse_head(head):
+    """(method, target, version, headers) of a request head; absolute-form targets become origin-form."""
+    request_line, *header_lines = head.decode('latin-1').rstrip('\r\n').split('\r\n')
+    try: method, target, version = request_line.split(' ')
+    except ValueError: raise RequestError('400 Bad Request')
+    if version not in ('HTTP/1.0', 'HTTP/1.1'): raise RequestError('505 HTTP Version Not Supported')
+    headers = []
+    for line in header_lines:
+        name, colon, value = line.partition(':')
+        # No whitespace before the colon and no folded lines: both are read differently by different parsers
+        if not colon or not HEADER_NAME.fullmatch(name): raise RequestError('400 Bad Request')
+        headers.append((name, value.strip()))
+    if not target.startswith('/') and target != '*':
+        url = urlparse(target)
+        if url.scheme not in ('http', 'https') or not url.netloc: raise RequestError('400 Bad Request')
+        # The authority of an absolute-form target replaces the Host header
+        headers = [(n, v) for n, v in headers if n.lower() != 'host'] + [('Host', url.netloc)]
+        target = (url.path or '/') + (f'?{url.query}' if url.query else '')
+    return method, target, version, headers
+
+def _body_framing(headers):
+    """Content-Length of a request body, or None for a chunked one."""
+    lengths = {v for n, v in headers if n.lower() == 'content-length'}
+    codings = [c.strip().lower() for n, v in headers if n.lower() == 'transfer-encoding' for c in v.split(',')]
+    if codings:
+        if lengths: raise RequestError('400 Bad Request')
+        if codings != ['chunked']: raise RequestError('501 Not Implemented')
+        return None
+    if len(lengths) > 1: raise RequestError('400 Bad Request')
+    length = lengths.pop() if lengths else '0'
+    if not re.fullmatch(r'[0-9]+', length): raise RequestError('400 Bad Request')
+    if int(length) > REQUEST_BODY_MAX: raise RequestError('413 Content Too Large')
+    return int(length)
+
+async def _read_chunked(reader):
+    body = bytearray()
+    while True:
+        size = (await reader.readuntil(b'\r\n'))[:-2].split(b';', 1)[0].strip()
+        if not re.fullmatch(rb'[0-9A-Fa-f]{1,16}', size): raise RequestError('400 Bad Request')
+        size = int(size, 16)
+        if len(body) + size > REQUEST_BODY_MAX: raise RequestError('413 Content Too Large')
+        if not size: break
+        body += await reader.readexactly(size)
+        if await reader.readexactly(2) != b'\r\n': raise RequestError('400 Bad Request')
+    while await reader.readuntil(b'\r\n') != b'\r\n': pass  # Trailer fields are ignored
+    return bytes(body)
+
+async def _serve_connection(app, pool, reader, writer):
+    writer.transport.set_write_buffer_limits(high=SEND_BUFFER)
+    try:
+        while True:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), KEEPALIVE_TIMEOUT)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+                break
+            try:
+                method, target, version, headers = _parse_head(head)
+                length = _body_framing(headers)
+                fields = {name.lower(): value for name, value in headers}
+                if fields.get('expect', '').lower() == '100-continue': writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+                reading = reader.readexactly(length) if length is not None else _read_chunked(reader)
+                body = await asyncio.wait_for(reading, KEEPALIVE_TIMEOUT)
+            except RequestError as e:
+                writer.write(f"HTTP/1.1 {e}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".encode('latin-1'))
+                await writer.drain()
+                break
+            connection = fields.get('connection', '').lower()
+            keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+            if not await _respond(app, reader, writer, pool, method, target, version, headers, body, keep_alive): break
+    except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+def serve_async(app, host, port):
+    """Runs the app on the asyncio core until interrupted."""
+    pool = ThreadPoolExecutor(max_workers=WSGI_THREADS, thread_name_prefix='wsgi')
+    async def main():
+        server = await asyncio.start_server(lambda r, w: _serve_connection(app, pool, r, w), host, port, limit=64 * 1024)
+        async with server: await server.serve_forever()
+    try: asyncio.run(main())
+    except KeyboardInterrupt: pass
+
+# ==========================================
+# ROUTES
+# ==========================================
+
+@app.before_request
+def load_session_id():
+    session_id = request.cookies.get(SESSION_COOKIE, '')
+    g.session_id = session_id if re.fullmatch(r'[0-9a-f]{32}', session_id) else None  # Assigned by get_stream_session
+
+@app.after_request
+def save_session_id(response):
+    if g.get('new_session'):
+        response.set_cookie(SESSION_COOKIE, g.session_id, httponly=True, samesite='Lax')
+    return response
+
+@app.route('/')
+def index():
+    return render_template('landing.html')
+
+@app.route('/assets/<name>')
+def static_asset(name):
+    """Content-hashed CSS/JS: immutable, in the smallest encoding the client accepts."""
+    asset = hashed_assets.get(name)
+    if not asset: return "Not found", 404
+    encoding = next((e for e in ('br', 'gzip') if e in asset['bodies'] and request.accept_encodings[e]), 'identity')
+    rv = Response(asset['bodies'][encoding], mimetype=asset['mimetype'])
+    if encoding != 'identity': rv.headers['Content-Encoding'] = encoding
+    rv.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    rv.headers['Vary'] = 'Accept-Encoding'
+    rv.set_etag(f"{asset['etag']}-{encoding}")
+    return rv.make_conditional(request)
+
+@app.route('/progress')
+def progress_check():
+    """Endpoint for polling download status of one job (default: the latest)."""
+    job = get_download_job(request.args.get('job'))
+    if not job: return jsonify({'progress': 0, 'status': 'Idle', 'msg': 'Waiting...', 'filename': ''})
+    return jsonify(job)
+
+@app.route('/progress/stream')
+def progress_stream():
+    """Server-sent events with the job state, pushed whenever it changes."""
+    job_id = request.args.get('job')
+    if not get_download_job(job_id): return "Unknown job", 404
+
+    last = [None]
+    def poll():
+        job = get_download_job(job_id)
+        if job is None: return None, True
+        payload = json.dumps(job)
+        changed = payload != last[0]
+        last[0] = payload
+        return (payload if changed else None), job['status'] in ('Done', 'Error', 'Cancelled')
+
+    return Response(EventStreamBody(poll), mimetype='text/event-stream', direct_passthrough=True,
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/jobs')
+def list_jobs():
+    with jobs_lock: return jsonify(list(download_jobs.values()))
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    if cancel_download_job(job_id): return jsonify({'status': 'ok'})
+    return jsonify({'status': 'error', 'message': 'Job is not running'}), 409
+
+@app.route('/jobs/<job_id>/retry', methods=['POST'])
+def retry_job(job_id):
+    if retry_download_job(job_id): return jsonify({'status': 'ok', 'job_id': job_id})
+    return jsonify({'status': 'error', 'message': 'Only failed or cancelled jobs can be retried'}), 409
+
+@app.route('/status')
+def server_status():
+    """Live capacity numbers: encoder slots, queue depth and sessions."""
+    with session_lock: session_count = len(stream_sessions)
+    pipelines = {mode: {'default': current_pipeline_level(mode), 'demoted': {}} for mode in AVAILABLE_HW_MODES}
+    for mode, codec, pix_fmt in list(pipeline_demotions):
+        if mode in pipelines: pipelines[mode]['demoted'][f"{codec}/{pix_fmt}"] = current_pipeline_level(mode, (codec, pix_fmt))
+    hardware = {'modes': list(AVAILABLE_HW_MODES), 'default': CURRENT_HW_MODE, 'detecting': not hw_detection_done.is_set()}
+    relays = list(active_relays)
+    relay_stats = {'active': len(relays), 'suspended': sum(r.suspended for r in relays), 'buffered': sum(r.buffered for r in relays)}
+    return jsonify({'transcodes': scheduler_status(), 'sessions': session_count, 'pipelines': pipelines, 'hardware': hardware, 'relays': relay_stats,
+                    'processes': supervisor_status()})
+
+@app.route('/process_url', methods=['POST'])
+def process_url():
+    """Queues a background download and returns its job id right away."""
+    url = request.form.get('url')
+    if not url: return jsonify({'status': 'error', 'message': 'Missing URL'})
+    return jsonify({'status': 'ok', 'job_id': submit_download_job(url)})
+
+def library_page_args():
+    """(q, page, per_page, sort) from the query string, clamped to sane values."""
+    try: page = max(1, int(request.args.get('page', 1)))
+    except ValueError: page = 1
+    try: per_page = min(LIBRARY_PAGE_MAX, max(1, int(request.args.get('per_page', 50))))
+    except ValueError: per_page = 50
+    return request.args.get('q', '').strip(), page, per_page, request.args.get('sort', 'name')
+
+def fresh_library():
+    """Waits for the first scan on a cold start instead of showing an empty library."""
+    if not library_ready.is_set(): scan_library()
 
 @app.route('/list_files')
 def list_files():
-    video_exts = ('.mp4', '.mkv', '.avi', '.mov', '.webm')
-    files = []
-    for root, dirs, filenames in os.walk(DOWNLOAD_DIR):
-        for f in filenames:
-            if f.lower().endswith(video_exts):
-                full_path = os.path.join(root, f)
-                files.append({'name': f, 'path': os.path.abspath(full_path)})
-    
-    if not files: return "No video files found in download.", 404
-    return render_template_string(SELECTION_TEMPLATE, files=files)
+    fresh_library()
+    q, page, per_page, sort = library_page_args()
+    total, rows = query_library(q, page, per_page, sort)
+    if not total and not q: return "No video files found in download.", 404
+    pages = max(1, (total + per_page - 1) // per_page)
+    return render_template('selection.html', files=[library_item(row) for row in rows], q=q, page=page, pages=pages, total=total, sort=sort)
+
+@app.route('/library')
+def library():
+    """Paginated, searchable JSON view of the media index."""
+    fresh_library()
+    q, page, per_page, sort = library_page_args()
+    total, rows = query_library(q, page, per_page, sort)
+    return jsonify({'total': total, 'page': page, 'per_page': per_page, 'items': [library_item(row) for row in rows]})
+
+@app.route('/library/thumb/<key>.jpg')
+def library_thumb(key):
+    """Poster frames are named by content fingerprint, so they never change under the same URL."""
+    if not re.fullmatch(r'[0-9a-f]{40}', key): return "Not found", 404
+    path = os.path.join(THUMB_DIR, f"{key}.jpg")
+    if not os.path.exists(path): return "Not found", 404
+    rv = send_file(os.path.abspath(path), mimetype='image/jpeg', conditional=True)
+    rv.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return rv
 
 @app.route('/set_and_play')
 def set_and_play():
-    global current_file_path
     mode = request.args.get('mode')
     path = request.args.get('path')
-    if os.path.exists(path):
-        current_file_path = path
+    if path and media_exists(path):
+        session = get_stream_session()
+        with session_lock:
+            if session['file'] != path: stop_session_process(session)
+            session['file'] = path
         if mode == 'simple': return redirect(url_for('simple_player'))
         return redirect(url_for('advanced_player'))
     return "File not found", 404
 
 @app.route('/play/advanced')
 def advanced_player():
-    if not current_file_path: return redirect(url_for('index'))
+    session = get_stream_session()
+    if not session['file']: return redirect(url_for('index'))
     # Load Metadata like original main.py
-    audio_tracks, sub_tracks, duration, _ = get_media_info(current_file_path)
+    audio_tracks, sub_tracks, duration, is_h264 = get_media_info(session['file'])
     
     # Safely select an audio track if available, else 'None'
     current_audio = request.args.get('audio_index')
@@ -738,31 +3246,37 @@ def advanced_player():
         current_audio = list(audio_tracks.keys())[0]
     elif not current_audio and not audio_tracks:
         current_audio = 'None'
+    stream_mode = request.args.get('stream', 'progressive')
+    if stream_mode not in ('progressive', 'hls'): stream_mode = 'progressive'
+    if is_h264: get_keyframes(session['file'])  # Start indexing now, copy-mode seeks will need it
+    get_sprites(session['file'])
     
-    return render_template_string(
-        ADVANCED_TEMPLATE, filename=os.path.basename(current_file_path),
+    return render_template(
+        'advanced.html', filename=os.path.basename(session['file']),
         audio_tracks=audio_tracks, sub_tracks=sub_tracks, current_audio=current_audio,
-        current_quality="original", duration=duration, duration_formatted=format_seconds(duration),
-        start_time=0, hw_modes=AVAILABLE_HW_MODES, current_hw=CURRENT_HW_MODE
+        current_quality=session['quality'], duration=duration, duration_formatted=format_seconds(duration),
+        start_time=0, hw_modes=AVAILABLE_HW_MODES, current_hw=session['hw'], stream_mode=stream_mode
     )
 
 @app.route('/play/simple')
 def simple_player():
-    if not current_file_path: return redirect(url_for('index'))
+    session = get_stream_session()
+    if not session['file']: return redirect(url_for('index'))
     # Simple needs duration for UI
-    _, _, duration, _ = get_media_info(current_file_path)
-    return render_template_string(
-        SIMPLE_TEMPLATE, 
-        duration_formatted=format_seconds(duration)
+    _, _, duration, _ = get_media_info(session['file'])
+    return render_template(
+        'simple.html', 
+        duration_formatted=format_seconds(duration),
+        # A file that is still downloading changes identity on completion, so it cannot use the cacheable URL
+        media_url='/raw_stream' if get_partial(session['file']) else media_url(session['file'])
     )
 
 # --- ADVANCED PLAYER ROUTES (UNCHANGED LOGIC) ---
 @app.route('/set_hw')
 def set_hw():
-    global CURRENT_HW_MODE
     new_mode = request.args.get('mode')
     if new_mode in AVAILABLE_HW_MODES:
-        CURRENT_HW_MODE = new_mode
+        get_stream_session()['hw'] = new_mode
         logger.info(f"Switched Hardware Engine to: {AVAILABLE_HW_MODES[new_mode]}")
         return "OK"
     return "Invalid", 400
@@ -772,136 +3286,232 @@ def subtitle_feed():
     sub_index = request.args.get('index')
     start_time = float(request.args.get('start', '0'))
     offset = float(request.args.get('offset', '0'))
-    if not current_file_path or not sub_index: return "Error", 400
-    adjusted = max(0, start_time - offset)
-    cmd = ['ffmpeg', '-ss', str(adjusted), '-i', current_file_path, '-map', f'0:{sub_index}', '-vn', '-an', '-f', 'webvtt', '-loglevel', 'error', 'pipe:1']
+    filepath = get_stream_session()['file']
+    if not filepath or not sub_index: return "Error", 400
     try:
-        startupinfo = None
-        if os.name == 'nt': startupinfo = subprocess.STARTUPINFO(); startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, startupinfo=startupinfo)
-        out, _ = proc.communicate()
-        return Response(out, mimetype='text/vtt')
-    except: return "Error", 500
+        entry = get_subtitle_cues(filepath, sub_index)
+        return Response(render_subtitle_window(entry, start_time, offset), mimetype='text/vtt')
+    except Exception as e:
+        logger.error(f"Subtitle Error: {e}")
+        return "Error", 500
+
+@app.route('/seek_point')
+def seek_point():
+    """Where a /video_feed started at `start` will really begin: the keyframe before it in copy
+    mode, the segment boundary before it when transcoding."""
+    filepath = get_stream_session()['file']
+    start_time = float(request.args.get('start', '0'))
+    if not filepath: return "No file", 404
+    _, _, _, is_h264 = get_media_info(filepath)
+    if request.args.get('quality') != 'original' or not is_h264:
+        # Transcoded streams come from the segment cache and start on a segment boundary
+        return jsonify({'start': (start_time // SEGMENT_DURATION) * SEGMENT_DURATION, 'keyframe': True})
+    keyframe = snap_to_keyframe(filepath, start_time)
+    return jsonify({'start': start_time if keyframe is None else keyframe, 'keyframe': keyframe is not None})
+
+@app.route('/preroll')
+def preroll():
+    """Speculative start at the seek bar position being dragged to, so the seek that follows is instant."""
+    session = get_stream_session()
+    filepath = session['file']
+    if not filepath: return "No file", 404
+    start_time = float(request.args.get('start', '0'))
+    audio_index = request.args.get('audio_index', '1')
+    quality = request.args.get('quality', 'original')
+    is_hls = request.args.get('stream') == 'hls'
+    audio_tracks, _, _, is_h264 = get_media_info(filepath)
+
+    if not is_hls and quality == 'original' and is_h264:
+        keyframe = snap_to_keyframe(filepath, start_time)
+        if keyframe is not None: start_time = keyframe
+        cmd = direct_stream_cmd(filepath, start_time, audio_index, audio_tracks, quality, is_h264, session['hw'])
+        with session_lock: start_preroll(session, cmd)
+        return jsonify({'status': 'ok', 'start': start_time})
+
+    n = int(start_time // SEGMENT_DURATION)
+    discard_warm_segments(session)  # Only the latest drag position is worth an encoder
+    if is_hls:
+        hw_mode = request.args.get('hw', session['hw'])
+        if hw_mode not in AVAILABLE_HW_MODES: hw_mode = session['hw']
+        warm_segment(session, get_hls_variant(filepath, None, quality, hw_mode), n)
+        if audio_index in audio_tracks: warm_segment(session, get_hls_variant(filepath, audio_index, 'audio', None), n)
+    else:
+        if quality == 'auto': quality = '720p'
+        warm_segment(session, get_hls_variant(filepath, audio_index, quality, session['hw']), n)
+    return jsonify({'status': 'ok', 'start': n * SEGMENT_DURATION})
 
 @app.route('/video_feed')
 def video_feed():
-    global current_file_path
-    if not current_file_path: return "No file", 404
+    session = get_stream_session()
+    filepath = session['file']
+    if not filepath: return "No file", 404
     audio_index = request.args.get('audio_index', '1')
-    start_time = request.args.get('start', '0')
+    start_time = float(request.args.get('start', '0'))
     quality = request.args.get('quality', 'original')
-    session_id = 'video_stream'
+    session['quality'] = quality
+    if quality == 'auto': quality = '720p'  # The bitrate ladder needs HLS; a single stream gets the middle rung
 
-    with process_lock:
-        if session_id in active_processes:
-            try: active_processes[session_id].kill()
-            except: pass
+    # One encoder per session: a new request (seek, quality or audio change) replaces the old one
+    with session_lock: stop_session_process(session)
 
     # Get media info to check audio existence
-    audio_tracks, _, _, is_h264 = get_media_info(current_file_path)
-    
-    input_flags = ['-ss', str(start_time)]
-    cmd = ['ffmpeg'] + input_flags + ['-i', current_file_path, '-map', '0:v:0']
-
-    # --- AUDIO CHECK ---
-    # Only map audio if valid tracks exist and index is valid
-    if audio_tracks and audio_index in audio_tracks:
-        cmd.extend(['-map', f'0:{audio_index}'])
-        # Transcode audio to Stereo AAC
-        cmd.extend(['-c:a', 'aac', '-ac', '2', '-b:a', '192k'])
+    audio_tracks, _, duration, is_h264 = get_media_info(filepath)
+
+    # Transcoded streams are served from the segment cache. A range that is cached or already
+    # being encoded for someone else needs no encoder slot of its own.
+    variant_id = None
+    if not (quality == 'original' and is_h264):
+        variant_id = get_hls_variant(filepath, audio_index, quality, session['hw'])
+    job = None
+    if not (variant_id and hls_segment_available(variant_id, int(start_time // SEGMENT_DURATION))):
+        job, quality = schedule_stream(g.session_id, quality, is_h264)
+        if quality is None:
+            logger.warning("Transcode queue full, rejecting stream request")
+            return Response("Server busy", 503, headers={'Retry-After': '5'})
+        variant_id = None if quality == 'original' and is_h264 else get_hls_variant(filepath, audio_index, quality, session['hw'])
+    session['job'] = job
+
+    if variant_id:
+        # Segments are MPEG-TS with continuous timestamps: they are concatenated and only remuxed
+        first = int(start_time // SEGMENT_DURATION)
+        start_time = first * SEGMENT_DURATION
+        cmd = ['ffmpeg', '-f', 'mpegts', '-i', 'pipe:0', '-map', '0', '-c', 'copy',
+               '-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-loglevel', 'warning', 'pipe:1']
     else:
-        # No audio track? Do not map audio.
-        logger.info("No audio track detected or selected. Streaming video only.")
-        # If no audio, just video flags
-    
-    cmd.extend(get_video_codec_flags(quality, is_h264))
-    
-    cmd.extend(['-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-loglevel', 'warning', 'pipe:1'])
+        # Stream copy starts on the keyframe before -ss; start exactly there so the player's clock is right
+        keyframe = snap_to_keyframe(filepath, start_time)
+        if keyframe is not None: start_time = keyframe
+        cmd = direct_stream_cmd(filepath, start_time, audio_index, audio_tracks, quality, is_h264, session['hw'])
 
-    print(f"Executing: {' '.join(cmd)}") 
+    logger.debug(f"Executing: {' '.join(cmd)}")
 
-    startupinfo = None
-    if os.name == 'nt': 
-        startupinfo = subprocess.STARTUPINFO()
-        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-
-    def generate():
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=sys.stderr, bufsize=65536, startupinfo=startupinfo)
-        with process_lock: active_processes[session_id] = process
+    def feed_segments(process):
+        """Writes segments into the remuxer, encoding (or joining the encode of) missing ones."""
+        held = job
         try:
-            while True:
-                data = process.stdout.read(65536)
-                if not data: break
-                yield data
-        except Exception as e:
-            logger.error(f"Stream Error: {e}")
+            for n in range(first, max(1, int(-(-duration // SEGMENT_DURATION)))):
+                path = get_hls_segment(variant_id, n, held)
+                held = None
+                if not path: break
+                with open(path, 'rb') as f: shutil.copyfileobj(f, process.stdin)
+        except (OSError, ValueError):
+            pass  # The remuxer is gone: the viewer left or seeked
         finally:
-            process.kill()
+            try: process.stdin.close()
+            except OSError: pass
+
+    with session_lock: prerolled = None if variant_id else take_preroll(session, cmd)
+    if prerolled: logger.info("Adopting pre-rolled stream")
+
+    process = prerolled or spawn(cmd, 'stream', stdin=subprocess.PIPE if variant_id else None, stdout=subprocess.PIPE,
+                                 stderr=sys.stderr, bufsize=65536)
+    with session_lock: session['process'] = process
+    if variant_id: threading.Thread(target=feed_segments, args=(process,), daemon=True).start()
+
+    def touch(): session['last_seen'] = time.time()
+
+    def finish():
+        process.kill()
+        with session_lock:
+            if session['process'] is process: session['process'] = None
+        release_transcode(job)
+
+    body = PipeBody(process, on_data=touch, on_close=finish)
+    watch_client(process, lambda: not body.closed and not (body.client_gone and body.client_gone()))
+    response = Response(body, mimetype='video/mp4', direct_passthrough=True)
+    response.headers['X-Stream-Quality'] = quality
+    response.headers['X-Start-Time'] = f"{start_time:.3f}"
+    return response
+
+@app.route('/seek_preview')
+def seek_preview():
+    """Where the seek-preview map of the current file lives; 202 while it is still being built."""
+    filepath = get_stream_session()['file']
+    if not filepath or not media_exists(filepath): return jsonify({'status': 'none'}), 404
+    if get_partial(filepath): return jsonify({'status': 'unavailable'})  # Built once the download is complete
+    key = get_sprites(filepath)
+    if not key: return jsonify({'status': 'building'}), 202
+    return jsonify({'status': 'ready', 'vtt': f"/sprites/{key}/thumbnails.vtt"})
+
+@app.route('/sprites/<key>/<name>')
+def sprite_file(key, name):
+    """Sprite sheets and their map, content-addressed by the file's fingerprint."""
+    if not re.fullmatch(r'[0-9a-f]{40}', key) or not re.fullmatch(r'sheet_\d{3}\.jpg|thumbnails\.vtt', name): return "Not found", 404
+    path = os.path.join(SPRITE_DIR, key, name)
+    if not os.path.exists(path): return "Not found", 404
+    cache_last_used[os.path.abspath(os.path.join(SPRITE_DIR, key))] = time.time()
+    rv = send_file(os.path.abspath(path), mimetype='text/vtt' if name.endswith('.vtt') else 'image/jpeg', conditional=True)
+    rv.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return rv
 
-    return Response(generate(), mimetype='video/mp4')
+# --- SEGMENTED PLAYER ROUTES (HLS) ---
+@app.route('/hls/playlist.m3u8')
+def hls_playlist():
+    session = get_stream_session()
+    if not session['file']: return "No file", 404
+    audio_index = request.args.get('audio_index', '1')
+    quality = request.args.get('quality', 'original')
+    hw_mode = request.args.get('hw', session['hw'])
+    if hw_mode not in AVAILABLE_HW_MODES: hw_mode = session['hw']
+    session['quality'] = quality
+    audio_tracks, _, _, _ = get_media_info(session['file'])
+    # Video is encoded without audio; every audio track is its own rendition
+    variant_id = get_hls_variant(session['file'], None, quality, hw_mode)
+    audio_variants = {index: get_hls_variant(session['file'], index, 'audio', None) for index in audio_tracks}
+    with session_lock:
+        for vid in [variant_id] + list(audio_variants.values()): hls_variants[vid]['sessions'].add(g.session_id)
+    return Response(build_master_playlist(variant_id, audio_variants, audio_index), mimetype='application/vnd.apple.mpegurl')
+
+@app.route('/hls/<variant_id>/index.m3u8')
+@app.route('/hls/<variant_id>/<rendition>/index.m3u8')
+def hls_media_playlist(variant_id, rendition=None):
+    """Media playlist of a variant, or of one rung of an 'auto' variant."""
+    variant = hls_variants.get(variant_id)
+    renditions = [r['name'] for r in variant['renditions']] if variant and variant['renditions'] else [None]
+    if not variant or rendition not in renditions: return "Not found", 404
+    touch_variant_sessions(variant_id)
+    _, _, duration, _ = get_media_info(variant['path'])
+    return Response(build_hls_playlist(variant_id, duration, rendition), mimetype='application/vnd.apple.mpegurl')
+
+@app.route('/hls/<variant_id>/<int:n>.ts')
+@app.route('/hls/<variant_id>/<rendition>/<int:n>.ts')
+def hls_segment(variant_id, n, rendition=None):
+    touch_variant_sessions(variant_id)
+    path = get_hls_segment(variant_id, n, rendition=rendition)
+    if not path: return Response("Segment unavailable", 503, headers={'Retry-After': '2'})
+    return send_file(path, mimetype='video/mp2t')
+
+@app.route('/internal/partial/<token>')
+def partial_feed(token):
+    """Loopback source FFmpeg reads while a file is still downloading (see media_input)."""
+    if request.remote_addr not in ('127.0.0.1', '::1'): return "Forbidden", 403
+    filepath = partial_tokens.get(token)
+    if not filepath or not os.path.exists(filepath): return "Not found", 404
+    return serve_media_file(filepath, 'no-store')
 
 # --- SIMPLE PLAYER ROUTE (Raw Range Requests) ---
 @app.route('/raw_stream')
 def raw_stream():
-    """Serves the raw file using a generator to prevent RAM spikes."""
-    if not current_file_path: return "No file", 404
-    
-    file_size = os.path.getsize(current_file_path)
-    range_header = request.headers.get('Range', None)
-
-    # If no range header, send the whole file (flask send_file handles streaming automatically)
-    if not range_header:
-        return send_file(current_file_path)
-
-    # Parse Range Header
-    byte1, byte2 = 0, None
-    m = re.search(r'(\d+)-(\d*)', range_header)
-    g = m.groups()
-
-    if g[0]: byte1 = int(g[0])
-    if g[1]: byte2 = int(g[1])
-
-    # Calculate length
-    if byte2 is not None:
-        length = byte2 + 1 - byte1
-    else:
-        length = file_size - byte1
-
-    # generator to stream file in 8KB chunks
-    def generate():
-        try:
-            with open(current_file_path, 'rb') as f:
-                f.seek(byte1)
-                remaining = length
-                chunk_size = 8192 
-                while remaining > 0:
-                    # Read whichever is smaller: the standard chunk or remaining bytes
-                    read_size = min(chunk_size, remaining)
-                    data = f.read(read_size)
-                    if not data:
-                        break
-                    remaining -= len(data)
-                    yield data
-        except Exception as e:
-            logger.error(f"Stream Error: {e}")
-
-    # Set byte2 for the header if it was None
-    end_byte = byte2 if byte2 is not None else file_size - 1
-
-    rv = Response(
-        generate(), 
-        206, 
-        mimetype=mimetypes.guess_type(current_file_path)[0], 
-        direct_passthrough=True
-    )
-    rv.headers.add('Content-Range', f'bytes {byte1}-{end_byte}/{file_size}')
-    rv.headers.add('Accept-Ranges', 'bytes')
+    """Serves the session's file with Range support. The URL depends on the session cookie, so it is never shared-cached."""
+    filepath = get_stream_session()['file']
+    if not filepath: return "No file", 404
+    rv = serve_media_file(filepath, 'private, no-cache')
+    rv.headers['Vary'] = 'Cookie'
     return rv
 
+@app.route('/media/<key>/<path:name>')
+def media_file(key, name):
+    """Content-addressed copy of /raw_stream that browsers and CDNs may cache indefinitely."""
+    filepath = media_paths_by_key.get(key)
+    if not filepath or not media_exists(filepath) or fingerprint_key(file_fingerprint(filepath)) != key:
+        return "Not found", 404
+    return serve_media_file(filepath, 'public, max-age=31536000, immutable')
+
 if __name__ == '__main__':
     print("---------------------------------------")
     print(" 🚀 UNIFIED PLAYER LAUNCHED")
-    print(f" Available Modes: {list(AVAILABLE_HW_MODES.keys())}")
-    print(" Go to: http://127.0.0.1:5500")
+    print(f" Available Modes: {list(AVAILABLE_HW_MODES.keys())}{'' if hw_detection_done.is_set() else ' (hardware scan running)'}")
+    print(f" Go to: http://127.0.0.1:{SERVER_PORT}")
     print("---------------------------------------")
-    serve(app, host='0.0.0.0', port=5500, threads=10)
\ No newline at end of file
+    if SERVER_CORE == 'waitress': serve(app, host='0.0.0.0', port=SERVER_PORT, threads=10)
+    else: serve_async(app, '0.0.0.0', SERVER_PORT)
\ No newline at end of file
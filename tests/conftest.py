@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# main.py creates its download and cache directories in the working directory on import
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp(prefix='web-player-tests-'))
@@ -0,0 +1,110 @@
+import pytest
+
+import main
+
+QUALITY_HEIGHTS = {'original': [None], '1080p': [1080], '720p': [720], 'auto': [r[1] for r in main.ABR_LADDER]}
+HW_ENCODERS = {mode: encoder for mode, encoder, _ in main.HW_CANDIDATES}
+ON_DEVICE = ('nvenc', 'qsv')  # Modes whose full pipeline keeps frames in device memory
+
+
+@pytest.fixture(autouse=True)
+def all_modes(monkeypatch):
+    """Every hardware mode counts as available and nothing has been demoted yet."""
+    modes = {'cpu': 'CPU (Software)'}
+    modes.update((mode, label) for mode, _, label in main.HW_CANDIDATES)
+    monkeypatch.setattr(main, 'AVAILABLE_HW_MODES', modes)
+    monkeypatch.setattr(main, 'pipeline_demotions', {})
+
+
+def test_chains():
+    assert main.pipeline_chain('cpu') == ['software']
+    for mode in HW_ENCODERS:
+        assert main.pipeline_chain(mode) == ['full', 'encode', 'software']
+
+
+def test_unavailable_mode_is_software_only(monkeypatch):
+    monkeypatch.setattr(main, 'AVAILABLE_HW_MODES', {'cpu': 'CPU (Software)'})
+    assert main.pipeline_chain('nvenc') == ['software']
+
+
+@pytest.mark.parametrize('quality', QUALITY_HEIGHTS)
+@pytest.mark.parametrize('mode', ['cpu'] + list(HW_ENCODERS))
+def test_command_graphs(mode, quality):
+    heights = QUALITY_HEIGHTS[quality]
+    for level in main.pipeline_chain(mode):
+        input_args, graph, encoder_args = main.build_video_pipeline(mode, level, heights)
+        codec = encoder_args[encoder_args.index('-c:v') + 1]
+
+        if level == 'full':
+            decode = main.HW_PIPELINES[mode]['decode']
+            assert input_args[:len(decode)] == decode
+            assert input_args[:2] == ['-hwaccel', input_args[1]]
+        else:
+            assert '-hwaccel' not in input_args
+        assert input_args[-2:] == ['-threads', str(main.encoder_threads())]
+        assert codec == ('libx264' if level == 'software' else HW_ENCODERS[mode])
+
+        on_device = level == 'full' and mode in ON_DEVICE
+        assert ('-pix_fmt' in encoder_args) != on_device
+        scale = main.HW_PIPELINES[mode]['scale'] if on_device else 'scale=-2:{height}'
+        for i, height in enumerate(heights):
+            assert f"{scale.format(height=height) if height else 'null'}[v{i}]" in graph
+        if len(heights) > 1:
+            assert graph.startswith(f'[0:v:0]split={len(heights)}')
+        else:
+            assert graph.startswith('[0:v:0]')
+
+
+def test_demotion_walks_the_chain():
+    source = ('hevc', 'yuv420p10le')
+    assert main.current_pipeline_level('nvenc', source) == 'full'
+    assert main.demote_pipeline('nvenc', 'full', source)
+    assert main.current_pipeline_level('nvenc', source) == 'encode'
+    assert main.demote_pipeline('nvenc', 'encode', source)
+    assert main.current_pipeline_level('nvenc', source) == 'software'
+    assert not main.demote_pipeline('nvenc', 'software', source)
+    assert main.current_pipeline_level('nvenc', source) == 'software'
+
+
+def test_demotion_is_per_source():
+    assert main.demote_pipeline('qsv', 'full', ('hevc', 'yuv420p10le'))
+    assert main.current_pipeline_level('qsv', ('h264', 'yuv420p')) == 'full'
+    assert main.current_pipeline_level('nvenc', ('hevc', 'yuv420p10le')) == 'full'
+
+
+def test_late_failure_does_not_undo_a_deeper_demotion():
+    source = ('h264', 'yuv420p')
+    main.demote_pipeline('amf', 'encode', source)
+    assert main.demote_pipeline('amf', 'full', source)
+    assert main.current_pipeline_level('amf', source) == 'software'
+
+
+def test_cpu_cannot_be_demoted():
+    assert not main.demote_pipeline('cpu', 'software')
+
+
+@pytest.mark.parametrize('stderr', [
+    '[h264 @ 0x55] No device available for decoder: device type cuda needed for codec h264.',
+    'Device creation failed: -12.\nFailed to set value \'cuda\' for option \'hwaccel\'',
+    '[Parsed_scale_cuda_0 @ 0x5] Unsupported input format: yuv420p10le\nError reinitializing filters!',
+    '[h264_qsv @ 0x7] Error initializing an internal MFX session: unsupported (-3)',
+    'Impossible to convert between the formats supported by the filter \'Parsed_null_0\' and the filter \'auto_scale_0\'',
+])
+def test_device_failures_are_recognised(stderr):
+    assert main.hardware_failure(stderr)
+
+
+@pytest.mark.parametrize('stderr', [
+    'http://127.0.0.1:5500/internal/partial/abc: Connection timed out',
+    '[matroska,webm @ 0x5] EBML header parsing failed\nInvalid data found when processing input',
+    '',
+])
+def test_source_failures_do_not_demote(stderr):
+    assert not main.hardware_failure(stderr)
+
+
+def test_encoder_flags_carry_no_scaling():
+    for mode in ['cpu'] + list(HW_ENCODERS):
+        assert '-vf' not in main.video_encoder_flags(mode)
+    assert main.get_video_codec_flags('720p', False, 'nvenc') == main.video_encoder_flags('nvenc') + ['-vf', 'scale=-2:720']
+    assert main.get_video_codec_flags('original', True, 'nvenc') == ['-c:v', 'copy']
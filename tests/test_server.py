@@ -0,0 +1,185 @@
+import asyncio
+import json
+import signal
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import main
+
+
+def echo_app(environ, start_response):
+    """Answers with what the server handed to the WSGI app."""
+    body = json.dumps({
+        'method': environ['REQUEST_METHOD'], 'path': environ['PATH_INFO'], 'query': environ['QUERY_STRING'],
+        'host': environ.get('HTTP_HOST'), 'body': environ['wsgi.input'].read().decode('latin-1'),
+    }).encode()
+    start_response('200 OK', [('Content-Type', 'application/json'), ('Content-Length', str(len(body)))])
+    return [body]
+
+
+def exchange(raw, app=echo_app):
+    """Sends raw bytes to a fresh asyncio core and returns everything it answers until it closes."""
+    async def run():
+        pool = ThreadPoolExecutor(max_workers=2)
+        server = await asyncio.start_server(lambda r, w: main._serve_connection(app, pool, r, w), '127.0.0.1', 0, limit=64 * 1024)
+        async with server:
+            reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+            writer.write(raw)
+            data = await asyncio.wait_for(reader.read(), 10)
+            writer.close()
+        pool.shutdown()
+        return data
+    return asyncio.run(run())
+
+
+def responses(data):
+    """(status line, JSON body) of each fixed-length response in data."""
+    result = []
+    while data:
+        head, _, data = data.partition(b'\r\n\r\n')
+        status, *lines = head.decode('latin-1').split('\r\n')
+        length = next((int(line.split(':', 1)[1]) for line in lines if line.lower().startswith('content-length:')), 0)
+        body, data = data[:length], data[length:]
+        result.append((status, json.loads(body) if body else None))
+    return result
+
+
+def parse(head):
+    return main._parse_head(head.encode('latin-1'))
+
+
+def test_parse_head():
+    method, target, version, headers = parse('GET /feed?x=1 HTTP/1.1\r\nHost: a\r\nX-Y:  z \r\n\r\n')
+    assert (method, target, version) == ('GET', '/feed?x=1', 'HTTP/1.1')
+    assert headers == [('Host', 'a'), ('X-Y', 'z')]
+
+
+def test_absolute_form_replaces_host():
+    _, target, _, headers = parse('GET http://example.com:8080/a/b?q=2 HTTP/1.1\r\nHost: other\r\n\r\n')
+    assert target == '/a/b?q=2'
+    assert headers == [('Host', 'example.com:8080')]
+    assert parse('GET http://example.com HTTP/1.1\r\n\r\n')[1] == '/'
+
+
+@pytest.mark.parametrize('head, status', [
+    ('GET /\r\n\r\n', '400 Bad Request'),
+    ('GET / HTTP/2.0\r\n\r\n', '505 HTTP Version Not Supported'),
+    ('GET / HTTP/1.1\r\nHost : a\r\n\r\n', '400 Bad Request'),
+    ('GET / HTTP/1.1\r\nHost: a\r\n folded\r\n\r\n', '400 Bad Request'),
+    ('GET / HTTP/1.1\r\nno colon\r\n\r\n', '400 Bad Request'),
+    ('GET ftp://example.com/ HTTP/1.1\r\n\r\n', '400 Bad Request'),
+    ('GET example.com/ HTTP/1.1\r\n\r\n', '400 Bad Request'),
+])
+def test_malformed_heads(head, status):
+    with pytest.raises(main.RequestError) as e:
+        parse(head)
+    assert str(e.value) == status
+
+
+def test_body_framing():
+    assert main._body_framing([]) == 0
+    assert main._body_framing([('Content-Length', '12')]) == 12
+    assert main._body_framing([('Content-Length', '12'), ('content-length', '12')]) == 12  # Repeats that agree
+    assert main._body_framing([('Transfer-Encoding', 'chunked')]) is None
+
+
+@pytest.mark.parametrize('headers, status', [
+    ([('Content-Length', '1'), ('Content-Length', '2')], '400 Bad Request'),
+    ([('Content-Length', '+5')], '400 Bad Request'),
+    ([('Content-Length', '0x10')], '400 Bad Request'),
+    ([('Content-Length', '5'), ('Transfer-Encoding', 'chunked')], '400 Bad Request'),
+    ([('Transfer-Encoding', 'gzip, chunked')], '501 Not Implemented'),
+    ([('Content-Length', str(main.REQUEST_BODY_MAX + 1))], '413 Content Too Large'),
+])
+def test_rejected_framing(headers, status):
+    with pytest.raises(main.RequestError) as e:
+        main._body_framing(headers)
+    assert str(e.value) == status
+
+
+def read_chunked(data):
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return await main._read_chunked(reader)
+    return asyncio.run(run())
+
+
+def test_read_chunked():
+    assert read_chunked(b'5\r\nhello\r\n6;ext=1\r\n world\r\n0\r\n\r\n') == b'hello world'
+    assert read_chunked(b'0\r\nTrailer: x\r\n\r\n') == b''
+
+
+@pytest.mark.parametrize('data, status', [
+    (b'zz\r\nhello\r\n0\r\n\r\n', '400 Bad Request'),
+    (b'5\r\nhelloXX0\r\n\r\n', '400 Bad Request'),
+    (b'%x\r\n' % (main.REQUEST_BODY_MAX + 1), '413 Content Too Large'),
+])
+def test_rejected_chunks(data, status):
+    with pytest.raises(main.RequestError) as e:
+        read_chunked(data)
+    assert str(e.value) == status
+
+
+def test_keep_alive_and_bodies():
+    data = exchange(
+        b'POST /a HTTP/1.1\r\nHost: h\r\nContent-Length: 3\r\n\r\nabc'
+        b'POST /b HTTP/1.1\r\nHost: h\r\nTransfer-Encoding: chunked\r\n\r\n2\r\nxy\r\n1\r\nz\r\n0\r\n\r\n'
+        b'GET http://proxy.example/c?d=1 HTTP/1.1\r\nHost: h\r\nConnection: close\r\n\r\n')
+    (s1, r1), (s2, r2), (s3, r3) = responses(data)
+    assert s1 == s2 == s3 == 'HTTP/1.1 200 OK'
+    assert (r1['path'], r1['body']) == ('/a', 'abc')
+    assert (r2['path'], r2['body']) == ('/b', 'xyz')
+    assert (r3['path'], r3['query'], r3['host']) == ('/c', 'd=1', 'proxy.example')
+
+
+@pytest.mark.parametrize('raw, status', [
+    (b'POST / HTTP/1.1\r\nContent-Length: 3\r\nContent-Length: 4\r\n\r\nabcd', '400 Bad Request'),
+    (b'POST / HTTP/1.1\r\nContent-Length: 3\r\nTransfer-Encoding: chunked\r\n\r\n0\r\n\r\n', '400 Bad Request'),
+    (b'POST / HTTP/1.1\r\nContent-Length: %d\r\n\r\n' % (main.REQUEST_BODY_MAX + 1), '413 Content Too Large'),
+])
+def test_rejected_requests_close_the_connection(raw, status):
+    # A second request on the same connection is never answered
+    data = exchange(raw + b'GET / HTTP/1.1\r\n\r\n')
+    assert responses(data) == [(f'HTTP/1.1 {status}', None)]
+
+
+def test_chunked_response_and_flask_app():
+    def stream_app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return iter([b'one', b'', b'two'])
+    data = exchange(b'GET / HTTP/1.1\r\nConnection: close\r\n\r\n', stream_app)
+    head, _, body = data.partition(b'\r\n\r\n')
+    assert b'Transfer-Encoding: chunked' in head
+    assert body == b'3\r\none\r\n3\r\ntwo\r\n0\r\n\r\n'
+
+    data = exchange(b'GET /status HTTP/1.1\r\nConnection: close\r\n\r\n', main.app)
+    assert data.startswith(b'HTTP/1.1 200 OK\r\n')
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGSTOP'), reason='no job control')
+def test_blocking_relay_suspends_for_a_slow_client(monkeypatch):
+    monkeypatch.setattr(main, 'RELAY_BUFFER', 256 * 1024)
+    monkeypatch.setattr(main, 'RELAY_RESUME', 64 * 1024)
+    size = 4 * 1024 * 1024
+    # Writes like ffmpeg does: a write cut short by the stop and continue signals is resumed
+    writer = f'import os\nrest = memoryview(bytes({size}))\nwhile rest: rest = rest[os.write(1, rest):]'
+    process = subprocess.Popen([sys.executable, '-c', writer], stdout=subprocess.PIPE, bufsize=65536)
+    body = main.PipeBody(process)
+    chunks = iter(body)  # The WSGI server stops pulling here, as it does for a client that fell behind
+    received = len(next(chunks))
+    deadline = time.time() + 10
+    while not body.suspended and time.time() < deadline: time.sleep(0.01)
+    assert body.suspended and body in main.active_relays
+    assert body.buffered < main.RELAY_BUFFER + body.chunk_size
+
+    received += sum(len(data) for data in chunks)
+    assert received == size and body.sent == size
+    assert not body.suspended and body not in main.active_relays
+    body.close()
+    assert process.wait(10) == 0